@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+# Synthetic SPDX corpus generator and benchmark for lxsbomtool
+#
+# Copyright (C) 2021 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+import os
+import sys
+import json
+import argparse
+import logging
+import hashlib
+import random
+import resource
+import sqlite3
+import subprocess
+import tarfile
+import shutil
+import io
+import time
+import platform
+
+scripts_path = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger(os.path.basename(__file__))
+
+CORPUS_FILE = "corpus.json"
+IMAGE = "bench-image"
+MACHINE = "qemux86-64"
+MACHINE_ARCH = "qemux86_64"
+
+# License expressions the IP database rows are made of, a mix of plain SPDX
+# identifiers, compound expressions and LicenseRefs
+LICENSES = [
+    "GPL-2.0-only", "GPL-2.0-or-later", "LGPL-2.1-or-later", "MIT", "BSD-3-Clause", "Apache-2.0",
+    "GPL-2.0-only WITH Linux-syscall-note", "MIT OR Apache-2.0", "BSD-2-Clause AND MIT",
+]
+SUBPACKAGES = ["", "-dev", "-dbg", "-doc", "-staticdev", "-locale", "-src", "-ptest"]
+
+
+def checksum(name, algorithm):
+    return hashlib.new(algorithm, name.encode()).hexdigest()
+
+
+def file_checksums(name):
+    return [
+        {"algorithm": "SHA1", "checksumValue": checksum(name, "sha1")},
+        {"algorithm": "SHA256", "checksumValue": checksum(name, "sha256")},
+    ]
+
+
+def create_ip_database(db_file):
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    db_conn = sqlite3.connect(db_file)
+    db_conn.execute("CREATE TABLE File (FileChecksum TEXT NOT NULL, FileType TEXT, LicenseConcluded TEXT, LicenseInfoInFile TEXT, FileCopyrightText TEXT)")
+    db_conn.execute("CREATE TABLE LicenseReference (LicenseID TEXT NOT NULL PRIMARY KEY, ExtractedText TEXT NOT NULL, LicenseName TEXT NOT NULL DEFAULT 'NOASSERTION', LicenseCrossReference TEXT, LicenseComment TEXT)")
+    db_conn.execute("CREATE INDEX File_FileChecksum ON File (FileChecksum)")
+    return db_conn
+
+
+def generate_corpus(corpus_dir, packages, files, sources, hit_rate, split, license_refs, seed):
+    """Write a synthetic image: package and recipe documents in
+    deploy/spdx/<MACHINE_ARCH>, the image and index documents (plain and as
+    .spdx.tar.zst when zstd is available) in deploy/images/<MACHINE> and a
+    matching IP database.
+
+    packages: number of packages in the image
+    files: packaged files per package and source files per recipe
+    sources: source files each packaged file is GENERATED_FROM
+    hit_rate: fraction of the source files with a row in the IP database
+    split: packages built from each recipe (foo, foo-dev, foo-dbg, ...)
+    license_refs: number of LicenseRefs, one in five is not in the database
+    """
+    rng = random.Random(seed)
+    deploy_dir_image = os.path.join(corpus_dir, "deploy", "images", MACHINE)
+    deploy_dir_spdx = os.path.join(corpus_dir, "deploy", "spdx", MACHINE_ARCH)
+    for path in (deploy_dir_image, f"{deploy_dir_spdx}/packages", f"{deploy_dir_spdx}/recipes", os.path.join(corpus_dir, "build", "conf")):
+        os.makedirs(path, exist_ok=True)
+
+    db_file = os.path.join(corpus_dir, "ip.sqlite3")
+    db_conn = create_ip_database(db_file)
+    refs = [f"LicenseRef-bench-{i}" for i in range(license_refs)]
+    for i, licid in enumerate(refs):
+        if i % 5 != 4:
+            db_conn.execute("INSERT INTO LicenseReference VALUES (?, ?, ?, NULL, ?)",
+                (licid, f"Extracted text of {licid}\n" + "Permission is hereby granted. " * 40, licid.lower(), "Generated by lxsbombench"))
+    licenses = LICENSES + [f"{licid} AND MIT" for licid in refs] + refs
+
+    creation_info = {"created": "2024-01-01T00:00:00Z", "creators": ["Tool: lxsbombench"], "licenseListVersion": "3.20"}
+    index = {"documents": []}
+    image_refs = []
+    image_relationships = []
+    recipes = (packages + split - 1) // split
+    for r in range(recipes):
+        recipe = f"recipe{r}"
+        namespace = f"http://spdx.org/spdxdocs/recipe-{recipe}-{checksum(recipe, 'sha1')}"
+        source_files = []
+        for i in range(files):
+            name = f"{recipe}/src/file{i}.c"
+            source_files.append({
+                "SPDXID": f"SPDXRef-SourceFile-{recipe}-{i + 1}",
+                "fileName": f"src/file{i}.c",
+                "checksums": file_checksums(name),
+                "fileTypes": ["SOURCE"],
+                "licenseConcluded": "NOASSERTION",
+                "licenseInfoInFiles": ["NOASSERTION"],
+                "copyrightText": "NOASSERTION",
+            })
+            if rng.random() < hit_rate:
+                db_conn.execute("INSERT INTO File VALUES (?, 'SOURCE', ?, ?, ?)", (
+                    f"SHA256:{checksum(name, 'sha256')}",
+                    ";".join(rng.sample(licenses, 2)),
+                    ";".join(rng.sample(licenses, rng.randint(1, 3))),
+                    f"Copyright (c) {2000 + i % 24} {recipe} authors\r\n",
+                ))
+        recipe_json = {
+            "SPDXID": "SPDXRef-DOCUMENT",
+            "name": f"recipe-{recipe}",
+            "documentNamespace": namespace,
+            "creationInfo": creation_info,
+            "packages": [{"SPDXID": f"SPDXRef-Recipe-{recipe}", "name": recipe, "versionInfo": "1.0"}],
+            "files": source_files,
+            "relationships": [],
+        }
+        with open(f"{deploy_dir_spdx}/recipes/recipe-{recipe}.spdx.json", "w") as fp:
+            json.dump(recipe_json, fp)
+        index["documents"].append({"documentNamespace": namespace, "filename": f"recipe-{recipe}.spdx.json"})
+
+    for p in range(packages):
+        recipe = f"recipe{p // split}"
+        package = f"{recipe}{SUBPACKAGES[p % split % len(SUBPACKAGES)]}" + ("" if p % split < len(SUBPACKAGES) else f"-{p % split}")
+        namespace = f"http://spdx.org/spdxdocs/{package}-{checksum(package, 'sha1')}"
+        package_id = f"SPDXRef-Package-{package}"
+        packaged_files = []
+        relationships = [{"spdxElementId": "SPDXRef-DOCUMENT", "relationshipType": "DESCRIBES", "relatedSpdxElement": package_id}]
+        for i in range(files):
+            file_id = f"SPDXRef-PackagedFile-{package}-{i + 1}"
+            packaged_files.append({
+                "SPDXID": file_id,
+                "fileName": f"/usr/lib/{package}/file{i}",
+                "checksums": file_checksums(file_id),
+                "fileTypes": ["BINARY"],
+                "licenseConcluded": "NOASSERTION",
+                "licenseInfoInFiles": ["NOASSERTION"],
+                "copyrightText": "NOASSERTION",
+            })
+            relationships.append({"spdxElementId": package_id, "relationshipType": "CONTAINS", "relatedSpdxElement": file_id})
+            for k in rng.sample(range(files), min(sources, files)):
+                relationships.append({"spdxElementId": file_id, "relationshipType": "GENERATED_FROM", "relatedSpdxElement": f"DocumentRef-recipe-{recipe}:SPDXRef-SourceFile-{recipe}-{k + 1}"})
+        relationships.append({"spdxElementId": package_id, "relationshipType": "GENERATED_FROM", "relatedSpdxElement": f"DocumentRef-recipe-{recipe}:SPDXRef-Recipe-{recipe}"})
+
+        package_json = {
+            "SPDXID": "SPDXRef-DOCUMENT",
+            "name": package,
+            "documentNamespace": namespace,
+            "creationInfo": creation_info,
+            "externalDocumentRefs": [{
+                "externalDocumentId": f"DocumentRef-recipe-{recipe}",
+                "spdxDocument": f"http://spdx.org/spdxdocs/recipe-{recipe}-{checksum(recipe, 'sha1')}",
+                "checksum": {"algorithm": "SHA1", "checksumValue": checksum(recipe, "sha1")},
+            }],
+            "packages": [{
+                "SPDXID": package_id,
+                "name": package,
+                "versionInfo": "1.0-r0",
+                "licenseConcluded": "NOASSERTION",
+                "licenseDeclared": "MIT",
+                "licenseInfoFromFiles": rng.sample(LICENSES[:6], 2),
+                "hasFiles": [f["SPDXID"] for f in packaged_files],
+                "packageVerificationCode": {"packageVerificationCodeValue": checksum(package, "sha1")},
+            }],
+            "files": packaged_files,
+            "relationships": relationships,
+        }
+        with open(f"{deploy_dir_spdx}/packages/{package}.spdx.json", "w") as fp:
+            json.dump(package_json, fp)
+        index["documents"].append({"documentNamespace": namespace, "filename": f"{package}.spdx.json"})
+        image_refs.append({"externalDocumentId": f"DocumentRef-package-{package}", "spdxDocument": namespace})
+        image_relationships.append({"spdxElementId": "SPDXRef-Image", "relationshipType": "CONTAINS", "relatedSpdxElement": f"DocumentRef-package-{package}:{package_id}"})
+
+    db_conn.commit()
+    db_conn.close()
+
+    image_json = {
+        "SPDXID": "SPDXRef-DOCUMENT",
+        "name": f"{IMAGE}-{MACHINE}",
+        "creationInfo": creation_info,
+        "externalDocumentRefs": image_refs,
+        "relationships": [{"spdxElementId": "SPDXRef-DOCUMENT", "relationshipType": "DESCRIBES", "relatedSpdxElement": "SPDXRef-Image"}] + image_relationships,
+    }
+    with open(f"{deploy_dir_image}/{IMAGE}-{MACHINE}.spdx.json", "w") as fp:
+        json.dump(image_json, fp)
+    with open(f"{deploy_dir_image}/{IMAGE}-{MACHINE}.spdx.index.json", "w") as fp:
+        json.dump(index, fp)
+    archive = write_archive(f"{deploy_dir_image}/{IMAGE}-{MACHINE}.spdx.tar.zst", {
+        "index.json": index,
+        f"{IMAGE}-{MACHINE}-20240101000000.spdx.json": image_json,
+    })
+
+    corpus = {
+        "parameters": {
+            "packages": packages, "files": files, "sources": sources, "hit_rate": hit_rate,
+            "split": split, "license_refs": license_refs, "seed": seed,
+        },
+        "image": IMAGE,
+        "archive": archive,
+        "db_file": db_file,
+        "builddir": os.path.join(corpus_dir, "build"),
+        "DEPLOY_DIR_IMAGE": deploy_dir_image,
+        "DEPLOY_DIR_SPDX": deploy_dir_spdx,
+        "MACHINE_ARCH": MACHINE_ARCH,
+    }
+    with open(os.path.join(corpus_dir, CORPUS_FILE), "w") as fp:
+        json.dump(corpus, fp, indent=2)
+    return corpus
+
+
+def write_archive(archive_file, members):
+    """Write members as a .spdx.tar.zst like the image SPDX archive of a
+    build, returns False when zstd is not available."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        for name, member in members.items():
+            content = json.dumps(member).encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(content))
+    try:
+        subprocess.run(["zstd", "-q", "-f", "-o", archive_file], input=data.getvalue(), check=True)
+    except (OSError, subprocess.CalledProcessError):
+        logger.warning("zstd is not available, the corpus has no .spdx.tar.zst")
+        if os.path.exists(archive_file):
+            os.remove(archive_file)
+        return False
+    return True
+
+
+def load_corpus(corpus_dir):
+    with open(os.path.join(corpus_dir, CORPUS_FILE)) as fp:
+        return json.load(fp)
+
+
+def tool_environment(corpus):
+    """Environment for lxsbomtool runs: the bitbake variables it would read
+    with tinfoil come from the corpus."""
+    env = dict(os.environ)
+    env["BUILDDIR"] = corpus["builddir"]
+    for name in ("DEPLOY_DIR_IMAGE", "DEPLOY_DIR_SPDX", "MACHINE_ARCH"):
+        env[name] = corpus[name]
+    return env
+
+
+def run_end_to_end(corpus, output_dir, tool_args):
+    """Run lxsbomtool on the corpus, returns wall time, peak RSS and the
+    counters it reports with -t."""
+    shutil.rmtree(output_dir, ignore_errors=True)
+    cmd = [sys.executable, os.path.join(scripts_path, "lxsbomtool.py"), "-i", corpus["image"], "-D", corpus["db_file"], "-o", output_dir, "-t"] + tool_args
+    start = time.time()
+    proc = subprocess.Popen(cmd, env=tool_environment(corpus), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    output = proc.stdout.read()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.time() - start
+
+    result = {
+        "args": tool_args,
+        "returncode": proc.returncode,
+        "wall_time": wall_time,
+        "cpu_time": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss_kb": rusage.ru_maxrss,
+    }
+    counters = {
+        "ip_queries": " IP database queries",
+        "index_lookups": " checksum index lookups",
+        "licenseref_queries": " LicenseReference queries",
+        "succeeded": " packages parsed successfully",
+        "failed": " packages failed to parse",
+    }
+    for line in output.splitlines():
+        message = line.split(": ", 1)[-1]
+        for key, suffix in counters.items():
+            if message.endswith(suffix) and message[:-len(suffix)].isdigit():
+                result[key] = int(message[:-len(suffix)])
+    if proc.returncode != 0:
+        logger.error(f"lxsbomtool failed:\n{output}")
+    return result
+
+
+class FunctionTimer:
+    """Wraps module functions to record their call count and total time"""
+    def __init__(self, module, names):
+        self._module = module
+        self._originals = {}
+        self.stats = {name: {"calls": 0, "total_time": 0.0} for name in names}
+        for name in names:
+            self._originals[name] = getattr(module, name)
+            setattr(module, name, self._wrap(name, self._originals[name]))
+
+    def _wrap(self, name, function):
+        stats = self.stats[name]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats["calls"] += 1
+                stats["total_time"] += time.perf_counter() - start
+        return timed
+
+    def restore(self):
+        for name, function in self._originals.items():
+            setattr(self._module, name, function)
+
+
+# Functions of lxsbomtool timed by run_hot_functions
+HOT_FUNCTIONS = [
+    "load_spdx_document", "resolve_package", "resolve_source_file", "extract_license_copyright",
+    "collate_license_and_copyright", "write_resolved_package", "write_license_information",
+]
+
+
+def run_hot_functions(corpus, output_dir):
+    """Generate every package of the corpus in-process, timing the hot
+    functions of lxsbomtool and counting IP database queries."""
+    sys.path.insert(0, scripts_path)
+    import lxsbomtool
+
+    with open(f"{corpus['DEPLOY_DIR_IMAGE']}/{corpus['image']}-{MACHINE}.spdx.json") as fp:
+        image_json = json.load(fp)
+    with open(f"{corpus['DEPLOY_DIR_IMAGE']}/{corpus['image']}-{MACHINE}.spdx.index.json") as fp:
+        index_json = json.load(fp)
+
+    namespaces = lxsbomtool.make_namespace_dict(index_json)
+    common_args = lxsbomtool.CommonArgs(logger, dict(), lxsbomtool.OrderedSet(), lxsbomtool.RecipeStore(500000), {},
+        lxsbomtool.FileChecksumLookup(), namespaces, lxsbomtool.make_source_file_cache(256), lxsbomtool.LicenseReferenceLookup())
+    docref_dict = lxsbomtool.make_document_ref_dict(image_json['externalDocumentRefs'], index_json, namespaces)
+    relationships = [rel for rel in image_json['relationships'] if rel['relationshipType'] == "CONTAINS"]
+    db_conn = sqlite3.connect(corpus["db_file"])
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    timer = FunctionTimer(lxsbomtool, HOT_FUNCTIONS)
+    parse_logs = {}
+    start = time.time()
+    try:
+        for rel in relationships:
+            lxsbomtool.parse_relationship(rel, len(relationships), parse_logs, db_conn, None, corpus["image"], False, index_json, image_json,
+                corpus["DEPLOY_DIR_SPDX"], output_dir, docref_dict, common_args)
+    finally:
+        timer.restore()
+        db_conn.close()
+
+    return {
+        "wall_time": time.time() - start,
+        "packages": len(relationships),
+        "failed": sum(1 for log in parse_logs.values() if log.get("parse_status") != "succeeded"),
+        "ip_queries": common_args.getFileChecksumLookup().getQueryCount(),
+        "licenseref_queries": common_args.getLicenseReferenceLookup().getCounts()[0],
+        "functions": timer.stats,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic SPDX corpus generator and benchmark for lxsbomtool")
+    parser.add_argument('-d', '--debug', help='Enable debug output', action='store_true')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help="Generate a synthetic corpus")
+    generate_parser.add_argument('corpus_dir', help="Directory to generate the corpus in")
+    generate_parser.add_argument('--packages', help="Number of packages, default is 100", type=int, default=100)
+    generate_parser.add_argument('--files', help="Files per package and recipe, default is 50", type=int, default=50)
+    generate_parser.add_argument('--sources', help="Source files per packaged file, default is 3", type=int, default=3)
+    generate_parser.add_argument('--hit_rate', help="Fraction of source files in the IP database, default is 0.8", type=float, default=0.8)
+    generate_parser.add_argument('--split', help="Packages per recipe, default is 4", type=int, default=4)
+    generate_parser.add_argument('--license_refs', help="Number of LicenseRefs, default is 50", type=int, default=50)
+    generate_parser.add_argument('--seed', help="Random seed, default is 1", type=int, default=1)
+
+    run_parser = subparsers.add_parser('run', help="Benchmark lxsbomtool on a corpus, lxsbomtool arguments follow --")
+    run_parser.add_argument('corpus_dir', help="Corpus generated with the generate command")
+    run_parser.add_argument('-o', '--output', help="Write the results to this JSON file instead of stdout", action='store')
+    run_parser.add_argument('-r', '--repeat', help="Number of end-to-end runs, default is 1", type=int, default=1)
+    run_parser.add_argument('--no_functions', help="Skip the in-process hot function timing", action='store_true')
+    # Anything after -- is passed on to lxsbomtool
+    argv = sys.argv[1:]
+    tool_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG if args.debug else logging.INFO)
+
+    if args.command == 'generate':
+        start = time.time()
+        generate_corpus(args.corpus_dir, args.packages, args.files, args.sources, args.hit_rate, args.split, args.license_refs, args.seed)
+        logger.info(f"Generated {args.packages} packages in {args.corpus_dir} in {time.time() - start:.1f}s")
+        return
+
+    corpus = load_corpus(args.corpus_dir)
+    results = {
+        "corpus": corpus["parameters"],
+        "python": platform.python_version(),
+        "end_to_end": [run_end_to_end(corpus, os.path.join(args.corpus_dir, "out"), tool_args) for _ in range(args.repeat)],
+    }
+    if not args.no_functions:
+        results["hot_functions"] = run_hot_functions(corpus, os.path.join(args.corpus_dir, "out-functions"))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -17,44 +17,83 @@ import traceback
 import time
 import sqlite3
 from sqlite3 import Error
+import mmap
+import struct
 import tempfile
+import shutil
+import hashlib
+import multiprocessing
+import signal
+import lzma
+import io
+import tarfile
+import fnmatch
+import subprocess
+import contextlib
+import functools
+import heapq
+import socket
+import socketserver
+import math
+import cProfile
+import pstats
 from collections import OrderedDict
 from datetime import datetime, timezone
 
+TOOL_VERSION = "1.0"
+
+DOCUMENT_COMMENT = "This document is provided \"AS IS\" without any warranty, express or implied, including, but not limited to the Warranties of Merchantability, Fitness for a Particular Purpose, title and Non-Infringement. Wind River assumes no responsibility or liability for any errors or inaccuracies with respect to the information contained in it. Wind River may change the contents of this document at any time at its sole discretion, and Wind River shall have no liability whatsoever arising from recipient's use of this information. This file contains only computer generated SPDX data derived from computer automation.  Any legal obligations based on the content of this document should come from independent legal analysis and by reference to the notices and licenses contained within the open-source code itself."
+
 scripts_path = os.path.dirname(__file__)
-for path in list(filter(lambda p: "bitbake/lib" in p, os.environ["PYTHONPATH"].split(':'))):
+for path in list(filter(lambda p: "bitbake/lib" in p, os.environ.get("PYTHONPATH", "").split(':'))):
     lib_path = f"{path}/../../scripts/lib"
     if os.path.isfile(f"{lib_path}/scriptutils.py"):
         sys.path = sys.path + [lib_path]
         break
-    else:
+    elif __name__ == "__main__":
+        # Importing the module for its API continues quietly without bitbake
         print("ERROR: scriptutils.py is not found, please check for PYTHONPATH contains a path to bibake/lib")
         sys.exit(1)
 
-import scriptutils
-logger = scriptutils.logger_create(os.path.basename(__file__))
-
-import argparse_oe
-import scriptpath
-bitbakepath = scriptpath.add_bitbake_lib_path()
-if not bitbakepath:
-    logger.error("Unable to find bitbake by searching parent directory of this script or PATH")
-    sys.exit(1)
-logger.debug('Using standard bitbake path %s' % bitbakepath)
-scriptpath.add_oe_lib_path()
-
-import bb.tinfoil
-import bb.utils
-import oe.utils
-import oe.recipeutils
+# The bitbake libraries are only needed to read the bitbake configuration.
+# Outside of an oe-init-build-env environment the tool still runs when
+# DEPLOY_DIR_IMAGE, DEPLOY_DIR_SPDX and MACHINE_ARCH are given, see
+# get_bitbake_vars.
+try:
+    import scriptutils
+except ImportError:
+    scriptutils = None
+
+if scriptutils is not None:
+    logger = scriptutils.logger_create(os.path.basename(__file__))
+
+    import argparse_oe
+    import scriptpath
+    bitbakepath = scriptpath.add_bitbake_lib_path()
+    if not bitbakepath:
+        logger.error("Unable to find bitbake by searching parent directory of this script or PATH")
+        sys.exit(1)
+    logger.debug('Using standard bitbake path %s' % bitbakepath)
+    scriptpath.add_oe_lib_path()
+else:
+    argparse_oe = None
+    logger = logging.getLogger(os.path.basename(__file__))
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    logger.addHandler(handler)
 
 class CommonArgs:
-    def __init__(self, logger, license_copyright_buffer, license_refs, recipe_file_lookup, source_file_lookup):
+    def __init__(self, logger, license_copyright_buffer, license_refs, recipe_file_lookup, source_file_lookup, file_checksum_lookup=None, document_namespaces=None, source_file_cache=None, license_reference_lookup=None, phase_timer=None):
         self._logger = logger
         self._license_copyright_buffer = license_copyright_buffer
         self._license_refs = license_refs
         self._recipe_file_lookup = recipe_file_lookup
         self._source_file_lookup = source_file_lookup
+        self._file_checksum_lookup = file_checksum_lookup
+        self._document_namespaces = document_namespaces
+        self._source_file_cache = source_file_cache
+        self._license_reference_lookup = license_reference_lookup
+        self._phase_timer = phase_timer
 
     def getLogger(self):
         return self._logger
@@ -71,14 +110,135 @@ class CommonArgs:
     def getSourceFileLookup(self):
         return self._source_file_lookup
 
+    def getFileChecksumLookup(self):
+        return self._file_checksum_lookup
+
+    def getDocumentNamespaces(self):
+        return self._document_namespaces
+
+    def getSourceFileCache(self):
+        return self._source_file_cache
 
-def logTimedEvent(task_name, start_time, args_time, common_args):
+    def getLicenseReferenceLookup(self):
+        return self._license_reference_lookup
+
+    def getPhaseTimer(self):
+        return self._phase_timer
+
+    def getCounters(self):
+        """The caches and lookups whose counters are reported with -t"""
+        return [c for c in (self._file_checksum_lookup, self._recipe_file_lookup, self._source_file_cache, self._license_reference_lookup) if c is not None]
+
+    def resetPackageState(self):
+        """License and copyright data, and phase timings, are collected per
+        package, make sure nothing is carried over from the previous package."""
+        self._license_copyright_buffer.clear()
+        self._license_refs.clear()
+        if self._phase_timer is not None:
+            self._phase_timer.reset()
+
+
+def logTimedEvent(task_name, start_time, args_time, common_args, phase=None):
     if(args_time):
-        common_args.getLogger().debug(f"Completed subtask {task_name} in {time.time()-start_time}s")
+        duration = time.time()-start_time
+        if phase is not None and common_args.getPhaseTimer() is not None:
+            common_args.getPhaseTimer().add(phase, duration)
+        common_args.getLogger().debug(f"Completed subtask {task_name} in {duration}s")
     else:
         common_args.getLogger().debug(f"Completed substask {task_name}")
 
 
+class PhaseTimer:
+    """Count, total and max duration of each phase of the current package,
+    fed by logTimedEvent with -t. parse_relationship stores them in the
+    package's parse_logs.json entry, the run summary is built from those so
+    it is the same with --jobs."""
+    PHASES = ("json_load", "index", "db_lookup", "render", "license_refs", "file_write")
+
+    def __init__(self):
+        self._phases = {}
+
+    def reset(self):
+        self._phases = {}
+
+    def add(self, phase, duration, count=1, longest=None):
+        stats = self._phases.setdefault(phase, {"count": 0, "total": 0.0, "max": 0.0})
+        stats["count"] += count
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration if longest is None else longest)
+
+    def getPhases(self):
+        """A copy of the phases, the timer goes on to the next package"""
+        return {phase: dict(stats) for phase, stats in self._phases.items()}
+
+    def addPhases(self, phases):
+        """Fold in the phases of a package parsed by a worker process"""
+        for phase, stats in phases.items():
+            self.add(phase, stats["total"], stats["count"], stats["max"])
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def phase_summary(parse_logs):
+    """Run level count, total and max of each phase, with the percentiles of
+    the per package totals. Skipped, interrupted and resumed packages are
+    left out."""
+    totals = {}
+    summary = {}
+    for log in parse_logs.values():
+        if log.get("parse_status") not in ("succeeded", "failed") or log.get("resumed"):
+            continue
+        for phase, stats in log.get("phases", {}).items():
+            entry = summary.setdefault(phase, {"packages": 0, "count": 0, "total": 0.0, "max": 0.0})
+            entry["packages"] += 1
+            entry["count"] += stats["count"]
+            entry["total"] += stats["total"]
+            entry["max"] = max(entry["max"], stats["max"])
+            totals.setdefault(phase, []).append(stats["total"])
+    for phase, values in totals.items():
+        values.sort()
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            summary[phase][name] = percentile(values, fraction)
+    order = {phase: i for i, phase in enumerate(PhaseTimer.PHASES)}
+    return dict(sorted(summary.items(), key=lambda item: order.get(item[0], len(order))))
+
+
+def log_phase_summary(summary, common_args):
+    common_args.getLogger().info(f"{'phase':<14}{'packages':>9}{'count':>9}{'total':>10}{'max':>10}{'p50':>10}{'p90':>10}{'p99':>10}")
+    for phase, entry in summary.items():
+        common_args.getLogger().info(f"{phase:<14}{entry['packages']:>9}{entry['count']:>9}{entry['total']:>10.3f}{entry['max']:>10.4f}{entry['p50']:>10.4f}{entry['p90']:>10.4f}{entry['p99']:>10.4f}")
+
+
+def run_profiled(profile_dir, package_name, function, *args):
+    """Calls function, under cProfile when profile_dir is set. The profile is
+    written to profile_dir/<package_name>.prof."""
+    if profile_dir is None:
+        return function(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(f"{profile_dir}/{package_name}.prof")
+
+
+def keep_slowest_profiles(profile_dir, parse_logs, count):
+    """Remove the profiles of all but the count slowest packages and write
+    their top functions, by cumulative time, to profile_dir/summary.txt"""
+    timed = sorted(((log["time_elapsed"], name) for name, log in parse_logs.items() if log.get("parse_status") in ("succeeded", "failed")), reverse=True)
+    slowest = [name for elapsed, name in timed[:count]]
+    for filename in os.listdir(profile_dir):
+        if filename.endswith(".prof") and filename[:-len(".prof")] not in slowest:
+            os.remove(f"{profile_dir}/{filename}")
+    with open(f"{profile_dir}/summary.txt", "w") as summary_fp:
+        for elapsed, name in timed[:count]:
+            summary_fp.write(f"{name}: {elapsed:.3f}s\n")
+            pstats.Stats(f"{profile_dir}/{name}.prof", stream=summary_fp).sort_stats("cumulative").print_stats(25)
+    return slowest
+
+
 def create_connection(db_file, common_args):
     """ create a database connection to the SQLite database
         specified by the db_file
@@ -94,10 +254,672 @@ def create_connection(db_file, common_args):
     return conn
 
 
+class ChecksumIndex:
+    """Read-only, memory-mapped view of the IP database File table.
+
+    Layout (little endian):
+        header:  magic, record count, records offset, pool offset
+        records: sorted (raw SHA256 digest, pool offset of the file's rows)
+        pool:    deduplicated row lists and strings
+
+    A row list is a u32 row count followed by four u32 string offsets per row
+    (FileType, LicenseConcluded, LicenseInfoInFile, FileCopyrightText), a
+    string is a u32 length followed by the UTF-8 bytes. NULL is stored as
+    NULL_STRING. Lookups binary search the mapping directly so several jobs on
+    the same host share one copy through the page cache.
+    """
+    MAGIC = b"WRSBIDX1"
+    HEADER = struct.Struct("<8sQQQ")
+    RECORD = struct.Struct("<32sQ")
+    U32 = struct.Struct("<I")
+    NULL_STRING = 0xffffffff
+
+    def __init__(self, index_file):
+        with open(index_file, "rb") as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._records_offset, self._pool_offset = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            self._mm.close()
+            raise ValueError(f"{index_file} is not a checksum index")
+
+    @staticmethod
+    def makeKey(sha):
+        """Returns the raw digest for a canonical 'SHA256:<hex>' checksum,
+        None for anything the index cannot answer for."""
+        algorithm, _, value = sha.partition(':')
+        if algorithm != "SHA256" or len(value) != 64:
+            return None
+        try:
+            key = bytes.fromhex(value)
+        except ValueError:
+            return None
+        if key.hex() != value:
+            return None
+        return key
+
+    def _readString(self, offset):
+        if offset == self.NULL_STRING:
+            return None
+        start = self._pool_offset + offset
+        length, = self.U32.unpack_from(self._mm, start)
+        return self._mm[start + 4:start + 4 + length].decode("utf-8")
+
+    def getRows(self, sha, key):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self._records_offset + mid * self.RECORD.size
+            if self._mm[pos:pos + 32] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        pos = self._records_offset + lo * self.RECORD.size
+        if lo == self._count or self._mm[pos:pos + 32] != key:
+            return []
+
+        offset = self._pool_offset + self.RECORD.unpack_from(self._mm, pos)[1]
+        nrows, = self.U32.unpack_from(self._mm, offset)
+        rows = []
+        for i in range(nrows):
+            strings = struct.unpack_from("<4I", self._mm, offset + 4 + i * 16)
+            rows.append((sha,) + tuple(self._readString(o) for o in strings))
+        return rows
+
+    def close(self):
+        self._mm.close()
+
+
+def build_checksum_index(db_file, index_file, common_args):
+    """Export the File table of db_file into a ChecksumIndex at index_file.
+
+    The index is written next to its final location and renamed into place so
+    that concurrent jobs never map a partial file.
+    """
+    tIdx = time.time()
+    pool = bytearray()
+    pool_offsets = {}
+
+    def pool_add(data):
+        offset = pool_offsets.get(data)
+        if offset is None:
+            offset = len(pool)
+            if offset >= ChecksumIndex.NULL_STRING:
+                raise ValueError("checksum index string pool is too large")
+            pool_offsets[data] = offset
+            pool.extend(data)
+        return offset
+
+    def string_offset(value):
+        if value is None:
+            return ChecksumIndex.NULL_STRING
+        data = str(value).encode("utf-8")
+        return pool_add(ChecksumIndex.U32.pack(len(data)) + data)
+
+    # Canonical checksums are lower case hex behind a common prefix, so the
+    # database's text ordering is also the digest ordering and the records can
+    # be streamed straight to disk. Only the pool is held in memory.
+    tmp_file = f"{index_file}.tmp{os.getpid()}"
+    count = 0
+    try:
+        db_conn = sqlite3.connect(db_file)
+        with open(tmp_file, "wb") as fp:
+            records_offset = ChecksumIndex.HEADER.size
+            fp.write(ChecksumIndex.HEADER.pack(ChecksumIndex.MAGIC, 0, records_offset, 0))
+
+            def write_record(key, rows):
+                fp.write(ChecksumIndex.RECORD.pack(key, pool_add(ChecksumIndex.U32.pack(len(rows)) + b"".join(rows))))
+
+            cur = db_conn.cursor()
+            cur.execute("SELECT FileChecksum, * FROM File ORDER BY FileChecksum, rowid")
+            current_key = None
+            current_rows = []
+            for row in cur:
+                key = ChecksumIndex.makeKey(row[0]) if isinstance(row[0], str) else None
+                if key is None:
+                    continue
+                if key != current_key:
+                    if current_rows:
+                        write_record(current_key, current_rows)
+                        count += 1
+                    current_key = key
+                    current_rows = []
+                current_rows.append(struct.pack("<4I", *(string_offset(v) for v in row[2:6])))
+            if current_rows:
+                write_record(current_key, current_rows)
+                count += 1
+
+            pool_offset = records_offset + count * ChecksumIndex.RECORD.size
+            fp.write(pool)
+            fp.seek(0)
+            fp.write(ChecksumIndex.HEADER.pack(ChecksumIndex.MAGIC, count, records_offset, pool_offset))
+        db_conn.close()
+    except (Error, OSError, ValueError) as e:
+        common_args.getLogger().warning(f"Unable to build checksum index from {db_file}: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
+
+    os.replace(tmp_file, index_file)
+    logTimedEvent(f"build checksum index with {count} checksums", tIdx, True, common_args)
+    return True
+
+
+def open_checksum_index(index_file, rcpl_file, common_args):
+    """Returns a ChecksumIndex for index_file, or None when it is missing or
+    older than the RCPL level recorded in rcpl_file. Callers fall back to
+    querying SQLite in that case."""
+    if not os.path.exists(index_file):
+        return None
+    if os.path.exists(rcpl_file) and os.path.getmtime(index_file) < os.path.getmtime(rcpl_file):
+        common_args.getLogger().debug(f"{index_file} is older than {rcpl_file}, ignoring it")
+        return None
+    try:
+        return ChecksumIndex(index_file)
+    except (OSError, ValueError, struct.error) as e:
+        common_args.getLogger().warning(f"Unable to open checksum index {index_file}: {e}")
+        return None
+
+
+class FileChecksumLookup:
+    """Checksum to File rows map for the IP database.
+
+    When a ChecksumIndex is available it answers directly from the mapping.
+    Otherwise checksums are resolved in bulk with chunked, parameterized
+    IN (...) queries rather than one SELECT per source file, and checksums
+    without a match are remembered as an empty list so they are never queried
+    twice.
+    """
+    # Stay well below SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds
+    CHUNK_SIZE = 900
+
+    def __init__(self, checksum_index=None):
+        self._checksum_index = checksum_index
+        self._rows = {}
+        self._query_count = 0
+        self._index_lookups = 0
+
+    def setChecksumIndex(self, checksum_index):
+        self._checksum_index = checksum_index
+
+    def preload(self, db_conn, checksums):
+        pending = [sha for sha in dict.fromkeys(checksums) if sha not in self._rows and not self._useIndex(sha)]
+        cur = db_conn.cursor()
+        for i in range(0, len(pending), self.CHUNK_SIZE):
+            chunk = pending[i:i + self.CHUNK_SIZE]
+            for sha in chunk:
+                self._rows[sha] = []
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(f"SELECT FileChecksum, * FROM File WHERE FileChecksum IN ({placeholders})", chunk)
+            self._query_count += 1
+            for row in cur.fetchall():
+                self._rows[row[0]].append(row[1:])
+
+    def _useIndex(self, sha):
+        return self._checksum_index is not None and ChecksumIndex.makeKey(sha) is not None
+
+    def getRows(self, db_conn, sha):
+        if self._useIndex(sha):
+            self._index_lookups += 1
+            return self._checksum_index.getRows(sha, ChecksumIndex.makeKey(sha))
+        if sha not in self._rows:
+            self.preload(db_conn, [sha])
+        return self._rows[sha]
+
+    def clear(self):
+        """Forget the rows looked up so far, the counters are kept"""
+        self._rows.clear()
+
+    def getQueryCount(self):
+        return self._query_count
+
+    def getIndexLookupCount(self):
+        return self._index_lookups
+
+    def getCounts(self):
+        return (self._query_count, self._index_lookups)
+
+    def addCounts(self, query_count, index_lookups):
+        """Fold in the counters of a worker process"""
+        self._query_count += query_count
+        self._index_lookups += index_lookups
+
+
+class RecipeStore:
+    """Bounded LRU cache of recipe documents.
+
+    Only an SPDXID -> file entry index is kept for each recipe, the rest of the
+    document is dropped once it has been parsed. Recipes are evicted least
+    recently used first once more than max_files file entries are held; the
+    most recently used recipe is always kept, however large it is.
+    """
+    def __init__(self, max_files):
+        self._max_files = max_files
+        self._recipes = OrderedDict()
+        self._fingerprints = {}
+        self._file_count = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _load(self, recipe_name, deploy_dir_spdx, args_time, common_args):
+        common_args.getLogger().debug(f"Recipe Name {recipe_name}")
+        tRec = time.time()
+        recipe_json = load_spdx_document(deploy_dir_spdx, "recipes", recipe_name)
+        logTimedEvent("load recipe JSON", tRec, args_time, common_args, "json_load")
+
+        files = {}
+        for src_file in recipe_json['files']:
+            files.setdefault(src_file['SPDXID'], src_file)
+        return files
+
+    def getFiles(self, recipe_name, deploy_dir_spdx, args_time, common_args):
+        """Returns the SPDXID -> file entry index of a recipe document"""
+        files = self._recipes.get(recipe_name)
+        if files is not None:
+            common_args.getLogger().debug('Recipe already looked up, using cached data')
+            self._hits += 1
+            self._recipes.move_to_end(recipe_name)
+            return files
+
+        self._misses += 1
+        fingerprint = spdx_document_fingerprint(deploy_dir_spdx, "recipes", recipe_name)
+        files = self._load(recipe_name, deploy_dir_spdx, args_time, common_args)
+        self._recipes[recipe_name] = files
+        self._fingerprints[recipe_name] = fingerprint
+        self._file_count += len(files)
+        while self._file_count > self._max_files and len(self._recipes) > 1:
+            evicted_name, evicted = self._recipes.popitem(last=False)
+            del self._fingerprints[evicted_name]
+            self._file_count -= len(evicted)
+            self._evictions += 1
+            common_args.getLogger().debug(f"Evicted recipe {evicted_name} from the cache")
+        return files
+
+    def dropChanged(self, deploy_dir_spdx, common_args):
+        """Drop the recipes whose document changed since it was loaded"""
+        for recipe_name in list(self._recipes):
+            if spdx_document_fingerprint(deploy_dir_spdx, "recipes", recipe_name) != self._fingerprints[recipe_name]:
+                common_args.getLogger().debug(f"Recipe {recipe_name} changed, dropping it from the cache")
+                self._file_count -= len(self._recipes.pop(recipe_name))
+                del self._fingerprints[recipe_name]
+
+    def getCounts(self):
+        return (self._hits, self._misses, self._evictions)
+
+    def addCounts(self, hits, misses, evictions):
+        """Fold in the counters of a worker process"""
+        self._hits += hits
+        self._misses += misses
+        self._evictions += evictions
+
+
+class CachedSourceFile:
+    """What a source file contributes to every package that references it:
+    its IP database rows, the LicenseRefs and license_copyright_buffer entry
+    extracted from them and its rendered block for each output format."""
+    __slots__ = ('rows', 'license_refs', 'buffer_entry', 'rendered', 'size')
+
+    def __init__(self, rows, license_refs, buffer_entry):
+        self.rows = rows
+        self.license_refs = license_refs
+        self.buffer_entry = buffer_entry
+        self.rendered = {}
+        self.size = self.ENTRY_SIZE
+
+    # Rough size of an entry without its rendered blocks
+    ENTRY_SIZE = 512
+
+
+class SourceFileCache:
+    """Bounded LRU cache of CachedSourceFile keyed on source file SPDXID and
+    checksum.
+
+    Split packages of a recipe (foo, foo-dev, foo-dbg, ...) share most of their
+    source files, with the cache the license data of a source file is extracted
+    and its block is rendered once per run instead of once per package. Entries
+    are evicted least recently used first once their estimated size exceeds
+    max_bytes.
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def makeKey(file_data):
+        return (file_data['SPDXID'], source_file_checksum(file_data))
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        replaced = self._entries.pop(key, None)
+        if replaced is not None:
+            self._size -= replaced.size
+        self._entries[key] = entry
+        self._size += entry.size
+        self._evict()
+
+    def getRendered(self, entry, writer, file_data):
+        """Returns the block of the source file for writer, rendering it the
+        first time. The entry may have been evicted since it was looked up
+        (or come from another process), it is only counted in the size of
+        the cache while it is held."""
+        text = entry.rendered.get(writer.extension)
+        if text is None:
+            text = writer.renderSourceFile(file_data, entry.rows)
+            entry.rendered[writer.extension] = text
+            entry.size += len(text)
+            if self._entries.get(self.makeKey(file_data)) is entry:
+                self._size += len(text)
+                self._evict()
+        return text
+
+    def _evict(self):
+        while self._size > self._max_bytes and len(self._entries) > 1:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+            self._evictions += 1
+
+    def getSize(self):
+        """Estimated size of the entries held, in bytes"""
+        return self._size
+
+    def getCounts(self):
+        return (self._hits, self._misses, self._evictions)
+
+    def addCounts(self, hits, misses, evictions):
+        """Fold in the counters of a worker process"""
+        self._hits += hits
+        self._misses += misses
+        self._evictions += evictions
+
+
+def make_source_file_cache(max_mib):
+    """SourceFileCache of max_mib MiB, None when the cache is disabled"""
+    return SourceFileCache(max_mib << 20) if max_mib > 0 else None
+
+
+def rcpl_dump_files(sqlite_db_files, first_rcpl):
+    """Returns [(rcpl, dump file), ...] for the consecutive rcpl-NNNN.dump.xz
+    files starting at first_rcpl."""
+    dump_files = []
+    rcpl = first_rcpl
+    while os.path.exists(f"{sqlite_db_files}/rcpl-{rcpl:04}.dump.xz"):
+        dump_files.append((rcpl, f"{sqlite_db_files}/rcpl-{rcpl:04}.dump.xz"))
+        rcpl += 1
+    return dump_files
+
+
+# The dumps used to be replayed through the sqlite3 shell, which reports and
+# skips failing statements. Everything is now applied in one transaction that
+# is abandoned on the first error, so rewrite the statements the shell used to
+# skip (tables and indexes that already exist, rows that are already present)
+# into their idempotent forms. The dumps' own transaction control is dropped.
+RCPL_DUMP_REWRITES = [
+    (re.compile(r"^CREATE TABLE (?!IF NOT EXISTS )"), "CREATE TABLE IF NOT EXISTS "),
+    (re.compile(r"^CREATE (UNIQUE )?INDEX (?!IF NOT EXISTS )"), r"CREATE \1INDEX IF NOT EXISTS "),
+    (re.compile(r"^INSERT INTO "), "INSERT OR IGNORE INTO "),
+]
+RCPL_DUMP_SKIPPED = ("BEGIN TRANSACTION;", "BEGIN;", "COMMIT;", "END TRANSACTION;", "ROLLBACK;")
+
+# Indexes the lookups rely on, created after the rows are loaded
+RCPL_LOOKUP_INDEXES = [("File", "FileChecksum"), ("LicenseReference", "LicenseID")]
+
+
+def iter_dump_statements(dump_file):
+    """Stream-decompress an xz compressed SQL dump and yield it one complete
+    statement at a time."""
+    lines = []
+    with lzma.open(dump_file, "rt", encoding="utf-8") as fp:
+        for line in fp:
+            lines.append(line)
+            if line.rstrip().endswith(";") and sqlite3.complete_statement("".join(lines)):
+                yield "".join(lines).strip()
+                lines = []
+    if "".join(lines).strip():
+        raise ValueError(f"{dump_file} ends with an incomplete statement")
+
+
+def ensure_index(db_conn, table, column):
+    """Create an index on table(column) unless the table is missing or
+    already has an index leading with column."""
+    if not db_conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
+        return
+    for index in db_conn.execute(f"PRAGMA index_list('{table}')").fetchall():
+        info = db_conn.execute(f"PRAGMA index_info('{index[1]}')").fetchall()
+        if info and info[0][2] == column:
+            return
+    db_conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table}({column})")
+
+
+def apply_rcpl_dumps(db_file, dump_files, journal_mode, common_args):
+    """Stream dump_files into db_file in a single transaction, with settings
+    suited to bulk loads. Index creation is deferred until all rows are in.
+    On any error the transaction is rolled back, leaving db_file as it was.
+    Returns True on success."""
+    tLoad = time.time()
+    deferred = []
+    db_conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        db_conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        db_conn.execute("PRAGMA synchronous=OFF")
+        db_conn.execute("PRAGMA cache_size=-262144")
+        db_conn.execute("PRAGMA temp_store=MEMORY")
+        db_conn.execute("BEGIN")
+
+        for rcpl, dump_file in dump_files:
+            common_args.getLogger().info(f"Loading {dump_file}")
+            for statement in iter_dump_statements(dump_file):
+                if statement in RCPL_DUMP_SKIPPED:
+                    continue
+                for pattern, replacement in RCPL_DUMP_REWRITES:
+                    statement = pattern.sub(replacement, statement, count=1)
+                if statement.startswith("CREATE INDEX") or statement.startswith("CREATE UNIQUE INDEX"):
+                    deferred.append(statement)
+                    continue
+                db_conn.execute(statement)
+
+        rows = db_conn.total_changes
+        tIndex = time.time()
+        for statement in deferred:
+            db_conn.execute(statement)
+        for table, column in RCPL_LOOKUP_INDEXES:
+            ensure_index(db_conn, table, column)
+        db_conn.execute("COMMIT")
+        common_args.getLogger().info(f"Created indexes in {time.time()-tIndex:.1f}s")
+    except (Error, OSError, EOFError, lzma.LZMAError, ValueError) as e:
+        common_args.getLogger().error(f"Unable to apply the RCPL dumps to {db_file}: {e}")
+        if db_conn.in_transaction:
+            db_conn.execute("ROLLBACK")
+        return False
+    finally:
+        db_conn.close()
+
+    elapsed = time.time() - tLoad
+    common_args.getLogger().info(f"Loaded {rows} rows in {elapsed:.1f}s ({rows/max(elapsed, 1e-6):.0f} rows/s)")
+    return True
+
+
+def update_ip_database(db_file, sqlite_db_files, rebuild, common_args):
+    """Bring the cached IP database up to the newest RCPL dump.
+
+    Only the dumps newer than the level recorded in .last_rcpl are applied to
+    the existing database. It is built from rcpl-0001 onward when it does not
+    exist yet, when its level is unknown or when rebuild is set; a rebuild
+    goes to a scratch file that only replaces db_file once it is complete. On
+    failure db_file and .last_rcpl are left untouched.
+    """
+    db_dir = os.path.dirname(db_file)
+    last_rcpl_file = f"{db_dir}/.last_rcpl"
+    os.makedirs(db_dir, exist_ok=True)
+
+    rcpl = 0
+    if os.path.exists(last_rcpl_file) and os.path.exists(db_file):
+        with open(last_rcpl_file, "r") as rcpl_fp:
+            rcpl = int(rcpl_fp.readline())
+    if rebuild:
+        rcpl = 0
+
+    dump_files = rcpl_dump_files(sqlite_db_files, rcpl + 1)
+    if not dump_files:
+        common_args.getLogger().info(f"{db_file} is current for RCPL {rcpl:04}")
+        return True
+
+    if rcpl == 0:
+        common_args.getLogger().info(f"Building {db_file} from {', '.join(os.path.basename(d) for r, d in dump_files)}")
+        build_file = f"{db_file}.new"
+        if os.path.exists(build_file):
+            os.remove(build_file)
+        if not apply_rcpl_dumps(build_file, dump_files, "OFF", common_args):
+            if os.path.exists(build_file):
+                os.remove(build_file)
+            return False
+        os.replace(build_file, db_file)
+        common_args.getLogger().info("Database has been recreated.")
+    else:
+        common_args.getLogger().info(f"Updating {db_file} from RCPL {rcpl:04} with {', '.join(os.path.basename(d) for r, d in dump_files)}")
+        if not apply_rcpl_dumps(db_file, dump_files, "DELETE", common_args):
+            return False
+        common_args.getLogger().info("Database has been updated.")
+
+    with open(last_rcpl_file, "w") as rcpl_fp:
+        rcpl_fp.writelines(f"{dump_files[-1][0]:04}\n")
+    return True
+
+
+@contextlib.contextmanager
+def zstd_reader(filename):
+    """Decompressed stream of a zstd file. Uses the zstd support of the
+    standard library or the zstandard module when available and a zstd
+    process otherwise."""
+    try:
+        from compression import zstd
+        with zstd.open(filename, "rb") as reader:
+            yield reader
+        return
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+        with open(filename, "rb") as fp, zstandard.ZstdDecompressor().stream_reader(fp) as reader:
+            yield reader
+        return
+    except ImportError:
+        pass
+
+    proc = subprocess.Popen(["zstd", "--decompress", "--stdout", "--quiet", "--", filename], stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+        # Drain the stream so a zstd error is not mistaken for a broken pipe
+        while proc.stdout.read(1 << 16):
+            pass
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise OSError(f"zstd failed to decompress {filename} ({returncode})")
+
+
+class SpdxArchive:
+    """The documents of an image's .spdx.tar.zst, read in one streaming pass
+    without extracting anything to disk. index.json and the image document are
+    always loaded, the package and recipe documents only with keep_documents,
+    for deploy directories that do not have DEPLOY_DIR_SPDX."""
+    def __init__(self, filename, image_pattern, keep_documents=False):
+        self._filename = filename
+        self._index_json = None
+        self._image_json = None
+        # member name: (fingerprint, document bytes)
+        self._documents = {}
+
+        with zstd_reader(filename) as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = os.path.basename(member.name)
+                if name == "index.json":
+                    self._index_json = json.load(tar.extractfile(member))
+                elif self._image_json is None and fnmatch.fnmatchcase(name, image_pattern):
+                    self._image_json = json.load(tar.extractfile(member))
+                elif keep_documents and name.endswith(".spdx.json"):
+                    self._documents[name] = (f"{member.size}:{member.mtime}", tar.extractfile(member).read())
+
+    def getIndex(self):
+        return self._index_json
+
+    def getImage(self):
+        return self._image_json
+
+    def getDocument(self, filename):
+        entry = self._documents.get(filename)
+        return entry[1] if entry else None
+
+    def getFingerprint(self, filename):
+        entry = self._documents.get(filename)
+        return f"{self._filename}:{entry[0]}" if entry else None
+
+
+# SpdxArchive of the image being parsed, serves package and recipe documents
+# that are not in DEPLOY_DIR_SPDX
+spdx_archive = None
+
+
+def load_spdx_document(deploy_dir_spdx, subdir, filename):
+    """Load a package or recipe document from DEPLOY_DIR_SPDX/subdir, or from
+    the image's SPDX archive when it is not there."""
+    path = f"{deploy_dir_spdx}/{subdir}/{filename}"
+    document = spdx_archive.getDocument(filename) if spdx_archive and not os.path.exists(path) else None
+    if document is None:
+        with open(path) as fp:
+            return json.load(fp)
+    return json.loads(document)
+
+
+def spdx_document_exists(deploy_dir_spdx, subdir, filename):
+    path = f"{deploy_dir_spdx}/{subdir}/{filename}"
+    return os.path.exists(path) or bool(spdx_archive and spdx_archive.getDocument(filename) is not None)
+
+
+def spdx_document_fingerprint(deploy_dir_spdx, subdir, filename):
+    path = f"{deploy_dir_spdx}/{subdir}/{filename}"
+    if not os.path.exists(path) and spdx_archive and spdx_archive.getFingerprint(filename):
+        return spdx_archive.getFingerprint(filename)
+    return file_fingerprint(path)
+
+
+def spdx_document_size(deploy_dir_spdx, subdir, filename):
+    path = f"{deploy_dir_spdx}/{subdir}/{filename}"
+    if not os.path.exists(path) and spdx_archive and spdx_archive.getDocument(filename) is not None:
+        return len(spdx_archive.getDocument(filename))
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def annotation_date():
+    return datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
 def create_annotation(ref, note):
 
-    creation_time = datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-    annotation = "Annotator: Tool: lxsbomtool - 1.0\n"
+    creation_time = annotation_date()
+    annotation = f"Annotator: Tool: lxsbomtool - {TOOL_VERSION}\n"
     annotation = f"{annotation}AnnotationDate: {creation_time}\n"
     annotation = f"{annotation}AnnotationType: OTHER\n"
     annotation = f"{annotation}SPDXREF: {ref}\n"
@@ -105,114 +927,237 @@ def create_annotation(ref, note):
     return annotation
 
 
-def write_license_copyright(sha, sbom_fp, spdx_id, db_conn, common_args):
-    cur = db_conn.cursor()
-    cur.execute(f"SELECT * FROM File WHERE FileChecksum='{sha}'")
-    rows = cur.fetchall()
+# =================================================================
+# License expressions
+#
+# The IP database stores ';' separated lists of SPDX license expressions.
+# The same few hundred lists repeat for most of the files of an image, so
+# they are split once and the results memoized.
+
+LICENSE_OPERATORS = re.compile(r"\sAND\s|\sOR\s|\sWITH\s")
 
-    license     = ""
-    copyright   = ""
 
+class OrderedSet:
+    """Set that keeps the order items were first added in, with the list
+    methods the LicenseRef tracking uses."""
+    __slots__ = ('_items',)
+
+    def __init__(self, items=()):
+        self._items = dict.fromkeys(items)
+
+    def append(self, item):
+        self._items[item] = None
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+
+@functools.lru_cache(maxsize=4096)
+def license_list(licenses):
+    """The licenses of a ';' separated list"""
+    return tuple(lic.strip() for lic in licenses.split(';'))
+
+
+@functools.lru_cache(maxsize=4096)
+def license_tokens(licenses):
+    """The license identifiers of a ';' separated list of license expressions,
+    in order"""
+    return tuple(r.strip() for lic in licenses.split(';') for r in LICENSE_OPERATORS.split(lic))
+
+
+@functools.lru_cache(maxsize=4096)
+def license_refs_in(licenses):
+    """The LicenseRefs used by a ';' separated list of license expressions,
+    in the order they are first used"""
+    return tuple(dict.fromkeys(token for token in license_tokens(licenses) if "LicenseRef" in token))
+
+
+def extract_license_copyright(rows):
+    """Returns the LicenseRefs used by the licenses of a source file's IP
+    database rows and its license_copyright_buffer entry, None without rows.
+    Like write_license_copyright, only the first row is used."""
+    for row in rows:
+        license_refs = list(dict.fromkeys(license_refs_in(row[2]) + license_refs_in(row[3])))
+        return license_refs, {
+            'licenseInfoInFiles': license_tokens(row[3])[-1],
+            'copyrightText': row[4].rstrip('\r\n')
+        }
+    return [], None
+
+
+def add_license_copyright(license_refs, buffer_entry, spdx_id, common_args):
+    """Record the IP data of a source file for the package being parsed: the
+    LicenseRefs its licenses use, and its license and copyright entry in the
+    license_copyright_buffer that packaged files are collated from."""
+    refs = common_args.getLicenseRefs()
+    for license in license_refs:
+        if license not in refs:
+            refs.append(license)
+
+    # Write Packaged File's LicenseInfo and CopyRight Texts to centeral buffer
+    if buffer_entry is not None:
+        common_args.getLicenseCopyrightBuffer().setdefault(spdx_id, []).append(dict(buffer_entry))
+
+
+def collect_license_copyright(rows, spdx_id, common_args):
+    add_license_copyright(*extract_license_copyright(rows), spdx_id, common_args)
+
+
+def write_license_copyright(rows, sbom_fp):
     for row in rows:
         sbom_fp.write(f"FileType: {row[1]}\n")
-        for lic in row[2].split(';'):
-            sbom_fp.write(f"LicenseConcluded: {lic.lstrip().strip()}\n")
-            license = f"LicenseConcluded: {lic.lstrip().strip()}\n"
-            for r in re.split(r"\sAND\s|\sOR\s|\sWITH\s", lic):
-                license = r.lstrip().strip()
-                if "LicenseRef" in license and license not in common_args.getLicenseRefs():
-                    common_args.getLicenseRefs().append(license)
-
-        for lic in row[3].split(';'):
-            sbom_fp.write(f"LicenseInfoInFile: {lic.lstrip().strip()}\n")
-            for r in re.split(r"\sAND\s|\sOR\s|\sWITH\s", lic):
-                license = r.lstrip().strip()
-                if "LicenseRef" in license and license not in common_args.getLicenseRefs():
-                    common_args.getLicenseRefs().append(license)
+        for lic in license_list(row[2]):
+            sbom_fp.write(f"LicenseConcluded: {lic}\n")
+
+        for lic in license_list(row[3]):
+            sbom_fp.write(f"LicenseInfoInFile: {lic}\n")
 
         copyright = row[4].rstrip('\r\n')
         sbom_fp.write(f"FileCopyrightText: <text> {copyright} </text>\n")
-        copyright = f"{copyright}"
+        return True
+    return False
 
-        # Write Packaged File's LicenseInfo and CopyRight Texts to centeral buffer
-        # print(spdx_id)
-        try:
-            curr = common_args.getLicenseCopyrightBuffer()[spdx_id]
-            curr.append(
-                {
-                    'licenseInfoInFiles': license,
-                    'copyrightText': copyright
-                }
-            )
-            common_args.getLicenseCopyrightBuffer()[spdx_id] = curr
 
-        except KeyError:
-            common_args.getLicenseCopyrightBuffer()[spdx_id] = [
-                {
-                    'licenseInfoInFiles': license,
-                    'copyrightText': copyright
-                }
-            ]
+class LicenseReferenceLookup:
+    """LicenseID to LicenseReference row map for the IP database, shared by
+    all packages of a run.
 
-        return True
-    return False
+    Rows are loaded in bulk with chunked, parameterized IN (...) queries, only
+    for LicenseRefs that have not been looked up yet, and the rendered
+    license information section of each LicenseRef is kept for each output
+    format. Missing LicenseRefs are remembered too, but their annotation is
+    rendered each time so it carries the current date.
+    """
+    CHUNK_SIZE = FileChecksumLookup.CHUNK_SIZE
+
+    def __init__(self):
+        self._rows = {}
+        self._rendered = {}
+        self._query_count = 0
+
+    def preload(self, db_conn, license_refs):
+        # CREATE TABLE LicenseReference (LicenseID TEXT NOT NULL PRIMARY KEY, ExtractedText TEXT NOT NULL, LicenseName TEXT NOT NULL DEFAULT 'NOASSERTION', LicenseCrossReference TEXT, LicenseComment TEXT);
+        pending = [licid for licid in dict.fromkeys(license_refs) if licid not in self._rows]
+        cur = db_conn.cursor()
+        for i in range(0, len(pending), self.CHUNK_SIZE):
+            chunk = pending[i:i + self.CHUNK_SIZE]
+            for licid in chunk:
+                self._rows[licid] = None
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(f"SELECT * FROM LicenseReference WHERE LicenseID IN ({placeholders})", chunk)
+            self._query_count += 1
+            for row in cur.fetchall():
+                self._rows[row[0]] = row
+
+    def getEntries(self, db_conn, license_refs):
+        """Returns (LicenseID, LicenseReference row) for each LicenseRef, the
+        row is None for LicenseRefs that are not in the IP database."""
+        self.preload(db_conn, license_refs)
+        return [(licid, self._rows[licid]) for licid in license_refs]
+
+    def getRendered(self, writer, db_conn, license_refs):
+        """Returns the license information sections of license_refs for writer"""
+        rendered = []
+        for licid, row in self.getEntries(db_conn, license_refs):
+            if row is None:
+                rendered.append(writer.renderLicenseRef(licid, row))
+                continue
+            key = (writer.extension, licid)
+            text = self._rendered.get(key)
+            if text is None:
+                text = self._rendered[key] = writer.renderLicenseRef(licid, row)
+            rendered.append(text)
+        return rendered
 
+    def getCounts(self):
+        return (self._query_count,)
 
-def write_licenserefs(sbom_fp, db_conn, args_time, common_args):
-    tRef = time.time()
-    # CREATE TABLE LicenseReference (LicenseID TEXT NOT NULL PRIMARY KEY, ExtractedText TEXT NOT NULL, LicenseName TEXT NOT NULL DEFAULT 'NOASSERTION', LicenseCrossReference TEXT, LicenseComment TEXT);
+    def addCounts(self, query_count):
+        """Fold in the counters of a worker process"""
+        self._query_count += query_count
+
+
+def lookup_licenserefs(db_conn, license_refs):
+    """Returns (LicenseID, LicenseReference row) for each LicenseRef, the row
+    is None for LicenseRefs that are not in the IP database."""
+    return LicenseReferenceLookup().getEntries(db_conn, license_refs)
+
+
+def write_licenseref_header(sbom_fp):
     sbom_fp.write("\n\n##-----------------------------\n## Other License Information\n##-----------------------------\n")
-    cur = db_conn.cursor()
-    for licid in common_args.getLicenseRefs():
-        cur.execute(f"SELECT * FROM LicenseReference WHERE LicenseID='{licid}'")
-        rows = cur.fetchall()
-        for row in rows:
-            sbom_fp.write("\n\n## -------------------- License Information --------------------##\n")
-            sbom_fp.write(f"LicenseID: {row[0]}\n")
-            sbom_fp.write(f"ExtractedText: <text> {row[1]} </text>\n")
-            sbom_fp.write(f"LicenseName: {row[2]}\n")
-            sbom_fp.write(f"LicenseComment: <text> {row[4]} </text>\n")
-            break
-        else:
-            sbom_fp.write("\n\n## -----------------Missing License Information ----------------##\n")
-            sbom_fp.write(f"{create_annotation(licid, 'LicenseRef Data not available')}")
+
+
+def write_licenseref_entry(sbom_fp, licid, row):
+    if row is not None:
+        sbom_fp.write("\n\n## -------------------- License Information --------------------##\n")
+        sbom_fp.write(f"LicenseID: {row[0]}\n")
+        sbom_fp.write(f"ExtractedText: <text> {row[1]} </text>\n")
+        sbom_fp.write(f"LicenseName: {row[2]}\n")
+        sbom_fp.write(f"LicenseComment: <text> {row[4]} </text>\n")
+    else:
+        sbom_fp.write("\n\n## -----------------Missing License Information ----------------##\n")
+        sbom_fp.write(f"{create_annotation(licid, 'LicenseRef Data not available')}")
+
+
+def write_licenseref_entries(sbom_fp, entries):
+    write_licenseref_header(sbom_fp)
+    for licid, row in entries:
+        write_licenseref_entry(sbom_fp, licid, row)
+
+
+def write_license_information(writer, db_conn, license_refs, common_args):
+    """Write the license information section for license_refs through one of
+    the OUTPUT_FORMATS writers"""
+    lookup = common_args.getLicenseReferenceLookup()
+    if lookup is not None:
+        writer.writeRenderedLicenseRefs(lookup.getRendered(writer, db_conn, license_refs))
+    else:
+        writer.writeLicenseRefs(lookup_licenserefs(db_conn, license_refs))
+
+
+def write_licenserefs(sbom_fp, db_conn, args_time, common_args, license_refs=None):
+    tRef = time.time()
+    if license_refs is None:
+        license_refs = common_args.getLicenseRefs()
+    write_license_information(TagValueWriter(sbom_fp), db_conn, license_refs, common_args)
 
     common_args.getLicenseRefs().clear()
     logTimedEvent("write_licenserefs", tRef, args_time, common_args)
 
 
-def map_json_from_document_ref(image_json, document_ref, index_json):
-    """Starting with a document_ref like DocumentRef-openssh-ssh:SPDXRef-Package-openssh-ssh
-    go to the image spdx and lookup the externalDocumentID.
+def make_namespace_dict(index_json):
+    """Map each documentNamespace in the index to its filename, the first entry
+    wins."""
+    namespace_dict = {}
+    for index in index_json['documents']:
+        namespace_dict.setdefault(index['documentNamespace'], index['filename'])
+    return namespace_dict
 
-    Associated with the externalDocumentID is a spdxDocument that is a URI like
-    http://spdx.org/spdxdoc/openssh-scp-74c472b3-ad97-5922-b560-b90a39142fb6
 
-    Then use this URI to lookup in the image index file, to find the actual
-    file name that contains the spdx info for the original document.
+def make_document_ref_dict(image_json, index_json, namespace_dict=None):
+    """Map each externalDocumentId of the image to the filename of the
+    document it refers to, the first entry wins. Run this once to look up
+    the filename in constant time for every package.
     """
-    doc_ref, spdx_ref = re.split('[:]', document_ref)
-    for docs in image_json:
-        if doc_ref == docs['externalDocumentId']:
-            for index in index_json['documents']:
-                if docs['spdxDocument'] == index['documentNamespace']:
-                    return index['filename'], spdx_ref
-
+    if namespace_dict is None:
+        namespace_dict = make_namespace_dict(index_json)
 
-def make_document_ref_dict(image_json, index_json):
-    """A potentially faster alternative to the map_json_from_document_ref function.
-    Run this once to get the dictionary and then use that to look up the filename
-    in constant time rather than the loop every time.
-    """
     docref_dict = {}
     for docs in image_json:
         key = docs['externalDocumentId']
         if key in docref_dict:
             continue
-        for index in index_json['documents']:
-            if docs['spdxDocument'] == index['documentNamespace']:
-                docref_dict[key] = index['filename']
-                break
+        if docs['spdxDocument'] in namespace_dict:
+            docref_dict[key] = namespace_dict[docs['spdxDocument']]
     return docref_dict
 
 
@@ -233,7 +1178,7 @@ def write_document_header(fp, name):
     fp.write("SPDXID: SPDXRef-DOCUMENT\n")
     fp.write(f"DocumentName: {name}\n")
     fp.write("DocumentNamespace: http://spdx.windriver.com/Reports/2.2/<ID>\n")
-    fp.write("DocumentComment: <text> This document is provided \"AS IS\" without any warranty, express or implied, including, but not limited to the Warranties of Merchantability, Fitness for a Particular Purpose, title and Non-Infringement. Wind River assumes no responsibility or liability for any errors or inaccuracies with respect to the information contained in it. Wind River may change the contents of this document at any time at its sole discretion, and Wind River shall have no liability whatsoever arising from recipient's use of this information. This file contains only computer generated SPDX data derived from computer automation.  Any legal obligations based on the content of this document should come from independent legal analysis and by reference to the notices and licenses contained within the open-source code itself. </text>\n")
+    fp.write(f"DocumentComment: <text> {DOCUMENT_COMMENT} </text>\n")
 
 
 def write_creation_info(fp, pkg_json):
@@ -245,7 +1190,7 @@ def write_creation_info(fp, pkg_json):
     fp.write(f"LicenseListVersion: {pkg_json['creationInfo']['licenseListVersion']}\n")
 
 
-def write_pkg_spdx(pkg, relationship, sbom_fp, common_args):
+def write_pkg_spdx(pkg, relationship, sbom_fp):
     sbom_fp.write("\n\n##-------------------------\n")
     sbom_fp.write("## Package Information\n")
     sbom_fp.write("##-------------------------\n")
@@ -270,30 +1215,25 @@ def write_pkg_spdx(pkg, relationship, sbom_fp, common_args):
     sbom_fp.write(f"Relationship: SPDXRef-DOCUMENT {relationship['relationshipType']} {relationship['relatedSpdxElement'].split(':')[-1]}\n")
     sbom_fp.write("\n\n##-------------------------\n## File Information\n##-------------------------\n")
 
+
+def collect_package_licenses(pkg, common_args):
     # Load license and copyright data into lookup table
     spdx_id = pkg['SPDXID']
     for file_license in pkg['licenseInfoFromFiles']:
-        try:
-            curr = common_args.getLicenseCopyrightBuffer()[spdx_id]
-            curr.append(
-                {
-                    'licenseInfoInFiles': file_license,
-                    'copyrightText': "NOASSERTION"
-                }
-            )
-            common_args.getLicenseCopyrightBuffer()[spdx_id] = curr
-        except KeyError:
-            common_args.getLicenseCopyrightBuffer()[spdx_id] = [
-                {
-                    'licenseInfoInFiles': file_license,
-                    'copyrightText': "NOASSERTION"
-                }
-            ]
+        common_args.getLicenseCopyrightBuffer().setdefault(spdx_id, []).append(
+            {
+                'licenseInfoInFiles': file_license,
+                'copyrightText': "NOASSERTION"
+            }
+        )
 
 
-def write_file_spdx(file_data, sbom_fp, db_conn, args_time, common_args, packaged=False):
-    t = time.time()
+def source_file_checksum(file_data):
+    """Returns the checksum a source file is keyed on in the IP database"""
+    return f"{file_data['checksums'][1]['algorithm']}:{file_data['checksums'][1]['checksumValue']}"
 
+
+def write_file_spdx(file_data, rows, sbom_fp, packaged=False):
     if packaged:
         sbom_fp.write("\n\n## ------------------- Packaged File ------------------\n##\n")
         sbom_fp.write(f"FileName: {file_data['fileName']}\n")
@@ -306,8 +1246,7 @@ def write_file_spdx(file_data, sbom_fp, db_conn, args_time, common_args, package
         sbom_fp.write(f"FileChecksum: {file_data['checksums'][0]['algorithm']}:{file_data['checksums'][0]['checksumValue']}\n")
         sbom_fp.write(f"FileChecksum: {file_data['checksums'][1]['algorithm']}:{file_data['checksums'][1]['checksumValue']}\n")
 
-        spdx_id = file_data['SPDXID']
-        if not write_license_copyright(f"{file_data['checksums'][1]['algorithm']}:{file_data['checksums'][1]['checksumValue']}", sbom_fp, spdx_id, db_conn, common_args):
+        if not write_license_copyright(rows, sbom_fp):
             for file_type in file_data['fileTypes']:
                 sbom_fp.write(f"FileType: {file_type}\n")
             sbom_fp.write(f"LicenseConcluded: {file_data['licenseConcluded']}\n")
@@ -318,29 +1257,14 @@ def write_file_spdx(file_data, sbom_fp, db_conn, args_time, common_args, package
 
             # Add the annotation only for Source files since thats what's in the DB
             if 'BINARY' not in file_data['fileTypes']:
-                comment = f"No IP Data for {file_data['fileName']} in {file_data['SPDXID']}"
-                sbom_fp.write(f"{create_annotation(file_data['SPDXID'], comment)}")
-
-    logTimedEvent("write_file_spdx", t, args_time, common_args)
+                sbom_fp.write(f"{create_annotation(file_data['SPDXID'], missing_ip_data_note(file_data))}")
 
 
-def collate_license_and_copyright(file_data, sbom_fp, license_copyright_buffer=None, relationship_tables=None):
+def collate_license_and_copyright(file_data, license_copyright_buffer=None, relationship_tables=None):
     '''
     Function responsible for collating LicenseInfoInFile & Copyright up to Binary and Package level based on relationships.
+    Returns the (licenses, copyrights) lists for the packaged file.
     '''
-    if "PackagedFile" in file_data['SPDXID']:
-        sbom_fp.write(f"\n\n## ------------------- Packaged File ------------------\n##\n")
-    else:
-        return
-
-    # Write basic packaged file info to output file
-    sbom_fp.write(f"FileName: {file_data['fileName']}\n")
-    sbom_fp.write(f"SPDXID: {file_data['SPDXID']}\n")
-    sbom_fp.write(f"FileChecksum: {file_data['checksums'][0]['algorithm']}:{file_data['checksums'][0]['checksumValue']}\n")
-    sbom_fp.write(f"FileChecksum: {file_data['checksums'][1]['algorithm']}:{file_data['checksums'][1]['checksumValue']}\n")
-    for file_type in file_data['fileTypes']:
-        sbom_fp.write(f"FileType: {file_type}\n")
-
     spdx_id             = file_data['SPDXID']
     rela_table_from     = relationship_tables[0]
     rela_table_contain  = relationship_tables[1]
@@ -397,12 +1321,39 @@ def collate_license_and_copyright(file_data, sbom_fp, license_copyright_buffer=N
         copyrights.append("NOASSERTION")
         licenses.append("NOASSERTION")
 
+    return licenses, copyrights
+
+
+def missing_ip_data_note(file_data):
+    return f"No IP Data for {file_data['fileName']} in {file_data['SPDXID']}"
+
+
+def collated_license_concluded(licenses):
+    # A single license is concluded, NOASSERTION for a mix of licenses
+    if len(list(set(licenses))) == 1:
+        return licenses[0]
+    return "NOASSERTION"
+
+
+def collated_copyrights(copyrights):
+    return [file_cr for file_cr in list(set(copyrights))
+            if not (file_cr == "<text> NOASSERTION </text>" and "NOASSERTION" in set(copyrights))]
+
+
+def write_packaged_file_spdx(file_data, licenses, copyrights, sbom_fp):
+    sbom_fp.write(f"\n\n## ------------------- Packaged File ------------------\n##\n")
+
+    # Write basic packaged file info to output file
+    sbom_fp.write(f"FileName: {file_data['fileName']}\n")
+    sbom_fp.write(f"SPDXID: {file_data['SPDXID']}\n")
+    sbom_fp.write(f"FileChecksum: {file_data['checksums'][0]['algorithm']}:{file_data['checksums'][0]['checksumValue']}\n")
+    sbom_fp.write(f"FileChecksum: {file_data['checksums'][1]['algorithm']}:{file_data['checksums'][1]['checksumValue']}\n")
+    for file_type in file_data['fileTypes']:
+        sbom_fp.write(f"FileType: {file_type}\n")
+
     # =================================================================
     # Set LicenseConcluded
-    if len(list(set(licenses))) == 1:
-        sbom_fp.write(f"LicenseConcluded: {licenses[0]}\n")
-    else:
-        sbom_fp.write(f"LicenseConcluded: NOASSERTION\n")
+    sbom_fp.write(f"LicenseConcluded: {collated_license_concluded(licenses)}\n")
 
     # Write Licenses Info file
     for file_license in list(set(licenses)):
@@ -410,44 +1361,30 @@ def collate_license_and_copyright(file_data, sbom_fp, license_copyright_buffer=N
 
     # Write Copyright Text to file
     sbom_fp.write(f"FileCopyrightText: <text>\n")
-    for file_cr in list(set(copyrights)):
-        if file_cr == "<text> NOASSERTION </text>" and "NOASSERTION" in set(copyrights):
-            continue
+    for file_cr in collated_copyrights(copyrights):
         sbom_fp.write(f"{file_cr}\n")
     sbom_fp.write(f"</text>\n")
 
 
-def find_source_hash(json_stanza, relationship, pkg_name, sbom_fp, db_conn, args_time, index_json, deploy_dir_spdx, common_args):
-    spdx_id = relationship['relatedSpdxElement']
-    if "NOASSERTION" in spdx_id:
-        return False
-
-    recipe_name, spdx_ref = map_json_from_document_ref(json_stanza['externalDocumentRefs'], spdx_id, index_json)
-    if spdx_id.split(':')[1] in common_args.getSourceFileLookup():
+def resolve_source_file(doc_index, spdx_id, args_time, deploy_dir_spdx, common_args):
+    """Returns the recipe file entry for a DocumentRef-...:SPDXRef-... source
+    file reference, loading the recipe document if it has not been seen yet.
+    """
+    doc_ref, _, spdx_ref = spdx_id.partition(':')
+    if spdx_ref in common_args.getSourceFileLookup():
         common_args.getLogger().debug("File already looked up, using cached data")
-        write_file_spdx(common_args.getSourceFileLookup()[spdx_id.split(":")[1]], sbom_fp, db_conn, args_time, common_args)
-        return True
+        return common_args.getSourceFileLookup()[spdx_ref]
 
-    # Load recipe file, from file or lookup dictionary if possible
-    recipe_json = {}
-    if recipe_name in common_args.getRecipeFileLookup():
-        common_args.getLogger().debug('Recipe already looked up, using cached data')
-        recipe_json = common_args.getRecipeFileLookup()[recipe_name]
-    else:
-        with open(f"{deploy_dir_spdx}/recipes/{recipe_name}") as fp:
-            common_args.getLogger().debug(f"Recipe Name {recipe_name}")
-            tRec = time.time()
-            recipe_json = json.load(fp)
-            common_args.getRecipeFileLookup()[recipe_name] = recipe_json
-            logTimedEvent("load recipe JSON", tRec, args_time, common_args)
-
-    # Write source file entry from recipe
-    for src_file in recipe_json['files']:
-        if src_file['SPDXID'] == spdx_id.split(':')[1]:
-            common_args.getSourceFileLookup()[spdx_id.split(':')[1]] = src_file
-            write_file_spdx(src_file, sbom_fp, db_conn, args_time, common_args)
-            break
-    return True
+    recipe_name = doc_index.getDocumentFilename(doc_ref)
+    if recipe_name is None:
+        raise KeyError(f"No document in the index for {doc_ref}")
+
+    # Load recipe file, from file or the recipe cache if possible
+    recipe_files = common_args.getRecipeFileLookup().getFiles(recipe_name, deploy_dir_spdx, args_time, common_args)
+    src_file = recipe_files.get(spdx_ref)
+    if src_file is not None:
+        common_args.getSourceFileLookup()[spdx_ref] = src_file
+    return src_file
 
 
 def write_package_relationships(relationships, sbom_fp):
@@ -467,16 +1404,361 @@ def write_package_relationships(relationships, sbom_fp):
         sbom_fp.write(rel)
 
 
-def parse_package(pkg_json, pkg, pkg_relationship, sbom_fp, db_conn, args_time, index_json, deploy_dir_spdx, common_args):
+class TagValueWriter:
+    """SPDX 2.2 tag-value output, the default --format"""
+    extension = "spdx"
+
+    def __init__(self, sbom_fp):
+        self._fp = sbom_fp
+
+    def writeDocumentHeader(self, name):
+        write_document_header(self._fp, name)
+
+    def writeCreationInfo(self, doc_json):
+        write_creation_info(self._fp, doc_json)
+
+    def writePackage(self, pkg, relationship):
+        write_pkg_spdx(pkg, relationship, self._fp)
+
+    def writePackagedFile(self, file_data, licenses, copyrights):
+        write_packaged_file_spdx(file_data, licenses, copyrights, self._fp)
+
+    def writeSourceFile(self, file_data, rows):
+        write_file_spdx(file_data, rows, self._fp)
+
+    def renderSourceFile(self, file_data, rows):
+        block = io.StringIO()
+        write_file_spdx(file_data, rows, block)
+        return block.getvalue()
+
+    def writeRenderedSourceFile(self, text):
+        self._fp.write(text)
+
+    def writeRelationships(self, relationships):
+        write_package_relationships(relationships, self._fp)
+
+    def writeLicenseRefs(self, entries):
+        write_licenseref_entries(self._fp, entries)
+
+    def renderLicenseRef(self, licid, row):
+        entry = io.StringIO()
+        write_licenseref_entry(entry, licid, row)
+        return entry.getvalue()
+
+    def writeRenderedLicenseRefs(self, texts):
+        write_licenseref_header(self._fp)
+        for text in texts:
+            self._fp.write(text)
+
+    def close(self):
+        pass
+
+
+class JsonWriter:
+    """SPDX 2.2 JSON output. Files are streamed into the document as they are
+    written, packages, relationships and license information are spooled to
+    temporary files and appended when the document is closed, so memory use
+    stays flat with --aggregate."""
+    extension = "spdx.json"
+    SPOOL_SIZE = 1 << 22
+    SECTIONS = ('packages', 'relationships', 'hasExtractedLicensingInfos')
+
+    def __init__(self, sbom_fp):
+        self._fp = sbom_fp
+        self._started = False
+        self._files = 0
+        self._sections = {section: [tempfile.SpooledTemporaryFile(self.SPOOL_SIZE, mode="w+"), 0] for section in self.SECTIONS}
+
+    def _key(self, key):
+        self._fp.write("{" if not self._started else ",\n")
+        self._started = True
+        self._fp.write(f"{json.dumps(key)}: ")
+
+    def _field(self, key, value):
+        self._key(key)
+        json.dump(value, self._fp)
+
+    def _append(self, section, obj):
+        self._appendText(section, json.dumps(obj))
+
+    def _appendText(self, section, text):
+        spool = self._sections[section]
+        if spool[1]:
+            spool[0].write(",\n")
+        spool[0].write(text)
+        spool[1] += 1
+
+    def _writeFile(self, obj):
+        self.writeRenderedSourceFile(json.dumps(obj))
+
+    def writeRenderedSourceFile(self, text):
+        if self._files:
+            self._fp.write(",\n")
+        else:
+            self._key("files")
+            self._fp.write("[")
+        self._fp.write(text)
+        self._files += 1
+
+    @staticmethod
+    def _checksums(file_data):
+        return [{ 'algorithm': c['algorithm'], 'checksumValue': c['checksumValue'] } for c in file_data['checksums'][:2]]
+
+    def writeDocumentHeader(self, name):
+        self._field("spdxVersion", "SPDX-2.2")
+        self._field("dataLicense", "CC0-1.0")
+        self._field("SPDXID", "SPDXRef-DOCUMENT")
+        self._field("name", name)
+        self._field("documentNamespace", "http://spdx.windriver.com/Reports/2.2/<ID>")
+        self._field("comment", DOCUMENT_COMMENT)
+
+    def writeCreationInfo(self, doc_json):
+        self._field("creationInfo", {
+            'creators': ["Tool: lxsbomtool"],
+            'created': f"{datetime.now().isoformat(timespec='seconds')}Z",
+            'licenseListVersion': doc_json['creationInfo']['licenseListVersion'],
+        })
+
+    def writePackage(self, pkg, relationship):
+        package = {
+            'name': f"{pkg['name']}-{pkg['versionInfo']}",
+            'SPDXID': pkg['SPDXID'],
+            'downloadLocation': "NOASSERTION",
+            'filesAnalyzed': 'hasFiles' in pkg,
+        }
+        if 'hasFiles' in pkg:
+            package['packageVerificationCode'] = { 'packageVerificationCodeValue': pkg['packageVerificationCode']['packageVerificationCodeValue'] }
+        package.update(
+            licenseConcluded=pkg['licenseConcluded'],
+            licenseDeclared=pkg['licenseDeclared'].split(':')[-1],
+            licenseInfoFromFiles=list(pkg['licenseInfoFromFiles']),
+            copyrightText="NOASSERTION",
+            summary="Get from Recipe info",
+        )
+        self._append('packages', package)
+        self._append('relationships', {
+            'spdxElementId': "SPDXRef-DOCUMENT",
+            'relationshipType': relationship['relationshipType'],
+            'relatedSpdxElement': relationship['relatedSpdxElement'].split(':')[-1],
+        })
+
+    def writePackagedFile(self, file_data, licenses, copyrights):
+        self._writeFile({
+            'fileName': file_data['fileName'],
+            'SPDXID': file_data['SPDXID'],
+            'checksums': self._checksums(file_data),
+            'fileTypes': list(file_data['fileTypes']),
+            'licenseConcluded': collated_license_concluded(licenses),
+            'licenseInfoInFiles': list(set(licenses)),
+            'copyrightText': "\n".join(collated_copyrights(copyrights)),
+        })
+
+    def writeSourceFile(self, file_data, rows):
+        self._writeFile(self._sourceFile(file_data, rows))
+
+    def renderSourceFile(self, file_data, rows):
+        return json.dumps(self._sourceFile(file_data, rows))
+
+    def _sourceFile(self, file_data, rows):
+        source = {
+            'fileName': file_data['fileName'],
+            'SPDXID': file_data['SPDXID'],
+            'checksums': self._checksums(file_data),
+        }
+        for row in rows[:1]:
+            # Like the tag-value LicenseConcluded lines, each ; separated
+            # license of the IP database is concluded
+            concluded = license_list(row[2])
+            source.update(
+                fileTypes=[row[1]],
+                licenseConcluded=" AND ".join(f"({lic})" if " " in lic and len(concluded) > 1 else lic for lic in concluded),
+                licenseInfoInFiles=list(license_list(row[3])),
+                copyrightText=row[4].rstrip('\r\n'),
+            )
+            break
+        else:
+            source.update(
+                fileTypes=list(file_data['fileTypes']),
+                licenseConcluded=file_data['licenseConcluded'],
+                licenseInfoInFiles=list(file_data['licenseInfoInFiles']),
+                copyrightText=file_data['copyrightText'],
+            )
+            # Add the annotation only for Source files since thats what's in the DB
+            if 'BINARY' not in file_data['fileTypes']:
+                source['annotations'] = [{
+                    'annotator': f"Tool: lxsbomtool - {TOOL_VERSION}",
+                    'annotationDate': annotation_date(),
+                    'annotationType': "OTHER",
+                    'comment': missing_ip_data_note(file_data),
+                }]
+        return source
+
+    def writeRelationships(self, relationships):
+        # Remove duplicate relationships, keeping their order
+        for rel in dict.fromkeys(relationship_to_string(rel) for rel in relationships):
+            spdx_element_id, relationship_type, related_spdx_element = rel.split(' ')
+            self._append('relationships', {
+                'spdxElementId': spdx_element_id,
+                'relationshipType': relationship_type,
+                'relatedSpdxElement': related_spdx_element,
+            })
+
+    def writeLicenseRefs(self, entries):
+        self.writeRenderedLicenseRefs(self.renderLicenseRef(licid, row) for licid, row in entries)
+
+    def renderLicenseRef(self, licid, row):
+        if row is not None:
+            return json.dumps({
+                'licenseId': row[0],
+                'extractedText': row[1],
+                'name': row[2],
+                'comment': row[4],
+            })
+        return json.dumps({
+            'licenseId': licid,
+            'extractedText': "NOASSERTION",
+            'comment': "LicenseRef Data not available",
+        })
+
+    def writeRenderedLicenseRefs(self, texts):
+        for text in texts:
+            self._appendText('hasExtractedLicensingInfos', text)
+
+    def close(self):
+        if not self._files:
+            self._field("files", [])
+        else:
+            self._fp.write("]")
+        for section in self.SECTIONS:
+            spool, count = self._sections[section]
+            self._key(section)
+            self._fp.write("[")
+            spool.seek(0)
+            shutil.copyfileobj(spool, self._fp)
+            self._fp.write("]")
+            spool.close()
+        self._fp.write("}\n")
+
+
+# Output writers by --format
+OUTPUT_FORMATS = {
+    'tag-value': TagValueWriter,
+    'json': JsonWriter,
+}
+
+
+class PackageDocumentIndex:
+    """Lookup tables for a single package SPDX document.
+
+    Built once per document so that packaged files and their relationships can
+    be found by exact SPDXID instead of rescanning the 'files' and
+    'relationships' lists for every entry in 'hasFiles'. The document's
+    externalDocumentRefs are resolved to filenames through namespace_dict, see
+    make_namespace_dict.
+    """
+    def __init__(self, pkg_json, namespace_dict):
+        self._files = {}
+        self._relationships_from = {}
+        self._relationships_to = {}
+        self._docref_dict = make_document_ref_dict(pkg_json.get('externalDocumentRefs', []), None, namespace_dict)
+
+        for pkg_file in pkg_json.get('files', []):
+            self._files.setdefault(pkg_file['SPDXID'], pkg_file)
+
+        for relationship in pkg_json.get('relationships', []):
+            self._relationships_from.setdefault(relationship['spdxElementId'], []).append(relationship)
+            self._relationships_to.setdefault(relationship['relatedSpdxElement'], []).append(relationship)
+
+    def getFile(self, spdx_id):
+        return self._files.get(spdx_id)
+
+    def getRelationshipsFrom(self, spdx_id):
+        """Relationships where spdx_id is the spdxElementId ("parent")"""
+        return self._relationships_from.get(spdx_id, [])
+
+    def getRelationshipsTo(self, spdx_id):
+        """Relationships where spdx_id is the relatedSpdxElement ("child")"""
+        return self._relationships_to.get(spdx_id, [])
+
+    def getDocumentFilename(self, doc_ref):
+        """Filename of the document an externalDocumentId refers to"""
+        return self._docref_dict.get(doc_ref)
+
+
+def make_relationship_tables(relationships):
+    """Generate the two relationship lookup tables used for collation:
+        1. GENERATED_FROM, keyed on spdxElementId
+        2. CONTAINS, keyed on relatedSpdxElement
+    """
+    rela_table_from     = dict()
+    rela_table_contain  = dict()
+    for i in relationships:
+        if i['relationshipType'] == 'GENERATED_FROM':
+            rela_table_from.setdefault(i['spdxElementId'], []).append(i['relatedSpdxElement'])
+        elif i['relationshipType'] == 'CONTAINS':
+            rela_table_contain.setdefault(i['relatedSpdxElement'], []).append(i['spdxElementId'])
+    return rela_table_from, rela_table_contain
+
+
+class ResolvedSourceFile:
+    """A source file from a recipe document together with its IP database rows
+    and, when the SourceFileCache is used, its cache entry"""
+    __slots__ = ('file_data', 'rows', 'cached')
+
+    def __init__(self, file_data, rows, cached=None):
+        self.file_data = file_data
+        self.rows = rows
+        self.cached = cached
+
+
+class ResolvedPackagedFile:
+    """A packaged file, its collated licenses and copyrights and the source
+    files it is generated from. licenses and copyrights are None for files
+    that are not collated, sources holds None for references that do not
+    resolve to a source file."""
+    __slots__ = ('file_data', 'contained_by', 'licenses', 'copyrights', 'sources')
+
+    def __init__(self, file_data, contained_by, sources):
+        self.file_data = file_data
+        self.contained_by = contained_by
+        self.licenses = None
+        self.copyrights = None
+        self.sources = sources
+
+
+class ResolvedPackage:
+    """Everything that is written for one package document"""
+    __slots__ = ('spdx_pkg', 'relationship', 'packaged_files', 'relationships')
+
+    def __init__(self, spdx_pkg, relationship, packaged_files, relationships):
+        self.spdx_pkg = spdx_pkg
+        self.relationship = relationship
+        self.packaged_files = packaged_files
+        self.relationships = relationships
+
+
+def resolve_package(pkg_json, pkg, pkg_relationship, db_conn, args_time, deploy_dir_spdx, common_args):
+    """Resolve a package document into a ResolvedPackage: every source file is
+    looked up once, in the recipe store and (in bulk) in the IP database, the
+    license data is collected and the packaged files are collated."""
     master_parsed_rel_list = []
+    described_pkg = None
+
+    tIdx = time.time()
+    doc_index = PackageDocumentIndex(pkg_json, common_args.getDocumentNamespaces())
+    logTimedEvent("index package document", tIdx, args_time, common_args, "index")
 
     # I think each package spdx file will only contain a single package but
-    # multiple are possible
+    # multiple are possible. Only the package being described contributes
+    # relationships and is resolved first, it determines the order
+    # LicenseRefs are found in.
     for spdx_pkg in pkg_json['packages']:
 
         # Sanity check to ensure that the correct file has been loaded
         if pkg == spdx_pkg['SPDXID']:
-            write_pkg_spdx(spdx_pkg, pkg_relationship, sbom_fp, common_args)
+            if described_pkg is None:
+                described_pkg = spdx_pkg
+            collect_package_licenses(spdx_pkg, common_args)
 
             if 'hasFiles' not in spdx_pkg:
                 continue
@@ -485,89 +1767,285 @@ def parse_package(pkg_json, pkg, pkg_relationship, sbom_fp, db_conn, args_time,
             # this would be a collection of binary files but could also be
             # source files
             for pkged_file in spdx_pkg['hasFiles']:
+                pkg_file = doc_index.getFile(pkged_file)
+                if pkg_file is None:
+                    continue
 
-                # the files SPDXID is listed in the hasfiles section and
-                # defined in the files section. files is a list of maps so a
-                # loop is necessary
-                for pkg_file in pkg_json['files']:
-                    if pkged_file == pkg_file['SPDXID']:
-                        spdxElementId = pkg_file['SPDXID']
-
-                        # Find relationship for this file where it is a "child"
-                        for relationship in pkg_json['relationships']:
-                            if spdxElementId in relationship['relatedSpdxElement']:
-                                master_parsed_rel_list.append(relationship)
-                                break
-
-                        parsed_rel_list = [rel for rel in pkg_json['relationships'] if spdxElementId in rel['spdxElementId']]
-                        master_parsed_rel_list += parsed_rel_list
-
-                        # Find relationships for this file where it is a "parent"
-                        for relationship in parsed_rel_list:
-                            time_temp = time.time()
-
-                            # Loads source files' license and copyright data into the buffer lookup table (license_copyright_buffer).
-                            # Since no output needed from this call, the write file pointer redirects outputs to /dev/null.
-                            with open("/dev/null", "w") as wf_null:
-                                find_source_hash(pkg_json, relationship, spdx_pkg['name'], wf_null, db_conn, args_time, index_json, deploy_dir_spdx, common_args)
-                            logTimedEvent("find_source_hash on " + relationship["relatedSpdxElement"], time_temp, args_time, common_args)
-
-    # Generate two relationship lookup tables:
-    #   1. GENERATED_FROM
-    #   2. CONTAINS
-    rela_table_from     = dict()
-    rela_table_contain  = dict()
-    for i in master_parsed_rel_list:
+                # Find relationship for this file where it is a "child",
+                # then the ones where it is a "parent"
+                master_parsed_rel_list += doc_index.getRelationshipsTo(pkg_file['SPDXID'])[:1]
+                master_parsed_rel_list += doc_index.getRelationshipsFrom(pkg_file['SPDXID'])
 
-        # GENERATED_FROM Table ======================
-        if i['relationshipType'] == 'GENERATED_FROM':
-            try:
-                l = rela_table_from[i['spdxElementId']]
-                l.append(i['relatedSpdxElement'])
-                rela_table_from[i['spdxElementId']] = l
-            except KeyError:
-                rela_table_from[i['spdxElementId']] = [i['relatedSpdxElement']]
+    pkgs = [p for p in pkg_json['packages'] if p['SPDXID'] == pkg and 'hasFiles' in p]
+    pkgs += [p for p in pkg_json['packages'] if p['SPDXID'] != pkg and 'hasFiles' in p]
 
-        # CONTAINS Table ============================
-        elif i['relationshipType'] == 'CONTAINS':
-            try:
-                l = rela_table_contain[i['relatedSpdxElement']]
-                l.append(i['spdxElementId'])
-                rela_table_contain[i['relatedSpdxElement']] = l
-            except KeyError:
-                rela_table_contain[i['relatedSpdxElement']] = [i['spdxElementId']]
+    # Resolve every source file the packaged files are generated from
+    src_files = {}
+    for spdx_pkg in pkgs:
+        for pkged_file in spdx_pkg['hasFiles']:
+            if doc_index.getFile(pkged_file) is None:
+                continue
+            for relationship in doc_index.getRelationshipsFrom(pkged_file):
+                spdx_id = relationship['relatedSpdxElement']
+                if "NOASSERTION" not in spdx_id and spdx_id not in src_files:
+                    src_files[spdx_id] = resolve_source_file(doc_index, spdx_id, args_time, deploy_dir_spdx, common_args)
+
+    # Then look up their IP data in one go and load it into the
+    # license_copyright_buffer (and LicenseRefs)
+    tPre = time.time()
+    lookup = common_args.getFileChecksumLookup()
+    cache = common_args.getSourceFileCache()
+    cached = {}
+    if cache is not None:
+        for spdx_id, src_file in src_files.items():
+            if src_file is not None:
+                cached[spdx_id] = cache.get(SourceFileCache.makeKey(src_file))
+    lookup.preload(db_conn, [source_file_checksum(f) for spdx_id, f in src_files.items() if f is not None and cached.get(spdx_id) is None])
+    sources = {}
+    for spdx_id, src_file in src_files.items():
+        if src_file is None:
+            sources[spdx_id] = None
+            continue
+        entry = cached.get(spdx_id)
+        if entry is None:
+            rows = lookup.getRows(db_conn, source_file_checksum(src_file))
+            if cache is not None:
+                entry = CachedSourceFile(rows, *extract_license_copyright(rows))
+                cache.put(SourceFileCache.makeKey(src_file), entry)
+        if entry is not None:
+            add_license_copyright(entry.license_refs, entry.buffer_entry, src_file['SPDXID'], common_args)
+            sources[spdx_id] = ResolvedSourceFile(src_file, entry.rows, entry)
+        else:
+            collect_license_copyright(rows, src_file['SPDXID'], common_args)
+            sources[spdx_id] = ResolvedSourceFile(src_file, rows)
+    logTimedEvent(f"resolve IP data for {len(sources)} source files", tPre, args_time, common_args, "db_lookup")
+
+    relationship_tables = make_relationship_tables(master_parsed_rel_list)
 
+    packaged_files = []
     for spdx_pkg in pkg_json['packages']:
         if 'hasFiles' not in spdx_pkg:
             continue
 
         for pkged_file in spdx_pkg['hasFiles']:
-            for pkg_file in pkg_json['files']:
-                if pkged_file == pkg_file['SPDXID']:
-                    spdxElementId = pkg_file['SPDXID']
+            pkg_file = doc_index.getFile(pkged_file)
+            if pkg_file is None:
+                continue
+            spdxElementId = pkg_file['SPDXID']
 
-                    # Collate packaged files' licenses and copyrights data Binary and Package level based on relationships.
-                    for relationship in pkg_json['relationships']:
-                        if spdxElementId in relationship['relatedSpdxElement']:
-                            collate_license_and_copyright(pkg_file, sbom_fp, license_copyright_buffer=common_args.getLicenseCopyrightBuffer(), relationship_tables=[rela_table_from, rela_table_contain])
+            resolved_file = ResolvedPackagedFile(pkg_file, doc_index.getRelationshipsTo(spdxElementId),
+                [sources.get(rel['relatedSpdxElement']) for rel in doc_index.getRelationshipsFrom(spdxElementId)])
 
-                    spdxElementId = pkg_file['SPDXID']
-                    parsed_rel_list = [rel for rel in pkg_json['relationships'] if spdxElementId in rel['spdxElementId']]
+            # Collate packaged files' licenses and copyrights data Binary and Package level based on relationships.
+            if "PackagedFile" in spdxElementId:
+                resolved_file.licenses, resolved_file.copyrights = collate_license_and_copyright(pkg_file, license_copyright_buffer=common_args.getLicenseCopyrightBuffer(), relationship_tables=relationship_tables)
+            packaged_files.append(resolved_file)
 
-                    # Identify and output the source files
-                    for relationship in parsed_rel_list:
-                        time_temp = time.time()
-                        find_source_hash(pkg_json, relationship, spdx_pkg['name'], sbom_fp, db_conn, args_time, index_json, deploy_dir_spdx, common_args)
-                        logTimedEvent("find_source_hash on " + relationship["relatedSpdxElement"], time_temp, args_time, common_args)
+    return ResolvedPackage(described_pkg, pkg_relationship, packaged_files, master_parsed_rel_list)
 
-    write_package_relationships(master_parsed_rel_list, sbom_fp)
 
+def write_resolved_package(resolved, writer, args_time, common_args, source_filter=None):
+    """Render a ResolvedPackage through one of the OUTPUT_FORMATS writers.
+    source_filter, when given, is called for each source file and the file is
+    only written if it returns True."""
+    tFiles = time.time()
+    if resolved.spdx_pkg is not None:
+        writer.writePackage(resolved.spdx_pkg, resolved.relationship)
 
-def parse_relationship(rel, total, parse_logs, db_conn, args_packages, args_image, args_time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict, common_args):
-    # Find filename to parse
+    for packaged_file in resolved.packaged_files:
+        if packaged_file.licenses is not None:
+            for relationship in packaged_file.contained_by:
+                writer.writePackagedFile(packaged_file.file_data, packaged_file.licenses, packaged_file.copyrights)
+
+        # Identify and output the source files
+        for source in packaged_file.sources:
+            if source is None or (source_filter is not None and not source_filter(source)):
+                continue
+            if source.cached is not None:
+                writer.writeRenderedSourceFile(common_args.getSourceFileCache().getRendered(source.cached, writer, source.file_data))
+            else:
+                writer.writeSourceFile(source.file_data, source.rows)
+
+    writer.writeRelationships(resolved.relationships)
+    logTimedEvent(f"write {len(resolved.packaged_files)} packaged files", tFiles, args_time, common_args, "render")
+
+
+class IpData:
+    """The IP database data of a source file: its file type, concluded
+    licenses, licenses found in the file and copyright text"""
+    __slots__ = ('file_type', 'licenses_concluded', 'licenses_in_file', 'copyright_text')
+
+    def __init__(self, file_type, licenses_concluded, licenses_in_file, copyright_text):
+        self.file_type = file_type
+        self.licenses_concluded = licenses_concluded
+        self.licenses_in_file = licenses_in_file
+        self.copyright_text = copyright_text
+
+    @classmethod
+    def fromRows(cls, rows):
+        """Like write_license_copyright, only the first row is used. None
+        without rows."""
+        for row in rows:
+            return cls(row[1], license_list(row[2]), license_list(row[3]), row[4].rstrip('\r\n'))
+        return None
+
+
+class SourceFileModel:
+    """A source file of a recipe, ip_data is None when the IP database has
+    no match for its checksum"""
+    __slots__ = ('spdx_id', 'file_name', 'checksums', 'file_types', 'ip_data')
+
+    def __init__(self, spdx_id, file_name, checksums, file_types, ip_data):
+        self.spdx_id = spdx_id
+        self.file_name = file_name
+        self.checksums = checksums
+        self.file_types = file_types
+        self.ip_data = ip_data
+
+
+class PackagedFileModel:
+    """A packaged file with the licenses and copyrights rolled up from the
+    source files it is generated from. sources are the SPDXIDs of those
+    source files, see PackageModel.source_files."""
+    __slots__ = ('spdx_id', 'file_name', 'checksums', 'file_types', 'license_concluded', 'licenses', 'copyrights', 'sources')
+
+    def __init__(self, spdx_id, file_name, checksums, file_types, license_concluded, licenses, copyrights, sources):
+        self.spdx_id = spdx_id
+        self.file_name = file_name
+        self.checksums = checksums
+        self.file_types = file_types
+        self.license_concluded = license_concluded
+        self.licenses = licenses
+        self.copyrights = copyrights
+        self.sources = sources
+
+
+class LicenseRefModel:
+    """A LicenseRef used by the package, found is False (and the other fields
+    None) when it is not in the IP database"""
+    __slots__ = ('license_id', 'found', 'extracted_text', 'name', 'cross_reference', 'comment')
+
+    def __init__(self, license_id, row):
+        self.license_id = license_id
+        self.found = row is not None
+        self.extracted_text, self.name, self.cross_reference, self.comment = row[1:5] if row is not None else (None, None, None, None)
+
+
+class PackageModel:
+    """One resolved package of an image, see iter_packages. package is the
+    package's SPDX JSON object, relationships are the SPDX JSON relationships
+    of its files and source_files maps SPDXIDs to SourceFileModel."""
+    __slots__ = ('name', 'package', 'packaged_files', 'source_files', 'relationships', 'license_refs')
+
+    def __init__(self, name, package, packaged_files, source_files, relationships, license_refs):
+        self.name = name
+        self.package = package
+        self.packaged_files = packaged_files
+        self.source_files = source_files
+        self.relationships = relationships
+        self.license_refs = license_refs
+
+
+def package_model(name, resolved, license_ref_entries):
+    """Convert a ResolvedPackage and the (LicenseID, row) entries of its
+    LicenseRefs into a PackageModel. Collated licenses and copyrights are
+    in the order they are found rather than in set order."""
+    source_files = {}
+    packaged_files = []
+    for packaged_file in resolved.packaged_files:
+        sources = []
+        for source in packaged_file.sources:
+            if source is None:
+                continue
+            file_data = source.file_data
+            if file_data['SPDXID'] not in source_files:
+                source_files[file_data['SPDXID']] = SourceFileModel(file_data['SPDXID'], file_data['fileName'],
+                    {c['algorithm']: c['checksumValue'] for c in file_data['checksums']}, tuple(file_data['fileTypes']), IpData.fromRows(source.rows))
+            sources.append(file_data['SPDXID'])
+
+        # Only the collated packaged files are written, see write_resolved_package
+        if packaged_file.licenses is None:
+            continue
+        file_data = packaged_file.file_data
+        copyrights = tuple(dict.fromkeys(packaged_file.copyrights))
+        packaged_files.append(PackagedFileModel(file_data['SPDXID'], file_data['fileName'],
+            {c['algorithm']: c['checksumValue'] for c in file_data['checksums']}, tuple(file_data['fileTypes']),
+            collated_license_concluded(packaged_file.licenses), tuple(dict.fromkeys(packaged_file.licenses)),
+            tuple(c for c in copyrights if not (c == "<text> NOASSERTION </text>" and "NOASSERTION" in copyrights)),
+            tuple(dict.fromkeys(sources))))
+
+    return PackageModel(name, resolved.spdx_pkg, packaged_files, source_files, resolved.relationships,
+        [LicenseRefModel(licid, row) for licid, row in license_ref_entries])
+
+
+def relationship_filename(rel, docref_dict):
+    """Returns the package document filename and package name for an image
+    CONTAINS relationship."""
     doc_ref, spdx_ref = re.split('[:]', rel["relatedSpdxElement"])
     filename = docref_dict[doc_ref]
-    package_name = filename.split('.spdx.json')[0]
+    return filename, filename.split('.spdx.json')[0]
+
+
+class AggregateWriter:
+    """Writes the packages of an image into a single SPDX document as they are
+    parsed. Source files shared between packages are written only once, they
+    are remembered by 64 bit digests of their SPDXIDs so memory use stays flat
+    however many files the image has. The LicenseRefs of all packages are
+    written once, at the end of the document."""
+    def __init__(self, writer, name, image_json, args_time, common_args):
+        self._writer = writer
+        self._args_time = args_time
+        self._common_args = common_args
+        self._seen_sources = set()
+        self._shared_sources = 0
+        self._license_refs = OrderedSet()
+
+        writer.writeDocumentHeader(name)
+        writer.writeCreationInfo(image_json)
+
+    @staticmethod
+    def _digest(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+    def _firstSource(self, source):
+        digest = self._digest(source.file_data['SPDXID'])
+        if digest in self._seen_sources:
+            self._shared_sources += 1
+            return False
+        self._seen_sources.add(digest)
+        return True
+
+    def addPackage(self, resolved, license_refs):
+        write_resolved_package(resolved, self._writer, self._args_time, self._common_args, self._firstSource)
+        for licid in license_refs:
+            self._license_refs.append(licid)
+
+    def close(self, db_conn):
+        tRef = time.time()
+        write_license_information(self._writer, db_conn, list(self._license_refs), self._common_args)
+        logTimedEvent("write_licenserefs", tRef, self._args_time, self._common_args, "license_refs")
+        tClose = time.time()
+        self._writer.close()
+        logTimedEvent("close the aggregate document", tClose, self._args_time, self._common_args, "file_write")
+
+    def getSharedSourceCount(self):
+        """Number of source files not written again for another package"""
+        return self._shared_sources
+
+
+class PackageCollector:
+    """Stands in for an AggregateWriter in --jobs workers: keeps the resolved
+    packages so they can be written by the parent process."""
+    def __init__(self):
+        self.packages = []
+
+    def addPackage(self, resolved, license_refs):
+        self.packages.append((resolved, license_refs))
+
+
+def parse_relationship(rel, total, parse_logs, db_conn, args_packages, args_image, args_time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict, common_args, aggregate=None, output_format=TagValueWriter):
+    # Find filename to parse
+    filename, package_name = relationship_filename(rel, docref_dict)
 
     if args_packages and (package_name not in args_packages):
         return
@@ -578,20 +2056,43 @@ def parse_relationship(rel, total, parse_logs, db_conn, args_packages, args_imag
     start = time.time()
 
     success = False
+    common_args.resetPackageState()
 
     # Parse package and write spdx file
     try:
-        with open(f"{sbom_dir}/{package_name}.spdx", "w") as sbom_fp:
-            write_document_header(sbom_fp, args_image)
-            with open(f"{deploy_dir_spdx}/packages/{filename}") as pkg_fp:
-                pkg_json = json.load(pkg_fp)
-                write_creation_info(sbom_fp, pkg_json)
-                parse_package(pkg_json, pkg_json['packages'][0]['SPDXID'], rel, sbom_fp, db_conn, args_time, index_json, deploy_dir_spdx, common_args)
-            write_licenserefs(sbom_fp, db_conn, args_time, common_args)
+        tLoad = time.time()
+        pkg_json = load_spdx_document(deploy_dir_spdx, "packages", filename)
+        logTimedEvent("load package JSON", tLoad, args_time, common_args, "json_load")
+
+        if aggregate is not None:
+            resolved = resolve_package(pkg_json, pkg_json['packages'][0]['SPDXID'], rel, db_conn, args_time, deploy_dir_spdx, common_args)
+            aggregate.addPackage(resolved, list(common_args.getLicenseRefs()))
             success = True
             parse_logs[package_name]["parse_status"] = "succeeded"
+            return success
+
+        tRes = time.time()
+        resolved = resolve_package(pkg_json, pkg_json['packages'][0]['SPDXID'], rel, db_conn, args_time, deploy_dir_spdx, common_args)
+        logTimedEvent("resolve package", tRes, args_time, common_args)
+
+        with atomic_open(f"{sbom_dir}/{package_name}.{output_format.extension}") as sbom_fp:
+            tWrite = time.time()
+            writer = output_format(sbom_fp)
+            writer.writeDocumentHeader(args_image)
+            writer.writeCreationInfo(pkg_json)
+            write_resolved_package(resolved, writer, args_time, common_args)
+            tRef = time.time()
+            write_license_information(writer, db_conn, list(common_args.getLicenseRefs()), common_args)
+            logTimedEvent("write license information", tRef, args_time, common_args, "license_refs")
+            tClose = time.time()
+            writer.close()
+        logTimedEvent("close package file", tClose, args_time, common_args, "file_write")
+        logTimedEvent("write package", tWrite, args_time, common_args)
+        success = True
+        parse_logs[package_name]["parse_status"] = "succeeded"
     except KeyboardInterrupt:
         logger.warn("Caught KeyboardInterrupt")
+        parse_logs[package_name]["parse_status"] = "interrupted"
         return
     except Exception as e:
         logger.error(f"ERROR While parsing {package_name}")
@@ -600,161 +2101,948 @@ def parse_relationship(rel, total, parse_logs, db_conn, args_packages, args_imag
         parse_logs[package_name]["traceback"] = traceback.format_exc()
     finally:
         parse_logs[package_name]["time_elapsed"] = time.time() - start
+        if common_args.getPhaseTimer() is not None:
+            parse_logs[package_name]["phases"] = common_args.getPhaseTimer().getPhases()
         return success
 
 
-def main():
-    from pathlib import Path
+def file_fingerprint(path):
+    """Cheap change detection for an input file: size and mtime"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "missing"
+    return f"{st.st_size}:{st.st_mtime_ns}"
 
-    '''
-    Lookup table containing License and Copyright data for all SPDX-IDs.
-    Used to collate LicenseInfoInFile and Copyright up to Binary and Package level based on relationships.
 
-    Key: SPDXIDs
-    Value:
-        [
-            {
-                'licenseInfoInFiles': <license>,
-                'copyrightText': <copyright>
-            },
-            {
-                'licenseInfoInFiles': <license>,
-                'copyrightText': <copyright>
-            }
-        ]
-    '''
-    license_copyright_buffer = dict()
+def database_fingerprint(db_file, last_rcpl_file):
+    """The RCPL level for the cached IP database, the file itself otherwise"""
+    if last_rcpl_file and os.path.exists(last_rcpl_file):
+        with open(last_rcpl_file) as fp:
+            return f"rcpl-{fp.readline().strip()}"
+    return file_fingerprint(db_file)
 
-    license_refs = []
-    sqlite_db_files = f"{scripts_path}/../../wr-sbom-dl-4.2/sqlite_db_files"
-    cached_db_file = f"{os.environ['BUILDDIR']}/cache/wr-sbom/WRLinux-LTS.sqlite3"
 
-    recipe_file_lookup = {}
-    source_file_lookup = {}
+class SpdxCatalog:
+    """On-disk catalog of the package documents in DEPLOY_DIR_SPDX.
 
-    # Set up argument parser
-    parser = argparse_oe.ArgumentParser(description="WindRiver SBOM Generation Tool")
-    parser.add_argument('-d', '--debug', help='Enable debug output', action='store_true')
-    parser.add_argument('-q', '--quiet', help='Print only errors', action='store_true')
-    parser.add_argument('-D', '--db_file', help="IP Matching Database", action='store', default=cached_db_file)
-    parser.add_argument('-i', '--image', help="Image name to create SBOM from", action='store', default='wrlinux-image-small')
-    parser.add_argument('-l', '--limit', help="Limit # of packages parsed, default is all", type=int, action='store', default=0)
-    parser.add_argument('-p', '--packages', help="Scan package not image, can be used multiple times", action='append', type=str)
-    parser.add_argument('-o', '--output_dir', help="Alternate output directory for SBOM files", action='store')
-    parser.add_argument('-t', '--time', help='Enable timing output', action='store_true')
-    args = parser.parse_args()
+    For each package document an image contains it keeps the size and mtime
+    it was read at and the namespaces of its externalDocumentRefs, so
+    incremental planning does not have to parse the documents of unchanged
+    packages. refresh only reads the documents of the image whose size or
+    mtime changed since they were cataloged.
+    """
+    def __init__(self, catalog_file):
+        os.makedirs(os.path.dirname(catalog_file), exist_ok=True)
+        # Concurrent runs (--shard) share the catalog, wait for each other
+        self._conn = sqlite3.connect(catalog_file, timeout=300)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS PackageDocument (DeployDir TEXT NOT NULL, Filename TEXT NOT NULL, Size INTEGER NOT NULL, Mtime INTEGER NOT NULL, PRIMARY KEY (DeployDir, Filename));
+            CREATE TABLE IF NOT EXISTS PackageDocumentRef (DeployDir TEXT NOT NULL, Filename TEXT NOT NULL, Namespace TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS PackageDocumentRefDocument ON PackageDocumentRef (DeployDir, Filename);
+        """)
+        self._read_count = 0
+
+    def _forget(self, deploy_dir_spdx, filename):
+        for table in ("PackageDocument", "PackageDocumentRef"):
+            self._conn.execute(f"DELETE FROM {table} WHERE DeployDir = ? AND Filename = ?", (deploy_dir_spdx, filename))
+
+    def _read(self, deploy_dir_spdx, filename, st):
+        with open(f"{deploy_dir_spdx}/packages/{filename}") as fp:
+            document = json.load(fp)
+        key = (deploy_dir_spdx, filename)
+        self._conn.execute("INSERT INTO PackageDocument VALUES (?, ?, ?, ?)", key + (st.st_size, st.st_mtime_ns))
+        self._conn.executemany("INSERT INTO PackageDocumentRef VALUES (?, ?, ?)", [key + (d['spdxDocument'],) for d in document.get('externalDocumentRefs', [])])
+
+    def refresh(self, deploy_dir_spdx, filenames, common_args):
+        """Bring the catalog of the package documents filenames up to date,
+        returns the number of documents that were (re-)read"""
+        read_count = 0
+        with self._conn:
+            for filename in filenames:
+                row = self._conn.execute("SELECT Size, Mtime FROM PackageDocument WHERE DeployDir = ? AND Filename = ?",
+                    (deploy_dir_spdx, filename)).fetchone()
+                try:
+                    st = os.stat(f"{deploy_dir_spdx}/packages/{filename}")
+                except OSError:
+                    if row is not None:
+                        self._forget(deploy_dir_spdx, filename)
+                    continue
+                if row == (st.st_size, st.st_mtime_ns):
+                    continue
+                self._forget(deploy_dir_spdx, filename)
+                try:
+                    self._read(deploy_dir_spdx, filename, st)
+                    read_count += 1
+                except (OSError, ValueError, KeyError) as e:
+                    # Left out of the catalog, so it is read again next time
+                    common_args.getLogger().debug(f"Unable to catalog packages/{filename}: {e}")
+        self._read_count += read_count
+        return read_count
+
+    def getFingerprint(self, deploy_dir_spdx, subdir, filename):
+        """The file_fingerprint of a document when it was cataloged, None
+        for documents that are not in the catalog"""
+        if subdir != "packages":
+            return None
+        row = self._conn.execute("SELECT Size, Mtime FROM PackageDocument WHERE DeployDir = ? AND Filename = ?",
+            (deploy_dir_spdx, filename)).fetchone()
+        return f"{row[0]}:{row[1]}" if row is not None else None
+
+    def getDocumentRefs(self, deploy_dir_spdx, filename):
+        """The namespaces a package document references, None if it is not
+        in the catalog"""
+        if self.getFingerprint(deploy_dir_spdx, "packages", filename) is None:
+            return None
+        return [row[0] for row in self._conn.execute("SELECT Namespace FROM PackageDocumentRef WHERE DeployDir = ? AND Filename = ?",
+            (deploy_dir_spdx, filename))]
+
+    def getCounts(self):
+        return (self._read_count,)
+
+    def close(self):
+        self._conn.close()
+
+
+def package_recipe_files(deploy_dir_spdx, filename, namespace_dict, catalog=None):
+    """Returns the recipe documents a package document references through
+    its externalDocumentRefs."""
+    namespaces = catalog.getDocumentRefs(deploy_dir_spdx, filename) if catalog is not None else None
+    if namespaces is None:
+        pkg_json = load_spdx_document(deploy_dir_spdx, "packages", filename)
+        namespaces = [docs['spdxDocument'] for docs in pkg_json.get('externalDocumentRefs', [])]
+
+    recipe_files = []
+    for namespace in namespaces:
+        filename = namespace_dict.get(namespace)
+        if filename and spdx_document_exists(deploy_dir_spdx, "recipes", filename):
+            recipe_files.append(filename)
+    return sorted(set(recipe_files))
+
+
+def package_fingerprint(rel, filename, recipe_files, args_image, db_fingerprint, deploy_dir_spdx, args_format="tag-value", catalog=None):
+    """Fingerprint of everything that goes into a package's .spdx file: the
+    package and recipe documents, the IP database level, the output format
+    and the tool. With a freshly refreshed catalog the package documents
+    are not stat'ed again."""
+    def document_fingerprint(subdir, filename):
+        fingerprint = catalog.getFingerprint(deploy_dir_spdx, subdir, filename) if catalog is not None else None
+        return fingerprint or spdx_document_fingerprint(deploy_dir_spdx, subdir, filename)
+
+    h = hashlib.sha256()
+    h.update(f"{TOOL_VERSION}\n{db_fingerprint}\n{args_image}\n{rel['relatedSpdxElement']}\n".encode())
+    if args_format != "tag-value":
+        h.update(f"format {args_format}\n".encode())
+    h.update(f"{filename} {document_fingerprint('packages', filename)}\n".encode())
+    for recipe_file in recipe_files:
+        h.update(f"{recipe_file} {document_fingerprint('recipes', recipe_file)}\n".encode())
+    return h.hexdigest()
+
+
+def load_manifest(manifest_file):
+    """Load the incremental manifest of an output directory:
+        { package_name: { 'fingerprint': <sha256>, 'recipes': [<recipe document>, ...] } }
+    """
+    try:
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)
+        if manifest.get('version') == 1:
+            return manifest['packages']
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def write_manifest(manifest_file, manifest):
+    with atomic_open(manifest_file) as fp:
+        json.dump({'version': 1, 'packages': manifest}, fp)
+
+
+def shard_arg(value):
+    """argparse type of --shard K/N"""
+    try:
+        shard, shards = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not K/N")
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError(f"{value} is not a shard from 1/{shards} to {shards}/{shards}")
+    return shard, shards
+
+
+def shard_suffix(shard):
+    """Suffix of the parse logs, journal and manifest of a --shard run, so
+    shards can share the output directory"""
+    return f".shard-{shard[0]}-of-{shard[1]}" if shard else ""
+
+
+def shard_relationships(relationships, shard, shards, docref_dict, deploy_dir_spdx):
+    """The relationships of shard (1 to shards) of the image. Packages are
+    dealt out largest package document first, ties broken by name, each to
+    the shard with the least data so far. Every node that sees the same
+    deploy directory computes the same split; the image order is kept."""
+    packages = []
+    for i, rel in enumerate(relationships):
+        filename, package_name = relationship_filename(rel, docref_dict)
+        packages.append((-spdx_document_size(deploy_dir_spdx, "packages", filename), package_name, i))
+
+    loads = [(0, k) for k in range(shards)]
+    assigned = set()
+    for size, package_name, i in sorted(packages):
+        load, k = heapq.heappop(loads)
+        if k == shard - 1:
+            assigned.add(i)
+        heapq.heappush(loads, (load - size, k))
+    return [rel for i, rel in enumerate(relationships) if i in assigned]
+
+
+SHARD_LOGS = re.compile(r"parse_logs\.shard-(\d+)-of-(\d+)\.json$")
+
+
+def merge_shard_logs(sbom_dir):
+    """Combine the parse_logs.shard-K-of-N.json fragments of the --shard runs
+    in sbom_dir into its parse_logs.json. Missing shards, and packages that
+    are missing or were generated by more than one shard, are reported.
+    Returns True when every package was generated by exactly one shard."""
+    fragments = {}
+    for filename in sorted(os.listdir(sbom_dir)):
+        match = SHARD_LOGS.match(filename)
+        if match:
+            with open(f"{sbom_dir}/{filename}") as plg_fp:
+                fragments[(int(match.group(1)), int(match.group(2)))] = json.load(plg_fp)
+    if not fragments:
+        logger.error(f"No parse_logs.shard-K-of-N.json fragments in {sbom_dir}")
+        return False
+    shard_counts = sorted(set(shards for shard, shards in fragments))
+    if len(shard_counts) > 1:
+        logger.error(f"{sbom_dir} has fragments of runs with {' and '.join(str(n) for n in shard_counts)} shards")
+        return False
+
+    complete = True
+    shards = shard_counts[0]
+    for shard in range(1, shards + 1):
+        if (shard, shards) not in fragments:
+            logger.error(f"Shard {shard}/{shards} has no parse_logs fragment")
+            complete = False
+
+    # The packages every shard selected, in image order, and the shards that
+    # generated each of them
+    expected = []
+    owners = {}
+    for (shard, shards), fragment in sorted(fragments.items()):
+        info = fragment.pop("_shard", {})
+        fragment.pop("_summary", None)
+        if not expected:
+            expected = info.get("packages", [])
+        elif info.get("packages", []) != expected:
+            logger.warning(f"Shard {shard}/{shards} selected different packages, it was run with other options or inputs")
+        for package_name in fragment:
+            owners.setdefault(package_name, []).append((shard, fragment[package_name]))
+
+    parse_logs = {}
+    for package_name in expected + sorted(set(owners) - set(expected)):
+        if package_name in owners:
+            parse_logs[package_name] = owners[package_name][0][1]
+    for package_name, entries in owners.items():
+        if len(entries) > 1:
+            logger.error(f"{package_name} was generated by shards {', '.join(str(shard) for shard, log in entries)}")
+            complete = False
+    missing = [name for name in expected if parse_logs.get(name, {}).get("parse_status") not in ("succeeded", "failed", "skipped")]
+    for package_name in missing:
+        logger.error(f"{package_name} is missing")
+        complete = False
+
+    statuses = [log.get("parse_status") for log in parse_logs.values()]
+    logger.info(f"Merged {len(fragments)} of {shards} shards")
+    logger.info(f"{statuses.count('succeeded')} packages parsed successfully")
+    logger.info(f"{statuses.count('failed')} packages failed to parse")
+    logger.info(f"{statuses.count('skipped')} packages skipped as unchanged")
+    logger.info(f"{len(missing)} packages missing")
+
+    summary = phase_summary(parse_logs)
+    if summary:
+        parse_logs["_summary"] = summary
+    with atomic_open(f"{sbom_dir}/parse_logs.json") as plg_fp:
+        json.dump(parse_logs, plg_fp)
+    return complete
+
+
+@contextlib.contextmanager
+def atomic_open(filename):
+    """Open <filename>.tmp for writing and rename it to filename once it has
+    been written, so an interrupted run never leaves a partial file behind.
+    The temporary file is removed if writing fails."""
+    tmp_file = f"{filename}.tmp"
+    try:
+        with open(tmp_file, "w") as fp:
+            yield fp
+        os.replace(tmp_file, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+
+class ProgressJournal:
+    """Record of the packages completed in an output directory, appended
+    and synced to disk after each package so a run that was interrupted,
+    killed or preempted can be continued with --resume.
+
+    The first line identifies the run, the others hold the parse_logs.json
+    entry of a package:
+        { 'version': 1, 'run': { 'image': <image>, 'format': <format>, 'shard': [K, N] } }
+        { 'package': <package_name>, 'log': { 'parse_status': ..., ... } }
+    """
+    VERSION = 1
+
+    def __init__(self, journal_file, run):
+        self._journal_file = journal_file
+        # Compared with the header read back from the journal, so tuples
+        # and the like have to be in their JSON form
+        self._run = json.loads(json.dumps(run))
+        self._fp = None
+
+    def load(self):
+        """Returns the parse log entries of the packages that were generated
+        by the journaled run, an empty dict when there is no journal or it is
+        for a different image or format."""
+        entries = {}
+        try:
+            with open(self._journal_file) as fp:
+                header = json.loads(fp.readline())
+                if header.get('version') != self.VERSION or header.get('run') != self._run:
+                    return {}
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a killed run can be incomplete
+                        break
+                    entries[entry['package']] = entry['log']
+        except (OSError, ValueError, KeyError, AttributeError):
+            return {}
+        return entries
+
+    def start(self, entries):
+        """Start the journal over with the given, already completed, entries"""
+        with atomic_open(self._journal_file) as fp:
+            fp.write(json.dumps({'version': self.VERSION, 'run': self._run}) + "\n")
+            for package_name, log in entries.items():
+                fp.write(json.dumps({'package': package_name, 'log': log}) + "\n")
+        self._fp = open(self._journal_file, "a")
+
+    def record(self, package_name, log):
+        self._fp.write(json.dumps({'package': package_name, 'log': log}) + "\n")
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+# Per process state of a --jobs worker, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(db_file, checksum_index_file, last_rcpl_file, recipe_cache, total, args_image, args_time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict, aggregate=False, args_format="tag-value", render_cache=0, profile_dir=None):
+    """Pool initializer: each worker gets its own read-only database
+    connection and its own recipe and source file caches."""
+    # Interrupts are handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    common_args = CommonArgs(logger, dict(), OrderedSet(), RecipeStore(recipe_cache), {}, FileChecksumLookup(), make_namespace_dict(index_json), make_source_file_cache(render_cache), LicenseReferenceLookup(),
+        PhaseTimer() if args_time else None)
+    if checksum_index_file:
+        common_args.getFileChecksumLookup().setChecksumIndex(open_checksum_index(checksum_index_file, last_rcpl_file, common_args))
+    db_conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, check_same_thread=False)
+
+    worker_state.update(
+        common_args=common_args,
+        db_conn=db_conn,
+        args=(total, args_image, args_time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict),
+        aggregate=aggregate,
+        output_format=OUTPUT_FORMATS[args_format],
+        profile_dir=profile_dir,
+    )
+
+
+def parse_relationship_worker(rel):
+    """Runs parse_relationship in a pool worker and returns its parse log
+    entry along with the worker's IP database counters for the package and,
+    with --aggregate, the resolved package for the parent to write."""
+    total, args_image, args_time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict = worker_state['args']
+    common_args = worker_state['common_args']
+    counters = common_args.getCounters()
+    before = [counter.getCounts() for counter in counters]
+
+    parse_logs = {}
+    collector = PackageCollector() if worker_state['aggregate'] else None
+    success = run_profiled(worker_state['profile_dir'], relationship_filename(rel, docref_dict)[1], parse_relationship,
+        rel, total, parse_logs, worker_state['db_conn'], None, args_image, args_time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict, common_args, collector, worker_state['output_format'])
+    counts = [tuple(a - b for a, b in zip(counter.getCounts(), start)) for counter, start in zip(counters, before)]
+    return list(parse_logs.items()), success, counts, collector.packages if collector else []
+
+
+# Variables the tool needs from the bitbake configuration
+BITBAKE_VARS = ('DEPLOY_DIR_IMAGE', 'DEPLOY_DIR_SPDX', 'MACHINE_ARCH')
 
-    # Setup logger and set important variables
-    logger.setLevel(logging.INFO)
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
-        logger.debug(f"Debug Enabled: {args.db_file}")
-    elif args.quiet:
-        logger.setLevel(logging.ERROR)
+
+# The environment bitbake reads: the passthrough lists themselves, and the
+# variables they let through are added by bitbake_conf_key
+BITBAKE_ENV_VARS = ('BB_ENV_PASSTHROUGH', 'BB_ENV_PASSTHROUGH_ADDITIONS', 'BB_PRESERVE_ENV', 'BBPATH')
+
+
+def bitbake_layers(builddir):
+    """The layer directories BBLAYERS lists in $BUILDDIR/conf/bblayers.conf.
+    Only ${TOPDIR} and environment variables are expanded, layers whose path
+    uses other bitbake variables are left out."""
+    try:
+        with open(f"{builddir}/conf/bblayers.conf") as fp:
+            text = fp.read().replace("\\\n", " ")
+    except OSError:
+        return []
+    layers = []
+    for match in re.finditer(r'^\s*BBLAYERS(?::append)?\s*(?:[?+.:]*=|=[+.])\s*"([^"]*)"', text, re.MULTILINE):
+        for path in match.group(1).split():
+            path = os.path.expandvars(path.replace("${TOPDIR}", builddir))
+            if "${" not in path and path not in layers:
+                layers.append(path)
+    return layers
+
+
+def bitbake_conf_key(builddir):
+    """Hash of the build's conf/*.conf files, the mtimes of the conf/layer.conf
+    of its layers and the environment bitbake reads, which the cached bitbake
+    variables are valid for. Changes to files the configuration includes
+    from elsewhere are not noticed, remove the cache or give the variables
+    on the command line then."""
+    h = hashlib.sha256()
+    conf_dir = f"{builddir}/conf"
+    try:
+        conf_files = sorted(f for f in os.listdir(conf_dir) if f.endswith(".conf"))
+    except OSError:
+        conf_files = []
+    for conf_file in conf_files:
+        h.update(f"{conf_file}\0".encode())
+        with open(f"{conf_dir}/{conf_file}", "rb") as fp:
+            h.update(fp.read())
+        h.update(b"\0")
+    for layer in bitbake_layers(builddir):
+        try:
+            st = os.stat(f"{layer}/conf/layer.conf")
+            h.update(f"{layer} {st.st_size}:{st.st_mtime_ns}\0".encode())
+        except OSError:
+            h.update(f"{layer} missing\0".encode())
+    env_vars = set(BITBAKE_ENV_VARS)
+    for var in ('BB_ENV_PASSTHROUGH', 'BB_ENV_PASSTHROUGH_ADDITIONS'):
+        env_vars.update(os.environ.get(var, "").split())
+    for var in sorted(env_vars):
+        if var in os.environ:
+            h.update(f"{var}={os.environ[var]}\0".encode())
+    return h.hexdigest()
+
+
+def load_bitbake_vars(cache_file, key):
+    """Returns the cached bitbake variables, None if they are missing or were
+    cached for a different configuration."""
+    try:
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get('key') != key:
+        return None
+    bb_vars = cache.get('vars', {})
+    if not all(bb_vars.get(name) for name in BITBAKE_VARS):
+        return None
+    return bb_vars
+
+
+def save_bitbake_vars(cache_file, key, bb_vars):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "w") as fp:
+        json.dump({'key': key, 'vars': bb_vars}, fp)
+    os.replace(tmp_file, cache_file)
+
+
+def tinfoil_bitbake_vars(debug):
+    """Read BITBAKE_VARS from a config-only bitbake parse"""
+    # Imported here so that importing this module never loads bitbake
+    import bb.tinfoil
 
     with bb.tinfoil.Tinfoil() as tinfoil:
-        if args.debug:
+        if debug:
             tinfoil.logger.setLevel(logger.getEffectiveLevel())
-            tinfoil.prepare()
+            tinfoil.prepare(config_only=True)
         else:
             tinfoil.logger.setLevel(logging.ERROR)
-            tinfoil.prepare(quiet=1)
+            tinfoil.prepare(config_only=True, quiet=1)
 
-        deploy_dir_image = tinfoil.config_data.getVar('DEPLOY_DIR_IMAGE')
-        deploy_dir_spdx = tinfoil.config_data.getVar('DEPLOY_DIR_SPDX')
-        machine_arch = tinfoil.config_data.getVar('MACHINE_ARCH')
+        return {name: tinfoil.config_data.getVar(name) for name in BITBAKE_VARS}
 
-    total_time = time.time()
-
-    # Load image spdx json and relationships list
-    machinearch = machine_arch
-    spdx_tar_filename = f"{deploy_dir_image}/{args.image}-{machinearch}.spdx.tar.zst"
-    if not os.path.exists(spdx_tar_filename):
-        machinearch = machine_arch.replace('_', '-')
-        spdx_tar_filename = f"{deploy_dir_image}/{args.image}-{machinearch}.spdx.tar.zst"
 
-    image_filename = f"{deploy_dir_image}/{args.image}-{machinearch}.spdx.json"
+def get_bitbake_vars(overrides, builddir, cache_file, debug):
+    """Returns BITBAKE_VARS. Values given in overrides are used as is, the
+    rest come from cache_file while the build configuration is unchanged and
+    from tinfoil, which also refreshes the cache, otherwise."""
+    bb_vars = {name: overrides.get(name) for name in BITBAKE_VARS}
+    if all(bb_vars.values()):
+        logger.debug("Using bitbake variables from the command line/environment")
+        return bb_vars
 
-    # due to recent upstream change the <image>.spdx.json and <image>.spdx.index.json files
-    # are not created and exist only inside the <image>.spdx.tar.zst file. Both files need
-    # to be extracted from the compressed tar file
-    if not os.path.exists(image_filename) or (os.path.getctime(image_filename) < os.path.getctime(spdx_tar_filename)):
-        index_filename = f"{deploy_dir_image}/{args.image}-{machinearch}.spdx.index.json"
-        os.system(f"tar --extract --to-stdout --file={spdx_tar_filename} index.json > {index_filename}")
+    if builddir is None:
+        logger.error(f"BUILDDIR is not set, set {', '.join(BITBAKE_VARS)} or source oe-init-build-env")
+        sys.exit(1)
+    key = bitbake_conf_key(builddir)
+    cached_vars = load_bitbake_vars(cache_file, key)
+    if cached_vars is None and scriptutils is None:
+        logger.error(f"bitbake is not available, set {', '.join(BITBAKE_VARS)} or source oe-init-build-env")
+        sys.exit(1)
+    if cached_vars is None:
+        logger.debug(f"{cache_file} is stale, reading the bitbake configuration")
+        cached_vars = tinfoil_bitbake_vars(debug)
+        try:
+            save_bitbake_vars(cache_file, key, cached_vars)
+        except OSError as e:
+            logger.warning(f"Unable to cache bitbake variables: {e}")
+    else:
+        logger.debug(f"Using bitbake variables from {cache_file}")
+
+    for name in BITBAKE_VARS:
+        if not bb_vars[name]:
+            bb_vars[name] = cached_vars[name]
+    return bb_vars
+
+
+class SbomSession:
+    """What is kept between generate_sbom runs: the IP database connection
+    and checksum index, the recipe store, the IP data and LicenseRef caches,
+    the loaded image documents and the SpdxCatalog. A command line run uses a session once,
+    --serve keeps one for all requests and drops what is stale before each:
+    everything derived from the IP database when its RCPL level (or the file
+    itself) changes, recipes whose document changed and images whose
+    documents changed."""
+    def __init__(self, db_file, recipe_cache, render_cache, rebuild_db=False):
+        self._db_file = db_file
+        self._recipe_cache = recipe_cache
+        self._render_cache = render_cache
+        self._rebuild_db = rebuild_db
+        self._log_args = CommonArgs(logger, None, None, None, None)
+        self._db_conn = None
+        self._db_fingerprint = None
+        self._checksum_index_file = None
+        self._deploy_dir_spdx = None
+        self._recipe_file_lookup = RecipeStore(recipe_cache)
+        # (image, deploy directories): (fingerprint, image_json, index_json, spdx archive)
+        self._images = {}
+        self._catalog = None
+        self._resetDatabaseCaches()
+
+    def _resetDatabaseCaches(self):
+        self._file_checksum_lookup = FileChecksumLookup()
+        self._source_file_cache = make_source_file_cache(self._render_cache)
+        self._license_reference_lookup = LicenseReferenceLookup()
+
+    def loadImage(self, deploy_dir_image, deploy_dir_spdx, machine_arch, image, args_time):
+        """Returns the image and index documents, raises OSError, ValueError
+        or tarfile.TarError when they can not be read."""
+        global spdx_archive
+
+        machinearch = machine_arch
+        spdx_tar_filename = f"{deploy_dir_image}/{image}-{machinearch}.spdx.tar.zst"
+        if not os.path.exists(spdx_tar_filename):
+            machinearch = machine_arch.replace('_', '-')
+            spdx_tar_filename = f"{deploy_dir_image}/{image}-{machinearch}.spdx.tar.zst"
+        image_filename = f"{deploy_dir_image}/{image}-{machinearch}.spdx.json"
+        index_filename = f"{deploy_dir_image}/{image}-{machinearch}.spdx.index.json"
+
+        key = (image, deploy_dir_image, deploy_dir_spdx, machine_arch)
+        fingerprint = tuple(file_fingerprint(path) for path in (spdx_tar_filename, image_filename, index_filename))
+        cached = self._images.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            logger.debug(f"Using the loaded documents of {image}")
+            _, image_json, index_json, spdx_archive = cached
+            return image_json, index_json
+
+        # due to recent upstream change the <image>.spdx.json and <image>.spdx.index.json files
+        # are not created and exist only inside the <image>.spdx.tar.zst file. Both are read
+        # from the archive in a single pass, together with the package and recipe documents
+        # when DEPLOY_DIR_SPDX is not available.
+        spdx_archive = None
+        if os.path.exists(spdx_tar_filename):
+            tArchive = time.time()
+            # The image spdx file has the build time in the filename so use a wildcard to find it
+            spdx_archive = SpdxArchive(spdx_tar_filename, f"{image}-{machinearch}-*.spdx.json", not os.path.isdir(deploy_dir_spdx))
+            image_json = spdx_archive.getImage()
+            index_json = spdx_archive.getIndex()
+            if image_json is None or index_json is None:
+                raise ValueError(f"{spdx_tar_filename} does not contain the image and index documents")
+            if args_time:
+                logger.info(f"{time.time() - tArchive}s taken to read {spdx_tar_filename}")
+        else:
+            with open(image_filename) as image_fp:
+                image_json = json.load(image_fp)
+            # Load the index spdx json to translate externalRefs
+            with open(index_filename) as index_fp:
+                index_json = json.load(index_fp)
+
+        self._images[key] = (fingerprint, image_json, index_json, spdx_archive)
+        return image_json, index_json
+
+    def prepareDatabase(self, cached_db_file, sqlite_db_files):
+        """Bring the cached IP database up to date and (re)connect when it
+        changed. Returns the checksum index and .last_rcpl files, None for
+        both when db_file is not the cached database. Raises OSError when
+        the database or its dumps are missing."""
+        if self._db_file == cached_db_file:
+            # check for the db_file, create sqlite3 file if needed
+            if not os.path.exists(f"{sqlite_db_files}"):
+                raise FileNotFoundError("IP Database dumps files missing from wr-sbom-dl repo")
+
+            cached_db_dir = os.path.dirname(cached_db_file)
+            if not update_ip_database(cached_db_file, sqlite_db_files, self._rebuild_db, self._log_args):
+                logger.warning(f"Continuing with the existing {cached_db_file}")
+            self._rebuild_db = False
+            checksum_index_file = f"{cached_db_dir}/WRLinux-LTS.checksums"
+            last_rcpl_file = f"{cached_db_dir}/.last_rcpl"
+        else:
+            checksum_index_file = None
+            last_rcpl_file = None
+
+        if not os.path.exists(f"{self._db_file}"):
+            raise FileNotFoundError(f"{self._db_file} Database missing")
+
+        fingerprint = database_fingerprint(self._db_file, last_rcpl_file)
+        if fingerprint != self._db_fingerprint:
+            if self._db_conn is not None:
+                logger.info(f"{self._db_file} changed, dropping the cached IP data")
+                self._db_conn.close()
+                self._resetDatabaseCaches()
+
+            self._checksum_index_file = None
+            if checksum_index_file:
+                # Export the File table into the shared, memory-mapped checksum index
+                # whenever it is missing or older than the database
+                checksum_index = open_checksum_index(checksum_index_file, last_rcpl_file, self._log_args)
+                if checksum_index is None and os.path.exists(cached_db_file):
+                    logger.info(f"Building {checksum_index_file}")
+                    if build_checksum_index(cached_db_file, checksum_index_file, self._log_args):
+                        checksum_index = open_checksum_index(checksum_index_file, last_rcpl_file, self._log_args)
+                self._file_checksum_lookup.setChecksumIndex(checksum_index)
+                if checksum_index is not None:
+                    self._checksum_index_file = checksum_index_file
+
+            self._db_conn = create_connection(self._db_file, self._log_args)
+            self._db_fingerprint = fingerprint
+        return self._checksum_index_file, last_rcpl_file
+
+    def getConnection(self):
+        return self._db_conn
+
+    def getCatalog(self, catalog_file):
+        """The SpdxCatalog in catalog_file, opened once per session"""
+        if self._catalog is None:
+            self._catalog = SpdxCatalog(catalog_file)
+        return self._catalog
+
+    def commonArgs(self, index_json, deploy_dir_spdx, args_time):
+        """CommonArgs for a run over an image, with this session's caches.
+        Recipes whose document changed since they were loaded are dropped."""
+        if deploy_dir_spdx != self._deploy_dir_spdx:
+            if self._deploy_dir_spdx is not None:
+                self._recipe_file_lookup = RecipeStore(self._recipe_cache)
+            self._deploy_dir_spdx = deploy_dir_spdx
+        else:
+            self._recipe_file_lookup.dropChanged(deploy_dir_spdx, self._log_args)
 
-        # The image spdx file has the build time in the filename so use a wildcard to extract it
-        image_wildcard_filename = f"{args.image}-{machinearch}-*.spdx.json"
-        os.system(f"tar --extract --to-stdout --wildcards --file={spdx_tar_filename} {image_wildcard_filename} > {image_filename}")
+        '''
+        Lookup table containing License and Copyright data for all SPDX-IDs.
+        Used to collate LicenseInfoInFile and Copyright up to Binary and Package level based on relationships.
 
+        Key: SPDXIDs
+        Value:
+            [
+                {
+                    'licenseInfoInFiles': <license>,
+                    'copyrightText': <copyright>
+                },
+                {
+                    'licenseInfoInFiles': <license>,
+                    'copyrightText': <copyright>
+                }
+            ]
+        '''
+        license_copyright_buffer = dict()
+        license_refs = OrderedSet()
+        source_file_lookup = {}
+
+        return CommonArgs(logger, license_copyright_buffer, license_refs, self._recipe_file_lookup, source_file_lookup, self._file_checksum_lookup,
+            make_namespace_dict(index_json), self._source_file_cache, self._license_reference_lookup, PhaseTimer() if args_time else None)
+
+    def close(self):
+        if self._db_conn is not None:
+            self._db_conn.close()
+            self._db_conn = None
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
+
+
+def iter_packages(deploy_dir_image, deploy_dir_spdx, machine_arch, image, db_file, packages=None, recipe_cache=500000, render_cache=256):
+    """Resolve the packages of image one at a time and yield a PackageModel
+    for each, in image order, with the IP data of db_file (used as is, RCPL
+    dumps are not applied). packages limits the packages to those names.
+
+    Nothing is written and bitbake is not needed. Only the current package
+    is held besides the bounded recipe store and source file cache, so the
+    models can be streamed into another store. Errors reading a package
+    are raised from the generator; the database connection is closed when
+    the generator is exhausted or closed."""
+    session = SbomSession(db_file, recipe_cache, render_cache)
     try:
-        image_fp = open(image_filename)
-        image_json = json.load(image_fp)
-    except Error as e:
-        logger.error(e)
-        sys.exit(1)
+        image_json, index_json = session.loadImage(deploy_dir_image, deploy_dir_spdx, machine_arch, image, False)
+        session.prepareDatabase(None, None)
+        db_conn = session.getConnection()
+        common_args = session.commonArgs(index_json, deploy_dir_spdx, False)
+        docref_dict = make_document_ref_dict(image_json['externalDocumentRefs'], index_json, common_args.getDocumentNamespaces())
+
+        for rel in image_json['relationships']:
+            if rel['relationshipType'] != "CONTAINS":
+                continue
+            filename, package_name = relationship_filename(rel, docref_dict)
+            if packages and package_name not in packages:
+                continue
 
-    relationships_list = list(filter(lambda x: x["relationshipType"] == "CONTAINS", image_json["relationships"]))
-    # Load the index spdx json to translate externalRefs
-    index_fp = open(f"{deploy_dir_image}/{args.image}-{machinearch}.spdx.index.json")
-    index_json = json.load(index_fp)
+            common_args.resetPackageState()
+            common_args.getSourceFileLookup().clear()
+            common_args.getFileChecksumLookup().clear()
+            pkg_json = load_spdx_document(deploy_dir_spdx, "packages", filename)
+            resolved = resolve_package(pkg_json, pkg_json['packages'][0]['SPDXID'], rel, db_conn, False, deploy_dir_spdx, common_args)
+            license_refs = common_args.getLicenseReferenceLookup().getEntries(db_conn, list(common_args.getLicenseRefs()))
+            yield package_model(package_name, resolved, license_refs)
+    finally:
+        session.close()
 
-    # check for the db_file, create sqlite3 file if needed
-    if not os.path.exists(f"{sqlite_db_files}"):
-        logger.error("IP Database dumps files missing from wr-sbom-dl repo")
-        sys.exit(1)
 
-    if args.db_file == cached_db_file:
-        cached_db_dir = os.path.dirname(cached_db_file)
-        rcpl = 1
-        if os.path.exists(cached_db_dir):
-            if os.path.exists(f"{cached_db_dir}/.last_rcpl"):
-                with open(f"{cached_db_dir}/.last_rcpl", "r") as rcpl_file:
-                    rcpl = int(rcpl_file.readline())
-        else:
-            os.makedirs(cached_db_dir)
+class SocketLogHandler(logging.Handler):
+    """Sends log records to a --connect client as {"log": <line>} lines"""
+    def __init__(self, wfile):
+        super().__init__()
+        self.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+        self._wfile = wfile
 
-        # Check for the next RCPL Dump file
-        rcpl_dump_file = f"{sqlite_db_files}/rcpl-{rcpl+1:04}.dump.xz"
-        if os.path.exists(rcpl_dump_file):
-            # If there is any next RCPL dump file, rebuild the database
-            # from scratch, deleting any existing database files
-            try:
-                os.rename(f"{cached_db_file}", f"{cached_db_file}_bkup")
-            except:
-                pass
+    def emit(self, record):
+        try:
+            self._wfile.write((json.dumps({'log': self.format(record)}) + "\n").encode())
+        except OSError:
+            # the client went away, the request still completes
+            pass
+
+
+def request_args(server_args, request):
+    """The arguments of a --connect request: the server's own, with the image,
+    packages and output options of the request. Requests are always
+    incremental, unless aggregated, so only changed packages are generated."""
+    args = argparse.Namespace(**vars(server_args))
+    image = request.get('image') or server_args.image
+    args.image = [image] if isinstance(image, str) else image
+    args.packages = request.get('packages') or None
+    args.output_dir = request.get('output_dir') or server_args.output_dir
+    args.format = request.get('format') or server_args.format
+    if args.format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {args.format}")
+    args.aggregate = bool(request.get('aggregate'))
+    args.limit = int(request.get('limit') or 0)
+    args.jobs = int(request.get('jobs') or server_args.jobs)
+    args.time = bool(request.get('time'))
+    args.profile = int(request.get('profile') or 0)
+    args.incremental = not args.aggregate
+    args.resume = False
+    args.shard = None
+    return args
+
+
+class SbomRequestHandler(socketserver.StreamRequestHandler):
+    """Handles a request from lxsbomtool.py --connect: one JSON line with the
+    image and packages to generate. The log is streamed back, followed by
+    {"result": <generate_sbom result>} or {"error": <message>}."""
+    def _send(self, message):
+        with contextlib.suppress(OSError):
+            self.wfile.write((json.dumps(message) + "\n").encode())
+
+    def handle(self):
+        server = self.server
+        try:
+            request = json.loads(self.rfile.readline())
+            args = request_args(server.args, request)
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send({'error': f"Invalid request: {e}"})
+            return
+
+        handler = SocketLogHandler(self.wfile)
+        logger.addHandler(handler)
+        try:
+            logger.info(f"Generating {', '.join(args.packages or args.image)}")
+            bb_vars = get_bitbake_vars(server.overrides, os.environ.get('BUILDDIR'), bitbake_vars_file(), args.debug)
+            result = generate_images(args, server.session, bb_vars, server.cached_db_file, server.sqlite_db_files)
+            self._send({'result': result})
+        except (OSError, ValueError, tarfile.TarError) as e:
+            logger.error(e)
+            self._send({'error': str(e)})
+        except SystemExit:
+            self._send({'error': "Unable to read the bitbake configuration"})
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            self._send({'error': str(e)})
+        finally:
+            logger.removeHandler(handler)
+
+
+class SbomServer(socketserver.UnixStreamServer):
+    """Serves SBOM requests on a Unix socket, one at a time, from a single
+    SbomSession so the IP database, checksum index, recipes and LicenseRefs
+    stay loaded between them."""
+    def __init__(self, socket_path, args, session, overrides, cached_db_file, sqlite_db_files):
+        self.args = args
+        self.session = session
+        self.overrides = overrides
+        self.cached_db_file = cached_db_file
+        self.sqlite_db_files = sqlite_db_files
+        # Only the user running the server can connect
+        umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, SbomRequestHandler)
+        finally:
+            os.umask(umask)
+
+
+def serve_sbom_requests(socket_path, args, session, overrides, cached_db_file, sqlite_db_files):
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
             try:
-                os.remove(f"{cached_db_dir}/.sql_restore")
-            except:
-                pass
-            # Starting from RCPL 0001, dump the SQL from each RCPL into .sql_restore
-            rcpl = 1
-            while True:
-                rcpl_dump_file = f"{sqlite_db_files}/rcpl-{rcpl:04}.dump.xz"
-                if os.path.exists(rcpl_dump_file):
-                    logger.info(f"Building {cached_db_file} from {rcpl_dump_file}")
-                    os.system(f"xzcat {rcpl_dump_file} >> {cached_db_dir}/.sql_restore")
-                    rcpl += 1
-                else:
-                    break
-
-            # Create the database file from .sql_restore and record the last RCPL
-            os.system(f"echo 'COMMIT;' >> {cached_db_dir}/.sql_restore")
-            os.system(f"sqlite3 {cached_db_file} < {cached_db_dir}/.sql_restore")
-            logger.info("Database has been recreated.")
-            os.remove(f"{cached_db_dir}/.sql_restore")
-            with open(f"{cached_db_dir}/.last_rcpl", "w") as rcpl_file:
-                rcpl_file.writelines(f"{rcpl-1:04}\n")
-        else:
-            logger.info(f"{cached_db_file} is current for RCPL {rcpl:04}")
+                sock.connect(socket_path)
+                logger.error(f"A server is already listening on {socket_path}")
+                return False
+            except OSError:
+                # left behind by a server that was killed
+                os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+
+    with SbomServer(socket_path, args, session, overrides, cached_db_file, sqlite_db_files) as server:
+        logger.info(f"Serving SBOM requests on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Shutting down")
+        finally:
+            os.remove(socket_path)
+    return True
 
-    if not os.path.exists(f"{args.db_file}"):
-        logger.error(f"{args.db_file} Database missing")
-        sys.exit(1)
 
-    # Initialize common function arguments
-    common_args = CommonArgs(logger, license_copyright_buffer, license_refs, recipe_file_lookup, source_file_lookup)
+def request_sbom(socket_path, args):
+    """Sends the image and packages to generate to a --serve server and
+    prints its log. Returns True when the request completed."""
+    request = {
+        'image': args.image,
+        'packages': args.packages,
+        'output_dir': os.path.abspath(args.output_dir) if args.output_dir else None,
+        'format': args.format,
+        'aggregate': args.aggregate,
+        'limit': args.limit,
+        'jobs': args.jobs if args.jobs > 1 else None,
+        'time': args.time,
+        'profile': args.profile,
+    }
+    result = None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall((json.dumps(request) + "\n").encode())
+            with sock.makefile("r") as sock_fp:
+                for line in sock_fp:
+                    message = json.loads(line)
+                    if 'log' in message:
+                        print(message['log'], file=sys.stderr)
+                    elif 'result' in message:
+                        result = message['result']
+                    elif 'error' in message:
+                        logger.error(message['error'])
+    except (OSError, ValueError) as e:
+        logger.error(f"Unable to request the SBOM from {socket_path}: {e}")
+        return False
+    return result is not None and not result['interrupted']
+
+
+class SharedPackages:
+    """The package SBOMs of a multi-image run, see generate_images. Packages
+    are keyed on their package document, a package is generated for the
+    first image that contains it and linked from the output directories of
+    the others."""
+    def __init__(self):
+        self._files = {}
+        self._images = {}
+
+    def addImage(self, image, filenames):
+        for filename in filenames:
+            self._images.setdefault(filename, []).append(image)
+
+    def getFile(self, filename):
+        """The SBOM generated for a package document, None if there is none yet"""
+        return self._files.get(filename)
+
+    def addFile(self, filename, sbom_file):
+        self._files.setdefault(filename, sbom_file)
+
+    def getImageCounts(self, image):
+        """The number of packages of image and how many of them are in other
+        images too"""
+        images = [i for i in self._images.values() if image in i]
+        return len(images), sum(1 for i in images if len(i) > 1)
+
+    def getCounts(self):
+        """The number of distinct packages and how many are in more than one
+        image"""
+        return len(self._images), sum(1 for i in self._images.values() if len(i) > 1)
+
+
+def link_file(target, link_name):
+    """Replace link_name with a relative symlink to target"""
+    tmp_name = f"{link_name}.tmp"
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp_name)
+    os.symlink(os.path.relpath(target, os.path.dirname(link_name)), tmp_name)
+    os.replace(tmp_name, link_name)
+
+
+def generate_sbom(args, session, bb_vars, cached_db_file, sqlite_db_files, shared=None):
+    """Generate the SBOM of args.image, or of args.packages, with the IP
+    database and caches of session. With shared, the packages already
+    generated for another image are linked. Returns the counts of the run,
+    raises OSError, ValueError or tarfile.TarError when the image documents
+    or the IP database can not be read."""
+    from pathlib import Path
+
+    total_time = time.time()
+    deploy_dir_image = bb_vars['DEPLOY_DIR_IMAGE']
+    deploy_dir_spdx = bb_vars['DEPLOY_DIR_SPDX']
+    machine_arch = bb_vars['MACHINE_ARCH']
+
+    # Load image spdx json and relationships list
+    image_json, index_json = session.loadImage(deploy_dir_image, deploy_dir_spdx, machine_arch, args.image, args.time)
+    relationships_list = list(filter(lambda x: x["relationshipType"] == "CONTAINS", image_json["relationships"]))
 
-    db_conn = create_connection(args.db_file, common_args)
+    # Bring the IP database up to date and drop the cached data of an older one
+    checksum_index_file, last_rcpl_file = session.prepareDatabase(cached_db_file, sqlite_db_files)
+    db_conn = session.getConnection()
+
+    # Initialize common function arguments
+    common_args = session.commonArgs(index_json, deploy_dir_spdx, args.time)
 
     # Set output directory (create output dir if necessary)
     if args.output_dir:
@@ -762,6 +3050,13 @@ def main():
     else:
         sbom_dir = f"{deploy_dir_spdx}/wr-sbom"
     Path(sbom_dir).mkdir(parents=True, exist_ok=True)
+    suffix = shard_suffix(args.shard)
+
+    profile_dir = None
+    if args.profile > 0:
+        profile_dir = f"{sbom_dir}/profile{suffix}"
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        Path(profile_dir).mkdir()
 
     # Initialize progress tracking variables
     succeeded = 0
@@ -775,32 +3070,423 @@ def main():
     else:
         total = len(relationships_list)
 
-    docref_dict = make_document_ref_dict(image_json['externalDocumentRefs'], index_json)
-    # Parse each package to a single *.spdx file (based on the image relationships)
+    docref_dict = make_document_ref_dict(image_json['externalDocumentRefs'], index_json, common_args.getDocumentNamespaces())
+
+    # Select the packages to parse (based on the image relationships)
+    selected_relationships = []
     for rel in relationships_list[::-1]:
-        # Gets whether the parsing succeeded or not.
-        # This is the entry point into all the other functions in this file
-        success = parse_relationship(rel, total, parse_logs, db_conn, args.packages, args.image, args.time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict, common_args)
-        if success is not None:
-            if success:
-                succeeded += 1
-            else:
-                failed += 1
+        if args.packages and relationship_filename(rel, docref_dict)[1] not in args.packages:
+            continue
+        selected_relationships.append(rel)
 
         # Limit package parsing
-        if(args.limit != 0 and len(parse_logs.keys()) >= args.limit):
+        if(args.limit != 0 and len(selected_relationships) >= args.limit):
             break
 
+    # With --shard only this node's share of the packages is generated
+    output_format = OUTPUT_FORMATS[args.format]
+    parse_logs_file = f"{sbom_dir}/parse_logs{suffix}.json"
+    if args.shard:
+        shard_info = {
+            'shard': args.shard[0],
+            'shards': args.shard[1],
+            'image': args.image,
+            'packages': [relationship_filename(rel, docref_dict)[1] for rel in selected_relationships],
+        }
+        selected_relationships = shard_relationships(selected_relationships, args.shard[0], args.shard[1], docref_dict, deploy_dir_spdx)
+        logger.info(f"Shard {args.shard[0]}/{args.shard[1]}: {len(selected_relationships)} of {len(shard_info['packages'])} packages")
+
+    # Partial files of a run that was killed, other shards may be writing
+    # theirs in the same directory
+    own_files = {f"{relationship_filename(rel, docref_dict)[1]}.{output_format.extension}" for rel in selected_relationships}
+    own_files.update(os.path.basename(f) for f in (parse_logs_file, f"{sbom_dir}/.manifest{suffix}.json", f"{sbom_dir}/.journal{suffix}"))
+    for filename in os.listdir(sbom_dir):
+        if filename.endswith(".tmp") and filename[:-len(".tmp")] in own_files:
+            os.remove(f"{sbom_dir}/{filename}")
+
+    # In a multi-image run the packages generated for an earlier image are
+    # linked rather than generated again
+    linked = 0
+    image_relationships = selected_relationships
+    if shared is not None:
+        shared.addImage(args.image, [relationship_filename(rel, docref_dict)[0] for rel in selected_relationships])
+        if not args.aggregate:
+            pending_relationships = []
+            for rel in selected_relationships:
+                filename, package_name = relationship_filename(rel, docref_dict)
+                sbom_file = shared.getFile(filename)
+                if sbom_file is not None:
+                    try:
+                        link_file(sbom_file, f"{sbom_dir}/{package_name}.{output_format.extension}")
+                        parse_logs[package_name] = {"parse_status": "linked", "linked_to": sbom_file, "time_elapsed": 0.0}
+                        linked += 1
+                        continue
+                    except OSError as e:
+                        logger.debug(f"Unable to link {package_name} to {sbom_file}: {e}")
+                pending_relationships.append(rel)
+            selected_relationships = pending_relationships
+
+    # Each completed package is journaled, with --resume the packages the
+    # previous run completed are not generated again
+    journal = None
+    resumed = {}
+    if not args.aggregate:
+        journal = ProgressJournal(f"{sbom_dir}/.journal{suffix}", {'image': args.image, 'format': args.format, 'shard': list(args.shard) if args.shard else None})
+        if args.resume:
+            entries = journal.load()
+            if not entries:
+                logger.warning(f"No journal of an earlier run of {args.image} in {sbom_dir}, starting from the beginning")
+            pending_relationships = []
+            for rel in selected_relationships:
+                package_name = relationship_filename(rel, docref_dict)[1]
+                log = entries.get(package_name)
+                if log is not None and log.get("parse_status") == "succeeded" and os.path.exists(f"{sbom_dir}/{package_name}.{output_format.extension}"):
+                    parse_logs[package_name] = dict(log, resumed=True)
+                    resumed[package_name] = log
+                    continue
+                pending_relationships.append(rel)
+            selected_relationships = pending_relationships
+        journal.start(resumed)
+
+    # In incremental mode, skip packages whose inputs have not changed since
+    # their .spdx file was written
+    skipped = 0
+    manifest_file = f"{sbom_dir}/.manifest{suffix}.json"
+    manifest = load_manifest(manifest_file) if args.incremental else {}
+    fingerprints = {}
+    if args.incremental:
+        db_fingerprint = database_fingerprint(args.db_file, last_rcpl_file)
+        tCatalog = time.time()
+        catalog = None
+        if cached_db_file:
+            catalog = session.getCatalog(f"{os.path.dirname(cached_db_file)}/spdx-catalog.sqlite3")
+            read_count = catalog.refresh(deploy_dir_spdx, [relationship_filename(rel, docref_dict)[0] for rel in selected_relationships], common_args)
+            logTimedEvent(f"refresh the catalog of {deploy_dir_spdx}, {read_count} documents read", tCatalog, args.time, common_args)
+        previous_logs = {}
+        if os.path.exists(parse_logs_file):
+            with open(parse_logs_file) as plg_fp:
+                previous_logs = json.load(plg_fp)
+
+        pending_relationships = []
+        for rel in selected_relationships:
+            filename, package_name = relationship_filename(rel, docref_dict)
+            entry = manifest.get(package_name)
+            if entry and os.path.exists(f"{sbom_dir}/{package_name}.{output_format.extension}") and \
+                    entry['fingerprint'] == package_fingerprint(rel, filename, entry['recipes'], args.image, db_fingerprint, deploy_dir_spdx, args.format, catalog):
+                logger.debug(f"{package_name} is unchanged, skipping")
+                parse_logs[package_name] = dict(previous_logs.get(package_name, {}), parse_status="skipped", time_elapsed=0.0)
+                skipped += 1
+                continue
+
+            # Fingerprint the inputs before parsing, so a change made while
+            # the package is being generated is picked up next time
+            manifest.pop(package_name, None)
+            try:
+                recipe_files = package_recipe_files(deploy_dir_spdx, filename, common_args.getDocumentNamespaces(), catalog)
+                fingerprints[package_name] = {
+                    'fingerprint': package_fingerprint(rel, filename, recipe_files, args.image, db_fingerprint, deploy_dir_spdx, args.format, catalog),
+                    'recipes': recipe_files,
+                }
+            except (OSError, ValueError) as e:
+                logger.debug(f"Unable to fingerprint {package_name}: {e}")
+            pending_relationships.append(rel)
+        selected_relationships = pending_relationships
+
+    # Parse each package to a single *.spdx file, or all of them into the
+    # image's *.spdx file with --aggregate
+    aggregate = None
+    if args.aggregate:
+        aggregate_filename = f"{sbom_dir}/{args.image}.{output_format.extension}"
+        aggregate_fp = open(f"{aggregate_filename}.tmp", "w")
+        aggregate = AggregateWriter(output_format(aggregate_fp), args.image, image_json, args.time, common_args)
+
+    interrupted = False
+    if args.jobs > 1:
+        initargs = (args.db_file, checksum_index_file, last_rcpl_file, args.recipe_cache, total, args.image, args.time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict, args.aggregate, args.format, args.render_cache, profile_dir)
+        with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=initargs) as pool:
+            try:
+                # imap keeps parse_logs in the same order as a serial run
+                for logs, success, counts, packages in pool.imap(parse_relationship_worker, selected_relationships):
+                    parse_logs.update(logs)
+                    for resolved, license_refs in packages:
+                        # The package is written here, add that to the
+                        # phases the worker recorded for it
+                        phase_timer = common_args.getPhaseTimer()
+                        if phase_timer is not None:
+                            phase_timer.reset()
+                            phase_timer.addPhases(logs[0][1].get("phases", {}))
+                        aggregate.addPackage(resolved, license_refs)
+                        if phase_timer is not None:
+                            logs[0][1]["phases"] = phase_timer.getPhases()
+                    for counter, delta in zip(common_args.getCounters(), counts):
+                        counter.addCounts(*delta)
+                    if journal is not None:
+                        for package_name, log in logs:
+                            journal.record(package_name, log)
+                    if success is not None:
+                        if success:
+                            succeeded += 1
+                        else:
+                            failed += 1
+            except KeyboardInterrupt:
+                logger.warning("Caught KeyboardInterrupt")
+                pool.terminate()
+                interrupted = True
+    else:
+        try:
+            for rel in selected_relationships:
+                # Gets whether the parsing succeeded or not.
+                # This is the entry point into all the other functions in this file
+                package_name = relationship_filename(rel, docref_dict)[1]
+                success = run_profiled(profile_dir, package_name, parse_relationship, rel, total, parse_logs, db_conn, args.packages, args.image, args.time, index_json, image_json, deploy_dir_spdx, sbom_dir, docref_dict, common_args, aggregate, output_format)
+                if parse_logs.get(package_name, {}).get("parse_status") == "interrupted":
+                    raise KeyboardInterrupt
+                if journal is not None and package_name in parse_logs:
+                    journal.record(package_name, parse_logs[package_name])
+                if success is not None:
+                    if success:
+                        succeeded += 1
+                    else:
+                        failed += 1
+        except KeyboardInterrupt:
+            logger.warning("Caught KeyboardInterrupt")
+            interrupted = True
+
+    if journal is not None:
+        journal.close()
+
+    if aggregate is not None:
+        # Closing writes the LicenseRefs of all packages, that is timed for
+        # the run rather than for the last package
+        phase_timer = common_args.getPhaseTimer()
+        if phase_timer is not None:
+            phase_timer.reset()
+        aggregate.close(db_conn)
+        if phase_timer is not None:
+            parse_logs["_aggregate"] = {"phases": phase_timer.getPhases()}
+        aggregate_fp.close()
+        if interrupted:
+            os.remove(f"{aggregate_filename}.tmp")
+        else:
+            os.replace(f"{aggregate_filename}.tmp", aggregate_filename)
+
+    if args.incremental:
+        for package_name, entry in fingerprints.items():
+            if parse_logs.get(package_name, {}).get("parse_status") == "succeeded":
+                manifest[package_name] = entry
+        write_manifest(manifest_file, manifest)
+
+    if shared is not None and not args.aggregate:
+        for rel in image_relationships:
+            filename, package_name = relationship_filename(rel, docref_dict)
+            if parse_logs.get(package_name, {}).get("parse_status") in ("succeeded", "skipped"):
+                shared.addFile(filename, f"{sbom_dir}/{package_name}.{output_format.extension}")
+
     # Output file generation report
     common_args.getLogger().info("----------SPDX File Generation Complete----------")
     common_args.getLogger().info(f"{succeeded} packages parsed successfully")
     common_args.getLogger().info(f"{failed} packages failed to parse")
+    if args.incremental:
+        common_args.getLogger().info(f"{skipped} packages skipped as unchanged, {succeeded} regenerated")
+    if resumed:
+        common_args.getLogger().info(f"{len(resumed)} packages completed by the interrupted run")
+    if linked:
+        common_args.getLogger().info(f"{linked} packages linked to the SBOMs generated for an earlier image")
+    if interrupted and journal is not None:
+        common_args.getLogger().warning("Interrupted, use --resume to continue")
     common_args.getLogger().info(f"{time.time()-total_time}s taken")
-
-    # Dump parse logs to a json file
-    with open(f"{sbom_dir}/parse_logs.json", "w") as plg_fp:
+    if args.time:
+        common_args.getLogger().info(f"{common_args.getFileChecksumLookup().getQueryCount()} IP database queries")
+        common_args.getLogger().info(f"{common_args.getFileChecksumLookup().getIndexLookupCount()} checksum index lookups")
+        common_args.getLogger().info(f"{common_args.getLicenseReferenceLookup().getCounts()[0]} LicenseReference queries")
+        common_args.getLogger().info("Recipe cache: {} hits, {} misses, {} evictions".format(*common_args.getRecipeFileLookup().getCounts()))
+        if common_args.getSourceFileCache() is not None:
+            common_args.getLogger().info("Source file cache: {} hits, {} misses, {} evictions".format(*common_args.getSourceFileCache().getCounts()))
+        if aggregate is not None:
+            common_args.getLogger().info(f"{aggregate.getSharedSourceCount()} shared source files written once")
+        summary = phase_summary(parse_logs)
+        log_phase_summary(summary, common_args)
+        parse_logs["_summary"] = summary
+
+    if profile_dir is not None:
+        slowest = keep_slowest_profiles(profile_dir, parse_logs, args.profile)
+        common_args.getLogger().info(f"Profiles of the {len(slowest)} slowest packages written to {profile_dir}")
+
+    # Dump parse logs to a json file, also when interrupted
+    if args.shard:
+        parse_logs["_shard"] = shard_info
+    with atomic_open(parse_logs_file) as plg_fp:
         json.dump(parse_logs, plg_fp)
 
+    return {
+        'output_dir': sbom_dir,
+        'succeeded': succeeded,
+        'failed': failed,
+        'skipped': skipped,
+        'resumed': len(resumed),
+        'linked': linked,
+        'interrupted': interrupted,
+    }
+
+
+def generate_images(args, session, bb_vars, cached_db_file, sqlite_db_files):
+    """Generate the SBOMs of the images in args.image with generate_sbom. With
+    more than one image each gets its own directory in the output directory,
+    the package SBOMs are generated once for the first image that contains
+    them and linked from the others. A linked SBOM names the image it was
+    generated for. Returns the result of generate_sbom for a single image,
+    the results of each image and the shared counts otherwise."""
+    images = list(dict.fromkeys(args.image))
+    if len(images) == 1:
+        return generate_sbom(argparse.Namespace(**dict(vars(args), image=images[0])), session, bb_vars, cached_db_file, sqlite_db_files)
+
+    output_dir = args.output_dir or f"{bb_vars['DEPLOY_DIR_SPDX']}/wr-sbom"
+    shared = SharedPackages()
+    results = {}
+    for image in images:
+        logger.info(f"Generating {image}")
+        image_args = argparse.Namespace(**dict(vars(args), image=image, output_dir=f"{output_dir}/{image}"))
+        results[image] = generate_sbom(image_args, session, bb_vars, cached_db_file, sqlite_db_files, shared)
+        if results[image]['interrupted']:
+            break
+
+    logger.info("----------Multi-image SBOM Generation Complete----------")
+    for image, result in results.items():
+        total, shared_count = shared.getImageCounts(image)
+        logger.info(f"{image}: {total} packages, {shared_count} shared with other images, {result['succeeded']} generated, {result['linked']} linked")
+    distinct, shared_count = shared.getCounts()
+    logger.info(f"{distinct} distinct packages, {shared_count} in more than one image")
+    return {
+        'images': results,
+        'distinct': distinct,
+        'shared': shared_count,
+        'interrupted': any(result['interrupted'] for result in results.values()),
+    }
+
+
+def build_cache_dir():
+    """$BUILDDIR/cache/wr-sbom, None outside of an oe-init-build-env
+    environment"""
+    builddir = os.environ.get('BUILDDIR')
+    return f"{builddir}/cache/wr-sbom" if builddir else None
+
+
+def bitbake_vars_file():
+    cache_dir = build_cache_dir()
+    return f"{cache_dir}/bitbake-vars.json" if cache_dir else None
+
+
+def main():
+    sqlite_db_files = f"{scripts_path}/../../wr-sbom-dl-4.2/sqlite_db_files"
+    # Without BUILDDIR there is no cached IP database, bitbake variables or
+    # default socket, they have to be given on the command line
+    cache_dir = build_cache_dir()
+    cached_db_file = f"{cache_dir}/WRLinux-LTS.sqlite3" if cache_dir else None
+    default_socket = f"{cache_dir}/server.sock" if cache_dir else ""
+
+    # Set up argument parser
+    parser = (argparse_oe.ArgumentParser if argparse_oe else argparse.ArgumentParser)(description="WindRiver SBOM Generation Tool")
+    parser.add_argument('-d', '--debug', help='Enable debug output', action='store_true')
+    parser.add_argument('-q', '--quiet', help='Print only errors', action='store_true')
+    parser.add_argument('-D', '--db_file', help="IP Matching Database", action='store', default=cached_db_file)
+    parser.add_argument('-i', '--image', help="Image name to create SBOM from, can be used multiple times, packages shared by several images are generated once, default is wrlinux-image-small", action='append', type=str)
+    parser.add_argument('-l', '--limit', help="Limit # of packages parsed, default is all", type=int, action='store', default=0)
+    parser.add_argument('-p', '--packages', help="Scan package not image, can be used multiple times", action='append', type=str)
+    parser.add_argument('-o', '--output_dir', help="Alternate output directory for SBOM files", action='store')
+    parser.add_argument('-t', '--time', help='Enable timing output', action='store_true')
+    parser.add_argument('--rebuild_db', help="Rebuild the cached IP database from rcpl-0001 instead of applying only the new RCPL dumps", action='store_true')
+    parser.add_argument('--incremental', help="Only regenerate packages whose inputs changed since the last run", action='store_true')
+    parser.add_argument('--resume', help="Continue an interrupted run, packages it completed are not generated again", action='store_true')
+    parser.add_argument('--recipe_cache', help="Maximum number of recipe file entries kept in memory, default is 500000", type=int, action='store', default=500000)
+    parser.add_argument('--render_cache', help="Maximum MiB of rendered source files kept in memory per process, 0 disables the cache, default is 256", type=int, action='store', default=256)
+    parser.add_argument('-j', '--jobs', help="Number of packages to parse in parallel, default is 1", type=int, action='store', default=1)
+    parser.add_argument('--format', help="Output format, default is tag-value", choices=sorted(OUTPUT_FORMATS), action='store', default='tag-value')
+    parser.add_argument('--profile', help="Write cProfile profiles of the N slowest packages to <output_dir>/profile", type=int, metavar='N', action='store', default=0)
+    parser.add_argument('--aggregate', help="Write a single SBOM for the whole image, <image>.spdx, instead of one per package", action='store_true')
+    parser.add_argument('--deploy_dir_image', help="DEPLOY_DIR_IMAGE, default is $DEPLOY_DIR_IMAGE or the bitbake configuration", action='store', default=os.environ.get('DEPLOY_DIR_IMAGE'))
+    parser.add_argument('--deploy_dir_spdx', help="DEPLOY_DIR_SPDX, default is $DEPLOY_DIR_SPDX or the bitbake configuration", action='store', default=os.environ.get('DEPLOY_DIR_SPDX'))
+    parser.add_argument('--machine_arch', help="MACHINE_ARCH, default is $MACHINE_ARCH or the bitbake configuration", action='store', default=os.environ.get('MACHINE_ARCH'))
+    parser.add_argument('--shard', help="Generate shard K of N of the image's packages, the shards are merged with the merge command", type=shard_arg, metavar='K/N', action='store')
+    parser.add_argument('--serve', help=f"Keep the IP database and caches loaded and generate the SBOMs requested with --connect on a Unix socket, default is {default_socket}", nargs='?', const=default_socket, metavar='SOCKET')
+    parser.add_argument('--connect', help="Have the --serve server on SOCKET generate the SBOM, only the packages that changed are generated again", nargs='?', const=default_socket, metavar='SOCKET')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    merge_parser = subparsers.add_parser('merge', help="Combine the parse logs of the --shard runs in the output directory into parse_logs.json")
+    merge_parser.add_argument('-o', '--output_dir', help="Output directory of the shards", action='store', default=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    overrides = {
+        'DEPLOY_DIR_IMAGE': args.deploy_dir_image,
+        'DEPLOY_DIR_SPDX': args.deploy_dir_spdx,
+        'MACHINE_ARCH': args.machine_arch,
+    }
+    if cache_dir is None:
+        if args.serve == "" or args.connect == "":
+            parser.error("BUILDDIR is not set, --serve and --connect need a SOCKET")
+        if args.connect is None and not (args.command == 'merge' and args.output_dir):
+            if not all(overrides.values()):
+                parser.error("BUILDDIR is not set, source oe-init-build-env or give --deploy_dir_image, --deploy_dir_spdx and --machine_arch")
+            if args.command != 'merge' and not args.db_file:
+                parser.error("BUILDDIR is not set, the IP database has to be given with -D/--db_file")
+
+    # Setup logger and set important variables
+    logger.setLevel(logging.INFO)
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug(f"Debug Enabled: {args.db_file}")
+    elif args.quiet:
+        logger.setLevel(logging.ERROR)
+
+    if args.aggregate and args.incremental:
+        logger.error("--incremental can not be used with --aggregate")
+        sys.exit(1)
+    if args.aggregate and args.resume:
+        logger.error("--resume can not be used with --aggregate")
+        sys.exit(1)
+    if args.serve and args.connect:
+        logger.error("--serve can not be used with --connect")
+        sys.exit(1)
+    if args.aggregate and args.shard:
+        logger.error("--shard can not be used with --aggregate")
+        sys.exit(1)
+    args.image = args.image or ['wrlinux-image-small']
+    if args.shard and len(set(args.image)) > 1:
+        logger.error("--shard can only be used with a single image")
+        sys.exit(1)
+
+    if args.connect:
+        if not request_sbom(args.connect, args):
+            sys.exit(1)
+        return
+
+    # Full tinfoil parses are slow and need the bitbake lock, so the few
+    # variables needed are cached per build configuration
+    startup_time = time.time()
+    if args.command == 'merge' and args.output_dir:
+        if not merge_shard_logs(args.output_dir):
+            sys.exit(1)
+        return
+    bb_vars = get_bitbake_vars(overrides, os.environ.get('BUILDDIR'), bitbake_vars_file(), args.debug)
+    if args.command == 'merge':
+        if not merge_shard_logs(f"{bb_vars['DEPLOY_DIR_SPDX']}/wr-sbom"):
+            sys.exit(1)
+        return
+    if args.time:
+        logger.info(f"{time.time() - startup_time}s taken to read the bitbake configuration")
+
+    session = SbomSession(args.db_file, args.recipe_cache, args.render_cache, args.rebuild_db)
+    if args.serve:
+        if not serve_sbom_requests(args.serve, args, session, overrides, cached_db_file, sqlite_db_files):
+            sys.exit(1)
+        return
+
+    try:
+        result = generate_images(args, session, bb_vars, cached_db_file, sqlite_db_files)
+    except (OSError, ValueError, tarfile.TarError) as e:
+        logger.error(e)
+        sys.exit(1)
+    if result['interrupted']:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+import json
+import lxsbombench
+import os
+import tempfile
+import unittest
+
+class TestSyntheticCorpus(unittest.TestCase):
+    def test_generate_and_run(self):
+        with tempfile.TemporaryDirectory() as corpus_dir:
+            corpus = lxsbombench.generate_corpus(corpus_dir, packages=6, files=4, sources=2, hit_rate=0.5, split=3, license_refs=5, seed=1)
+            self.assertEqual(corpus, lxsbombench.load_corpus(corpus_dir))
+            self.assertEqual(len(os.listdir(os.path.join(corpus["DEPLOY_DIR_SPDX"], "recipes"))), 2)
+            self.assertEqual(sorted(os.listdir(os.path.join(corpus["DEPLOY_DIR_SPDX"], "packages"))),
+                ["recipe0-dbg.spdx.json", "recipe0-dev.spdx.json", "recipe0.spdx.json", "recipe1-dbg.spdx.json", "recipe1-dev.spdx.json", "recipe1.spdx.json"])
+
+            result = lxsbombench.run_hot_functions(corpus, os.path.join(corpus_dir, "out"))
+            self.assertEqual(result["packages"], 6)
+            self.assertEqual(result["failed"], 0)
+            self.assertEqual(result["functions"]["resolve_package"]["calls"], 6)
+            self.assertEqual(len(os.listdir(os.path.join(corpus_dir, "out"))), 6)
+            # the timing wrappers are removed again
+            self.assertEqual(lxsbombench.sys.modules["lxsbomtool"].resolve_package.__name__, "resolve_package")
+
+if __name__ == '__main__':
+    unittest.main()
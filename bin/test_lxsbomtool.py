@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
+import io
+import itertools
+import json
 import lxsbomtool
+import lzma
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sqlite3
+import tarfile
+import tempfile
 import unittest
+import unittest.mock
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata")
 
 class MockLogger:
     def debug(self, message):
         self.message = message + "mocked"
 
+    def info(self, message):
+        self.message = message + "mocked"
+
+    def error(self, message):
+        self.message = message + "mocked"
+
 class LogTimedEventTest(unittest.TestCase):
     def test_time_false(self):
         common_args = lxsbomtool.CommonArgs(MockLogger(), None, None, None, None)
@@ -49,6 +69,681 @@ class TestDocrefMapping(unittest.TestCase):
         # placed in the dict to match the original functionality.
         self.assertEquals(docref_dict["example_docref"], "example.file")
 
+    def test_duplicate_namespace(self):
+        index_json = { "documents": [
+            { "documentNamespace": "example_spdx", "filename": "example.file" },
+            { "documentNamespace": "example_spdx", "filename": "example2.file" }
+        ] }
+        namespace_dict = lxsbomtool.make_namespace_dict(index_json)
+
+        # The first matching document wins
+        self.assertEquals(namespace_dict["example_spdx"], "example.file")
+        self.assertEquals(lxsbomtool.make_document_ref_dict(
+            [{ "externalDocumentId": "example_docref", "spdxDocument": "example_spdx" }],
+            index_json), { "example_docref": "example.file" })
+
+    def test_package_document_refs(self):
+        pkg_json = { "externalDocumentRefs": [{ "externalDocumentId": "DocumentRef-recipe-foo", "spdxDocument": "example_spdx" }] }
+        index_json = { "documents": [{ "documentNamespace": "example_spdx", "filename": "recipe-foo.spdx.json" }] }
+        doc_index = lxsbomtool.PackageDocumentIndex(pkg_json, lxsbomtool.make_namespace_dict(index_json))
+
+        self.assertEquals(doc_index.getDocumentFilename("DocumentRef-recipe-foo"), "recipe-foo.spdx.json")
+        self.assertIsNone(doc_index.getDocumentFilename("DocumentRef-recipe-bar"))
+
+    def test_resolve_source_file(self):
+        pkg_json = { "externalDocumentRefs": [{ "externalDocumentId": "DocumentRef-recipe-foo", "spdxDocument": "example_spdx" }] }
+        namespace_dict = { "example_spdx": "recipe-foo.spdx.json" }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "recipes"))
+            with open(os.path.join(tmpdir, "recipes", "recipe-foo.spdx.json"), "w") as fp:
+                json.dump({ "files": [{ "SPDXID": "SPDXRef-SourceFile-foo-1" }, { "SPDXID": "SPDXRef-SourceFile-foo-2" }] }, fp)
+
+            common_args = lxsbomtool.CommonArgs(MockLogger(), None, None, lxsbomtool.RecipeStore(100), {}, None, namespace_dict)
+            doc_index = lxsbomtool.PackageDocumentIndex(pkg_json, namespace_dict)
+
+            src_file = lxsbomtool.resolve_source_file(doc_index, "DocumentRef-recipe-foo:SPDXRef-SourceFile-foo-2", False, tmpdir, common_args)
+            self.assertEquals(src_file, { "SPDXID": "SPDXRef-SourceFile-foo-2" })
+            self.assertIsNone(lxsbomtool.resolve_source_file(doc_index, "DocumentRef-recipe-foo:SPDXRef-SourceFile-foo-3", False, tmpdir, common_args))
+            with self.assertRaises(KeyError):
+                lxsbomtool.resolve_source_file(doc_index, "DocumentRef-recipe-bar:SPDXRef-SourceFile-bar-1", False, tmpdir, common_args)
+
+class TestPackageDocumentIndex(unittest.TestCase):
+    def test_exact_matching(self):
+        pkg_json = {
+            "files": [{ "SPDXID": "SPDXRef-PackagedFile-foo-1" }, { "SPDXID": "SPDXRef-PackagedFile-foo-10" }],
+            "relationships": [
+                { "spdxElementId": "SPDXRef-Package-foo", "relationshipType": "CONTAINS", "relatedSpdxElement": "SPDXRef-PackagedFile-foo-1" },
+                { "spdxElementId": "SPDXRef-Package-foo", "relationshipType": "CONTAINS", "relatedSpdxElement": "SPDXRef-PackagedFile-foo-10" },
+                { "spdxElementId": "SPDXRef-PackagedFile-foo-10", "relationshipType": "GENERATED_FROM", "relatedSpdxElement": "DocumentRef-foo:SPDXRef-SourceFile-1" }
+            ]
+        }
+        doc_index = lxsbomtool.PackageDocumentIndex(pkg_json, {})
+
+        self.assertEqual(doc_index.getFile("SPDXRef-PackagedFile-foo-1"), { "SPDXID": "SPDXRef-PackagedFile-foo-1" })
+        self.assertEqual(len(doc_index.getRelationshipsTo("SPDXRef-PackagedFile-foo-1")), 1)
+        self.assertEqual(doc_index.getRelationshipsFrom("SPDXRef-PackagedFile-foo-1"), [])
+        self.assertEqual(len(doc_index.getRelationshipsFrom("SPDXRef-PackagedFile-foo-10")), 1)
+        self.assertIsNone(doc_index.getFile("SPDXRef-PackagedFile-foo-2"))
+
+class TestFileChecksumLookup(unittest.TestCase):
+    def test_batched_preload(self):
+        db_conn = sqlite3.connect(":memory:")
+        db_conn.execute("CREATE TABLE File (FileChecksum TEXT, FileType TEXT, LicenseConcluded TEXT, LicenseInfoInFile TEXT, FileCopyrightText TEXT)")
+        db_conn.execute("INSERT INTO File VALUES ('SHA256:aa', 'SOURCE', 'MIT', 'MIT', 'Copyright A')")
+        db_conn.execute("INSERT INTO File VALUES ('SHA256:bb', 'SOURCE', 'BSD', 'BSD', 'Copyright B')")
+
+        lookup = lxsbomtool.FileChecksumLookup()
+        lookup.CHUNK_SIZE = 2
+        lookup.preload(db_conn, ["SHA256:aa", "SHA256:bb", "SHA256:cc", "SHA256:aa"])
+
+        self.assertEqual(lookup.getQueryCount(), 2)
+        self.assertEqual(lookup.getRows(db_conn, "SHA256:aa"), [("SHA256:aa", "SOURCE", "MIT", "MIT", "Copyright A")])
+        self.assertEqual(lookup.getRows(db_conn, "SHA256:cc"), [])
+        self.assertEqual(lookup.getQueryCount(), 2)
+
+class TestChecksumIndex(unittest.TestCase):
+    def test_matches_database(self):
+        sha_a = "SHA256:" + "ab" * 32
+        sha_b = "SHA256:" + "cd" * 32
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, "ip.sqlite3")
+            db_conn = sqlite3.connect(db_file)
+            db_conn.execute("CREATE TABLE File (FileChecksum TEXT, FileType TEXT, LicenseConcluded TEXT, LicenseInfoInFile TEXT, FileCopyrightText TEXT)")
+            db_conn.execute("INSERT INTO File VALUES (?, 'SOURCE', 'MIT', 'MIT', 'Copyright A')", (sha_b,))
+            db_conn.execute("INSERT INTO File VALUES (?, 'SOURCE', 'MIT', 'MIT', 'Copyright A')", (sha_a,))
+            db_conn.execute("INSERT INTO File VALUES (?, 'SOURCE', 'BSD', 'BSD', NULL)", (sha_a,))
+            db_conn.commit()
+            db_conn.close()
+
+            index_file = os.path.join(tmpdir, "ip.checksums")
+            common_args = lxsbomtool.CommonArgs(MockLogger(), None, None, None, None)
+            self.assertTrue(lxsbomtool.build_checksum_index(db_file, index_file, common_args))
+
+            checksum_index = lxsbomtool.open_checksum_index(index_file, os.path.join(tmpdir, ".last_rcpl"), common_args)
+            self.assertEqual(checksum_index.getRows(sha_a, lxsbomtool.ChecksumIndex.makeKey(sha_a)),
+                             [(sha_a, "SOURCE", "MIT", "MIT", "Copyright A"), (sha_a, "SOURCE", "BSD", "BSD", None)])
+            self.assertEqual(checksum_index.getRows(sha_b, lxsbomtool.ChecksumIndex.makeKey(sha_b)),
+                             [(sha_b, "SOURCE", "MIT", "MIT", "Copyright A")])
+            sha_c = "SHA256:" + "ef" * 32
+            self.assertEqual(checksum_index.getRows(sha_c, lxsbomtool.ChecksumIndex.makeKey(sha_c)), [])
+            self.assertIsNone(lxsbomtool.ChecksumIndex.makeKey("SHA1:" + "ab" * 20))
+            checksum_index.close()
+
+class TestPackageFingerprint(unittest.TestCase):
+    def test_detects_recipe_change(self):
+        rel = { "relatedSpdxElement": "DocumentRef-package-foo:SPDXRef-Package-foo" }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "packages"))
+            os.makedirs(os.path.join(tmpdir, "recipes"))
+            with open(os.path.join(tmpdir, "packages", "foo.spdx.json"), "w") as fp:
+                fp.write("{}")
+            recipe_file = os.path.join(tmpdir, "recipes", "recipe-foo.spdx.json")
+            with open(recipe_file, "w") as fp:
+                fp.write("{}")
+
+            fingerprint = lxsbomtool.package_fingerprint(rel, "foo.spdx.json", ["recipe-foo.spdx.json"], "image", "rcpl-0001", tmpdir)
+            self.assertEqual(fingerprint, lxsbomtool.package_fingerprint(rel, "foo.spdx.json", ["recipe-foo.spdx.json"], "image", "rcpl-0001", tmpdir))
+            self.assertNotEqual(fingerprint, lxsbomtool.package_fingerprint(rel, "foo.spdx.json", ["recipe-foo.spdx.json"], "image", "rcpl-0002", tmpdir))
+
+            os.utime(recipe_file, ns=(0, 0))
+            self.assertNotEqual(fingerprint, lxsbomtool.package_fingerprint(rel, "foo.spdx.json", ["recipe-foo.spdx.json"], "image", "rcpl-0001", tmpdir))
+
+class TestSpdxCatalog(unittest.TestCase):
+    def test_incremental_refresh(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            deploy_dir_spdx = os.path.join(tmpdir, "spdx")
+            shutil.copytree(TESTDATA, deploy_dir_spdx)
+            common_args = lxsbomtool.CommonArgs(MockLogger(), None, None, None, None)
+            namespace_dict = lxsbomtool.make_namespace_dict(json.load(open(os.path.join(TESTDATA, "index.json"))))
+            catalog = lxsbomtool.SpdxCatalog(os.path.join(tmpdir, "cache", "spdx-catalog.sqlite3"))
+
+            # Only the package documents asked for are read
+            self.assertEqual(catalog.refresh(deploy_dir_spdx, ["foo.spdx.json"], common_args), 1)
+            self.assertEqual(catalog.refresh(deploy_dir_spdx, ["foo.spdx.json"], common_args), 0)
+            self.assertEqual(lxsbomtool.package_recipe_files(deploy_dir_spdx, "foo.spdx.json", namespace_dict, catalog),
+                lxsbomtool.package_recipe_files(deploy_dir_spdx, "foo.spdx.json", namespace_dict))
+            self.assertEqual(catalog.getFingerprint(deploy_dir_spdx, "packages", "foo.spdx.json"),
+                lxsbomtool.file_fingerprint(os.path.join(deploy_dir_spdx, "packages", "foo.spdx.json")))
+            self.assertIsNone(catalog.getFingerprint(deploy_dir_spdx, "recipes", "recipe-foo.spdx.json"))
+            self.assertIsNone(catalog.getDocumentRefs(deploy_dir_spdx, "bar.spdx.json"))
+
+            # Only the changed document is read again, removed ones are dropped
+            with open(os.path.join(deploy_dir_spdx, "packages", "foo.spdx.json"), "a") as fp:
+                fp.write("\n")
+            os.remove(os.path.join(deploy_dir_spdx, "recipes", "recipe-foo.spdx.json"))
+            self.assertEqual(catalog.refresh(deploy_dir_spdx, ["foo.spdx.json"], common_args), 1)
+            self.assertEqual(lxsbomtool.package_recipe_files(deploy_dir_spdx, "foo.spdx.json", namespace_dict, catalog), [])
+            os.remove(os.path.join(deploy_dir_spdx, "packages", "foo.spdx.json"))
+            self.assertEqual(catalog.refresh(deploy_dir_spdx, ["foo.spdx.json"], common_args), 0)
+            self.assertIsNone(catalog.getDocumentRefs(deploy_dir_spdx, "foo.spdx.json"))
+            catalog.close()
+
+class TestProgressJournal(unittest.TestCase):
+    def test_resume_entries(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal_file = os.path.join(tmpdir, ".journal")
+            journal = lxsbomtool.ProgressJournal(journal_file, { "image": "test-image", "format": "tag-value", "shard": (1, 2) })
+            self.assertEqual(journal.load(), {})
+            journal.start({ "foo": { "parse_status": "succeeded" } })
+            journal.record("bar", { "parse_status": "failed" })
+            journal.close()
+            # a run killed while writing an entry
+            with open(journal_file, "a") as fp:
+                fp.write('{"package": "baz", "lo')
+
+            self.assertEqual(journal.load(), { "foo": { "parse_status": "succeeded" }, "bar": { "parse_status": "failed" } })
+            # a new run of the same shard reads the journal back
+            self.assertEqual(lxsbomtool.ProgressJournal(journal_file, { "image": "test-image", "format": "tag-value", "shard": (1, 2) }).load(), journal.load())
+            self.assertEqual(lxsbomtool.ProgressJournal(journal_file, { "image": "test-image", "format": "tag-value", "shard": (2, 2) }).load(), {})
+            self.assertEqual(lxsbomtool.ProgressJournal(journal_file, { "image": "other-image", "format": "tag-value", "shard": (1, 2) }).load(), {})
+
+    def test_atomic_open(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "foo.spdx")
+            with self.assertRaises(KeyboardInterrupt):
+                with lxsbomtool.atomic_open(filename) as fp:
+                    fp.write("partial")
+                    raise KeyboardInterrupt
+            self.assertEqual(os.listdir(tmpdir), [])
+            with lxsbomtool.atomic_open(filename) as fp:
+                fp.write("complete")
+            self.assertEqual(os.listdir(tmpdir), ["foo.spdx"])
+
+class TestBitbakeVarsCache(unittest.TestCase):
+    def test_cache_follows_conf_files(self):
+        bb_vars = { "DEPLOY_DIR_IMAGE": "/images", "DEPLOY_DIR_SPDX": "/spdx", "MACHINE_ARCH": "qemux86_64" }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "conf"))
+            local_conf = os.path.join(tmpdir, "conf", "local.conf")
+            with open(local_conf, "w") as fp:
+                fp.write('MACHINE = "qemux86-64"\n')
+            cache_file = os.path.join(tmpdir, "cache", "bitbake-vars.json")
+
+            key = lxsbomtool.bitbake_conf_key(tmpdir)
+            lxsbomtool.save_bitbake_vars(cache_file, key, bb_vars)
+            self.assertEqual(lxsbomtool.load_bitbake_vars(cache_file, key), bb_vars)
+
+            with open(local_conf, "a") as fp:
+                fp.write('MACHINE = "qemuarm64"\n')
+            self.assertIsNone(lxsbomtool.load_bitbake_vars(cache_file, lxsbomtool.bitbake_conf_key(tmpdir)))
+
+    def test_cache_follows_layers_and_environment(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "conf"))
+            os.makedirs(os.path.join(tmpdir, "meta-foo", "conf"))
+            layer_conf = os.path.join(tmpdir, "meta-foo", "conf", "layer.conf")
+            with open(layer_conf, "w") as fp:
+                fp.write('BBFILE_COLLECTIONS += "foo"\n')
+            with open(os.path.join(tmpdir, "conf", "bblayers.conf"), "w") as fp:
+                fp.write('BBLAYERS ?= " \\\n  ${TOPDIR}/meta-foo \\\n  ${TOPDIR}/meta-bar \\\n  "\n')
+            self.assertEqual(lxsbomtool.bitbake_layers(tmpdir), [os.path.join(tmpdir, "meta-foo"), os.path.join(tmpdir, "meta-bar")])
+
+            key = lxsbomtool.bitbake_conf_key(tmpdir)
+            os.utime(layer_conf, ns=(0, 0))
+            self.assertNotEqual(key, lxsbomtool.bitbake_conf_key(tmpdir))
+
+            key = lxsbomtool.bitbake_conf_key(tmpdir)
+            with unittest.mock.patch.dict(os.environ, { "BB_ENV_PASSTHROUGH_ADDITIONS": "MACHINE", "MACHINE": "qemuarm64" }):
+                self.assertNotEqual(key, lxsbomtool.bitbake_conf_key(tmpdir))
+            self.assertEqual(key, lxsbomtool.bitbake_conf_key(tmpdir))
+
+    def test_overrides_skip_bitbake(self):
+        bb_vars = { "DEPLOY_DIR_IMAGE": "/images", "DEPLOY_DIR_SPDX": "/spdx", "MACHINE_ARCH": "qemux86_64" }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, "bitbake-vars.json")
+            self.assertEqual(lxsbomtool.get_bitbake_vars(bb_vars, tmpdir, cache_file, False), bb_vars)
+            self.assertFalse(os.path.exists(cache_file))
+
+@unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+class TestSpdxArchive(unittest.TestCase):
+    def test_stream_members(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tar_file = os.path.join(tmpdir, "image-qemux86-64.spdx.tar")
+            with tarfile.open(tar_file, "w") as tar:
+                for name in ["index.json", "image-qemux86-64-20240101.spdx.json", "foo.spdx.json"]:
+                    data = json.dumps({ "name": name }).encode()
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            subprocess.check_call(["zstd", "-q", "--rm", tar_file])
+
+            archive = lxsbomtool.SpdxArchive(f"{tar_file}.zst", "image-qemux86-64-*.spdx.json", True)
+            self.assertEqual(archive.getIndex(), { "name": "index.json" })
+            self.assertEqual(archive.getImage(), { "name": "image-qemux86-64-20240101.spdx.json" })
+            self.assertEqual(json.loads(archive.getDocument("foo.spdx.json")), { "name": "foo.spdx.json" })
+            self.assertIsNone(archive.getDocument("bar.spdx.json"))
+
+class TestApplyRcplDumps(unittest.TestCase):
+    def write_dump(self, dump_file, sql):
+        with lzma.open(dump_file, "wt") as fp:
+            fp.write(sql)
+
+    def test_update_and_rollback(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, "ip.sqlite3")
+            dump_1 = os.path.join(tmpdir, "rcpl-0001.dump.xz")
+            dump_2 = os.path.join(tmpdir, "rcpl-0002.dump.xz")
+            dump_3 = os.path.join(tmpdir, "rcpl-0003.dump.xz")
+            self.write_dump(dump_1, "BEGIN TRANSACTION;\n"
+                "CREATE TABLE LicenseReference (LicenseID TEXT NOT NULL PRIMARY KEY, ExtractedText TEXT NOT NULL);\n"
+                "CREATE TABLE File (FileChecksum TEXT NOT NULL, FileType TEXT);\n"
+                "INSERT INTO LicenseReference VALUES('LicenseRef-a','line 1;\nline 2');\n")
+            self.write_dump(dump_2, "BEGIN TRANSACTION;\n"
+                "CREATE TABLE File (FileChecksum TEXT NOT NULL, FileType TEXT);\n"
+                "INSERT INTO LicenseReference VALUES('LicenseRef-a','duplicate');\n"
+                "INSERT INTO File VALUES('SHA256:aa','SOURCE');\n"
+                "COMMIT;\n")
+            self.write_dump(dump_3, "INSERT INTO File VALUES('SHA256:bb','SOURCE');\nNOT SQL;\n")
+
+            common_args = lxsbomtool.CommonArgs(MockLogger(), None, None, None, None)
+            self.assertTrue(lxsbomtool.apply_rcpl_dumps(db_file, [(1, dump_1)], "OFF", common_args))
+            self.assertTrue(lxsbomtool.apply_rcpl_dumps(db_file, [(2, dump_2)], "DELETE", common_args))
+            self.assertFalse(lxsbomtool.apply_rcpl_dumps(db_file, [(3, dump_3)], "DELETE", common_args))
+
+            db_conn = sqlite3.connect(db_file)
+            self.assertEqual(db_conn.execute("SELECT * FROM LicenseReference").fetchall(), [("LicenseRef-a", "line 1;\nline 2")])
+            self.assertEqual(db_conn.execute("SELECT * FROM File").fetchall(), [("SHA256:aa", "SOURCE")])
+            self.assertIn("File_FileChecksum", [row[1] for row in db_conn.execute("PRAGMA index_list('File')")])
+            db_conn.close()
+
+class TestRecipeStore(unittest.TestCase):
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "recipes"))
+            for name, count in (("a", 2), ("b", 2), ("c", 1)):
+                with open(os.path.join(tmpdir, "recipes", f"recipe-{name}.spdx.json"), "w") as fp:
+                    json.dump({ "files": [{ "SPDXID": f"SPDXRef-SourceFile-{name}-{i}" } for i in range(count)] }, fp)
+
+            common_args = lxsbomtool.CommonArgs(MockLogger(), None, None, None, None)
+            store = lxsbomtool.RecipeStore(4)
+            self.assertIn("SPDXRef-SourceFile-a-1", store.getFiles("recipe-a.spdx.json", tmpdir, False, common_args))
+            store.getFiles("recipe-b.spdx.json", tmpdir, False, common_args)
+            store.getFiles("recipe-a.spdx.json", tmpdir, False, common_args)
+            self.assertEqual(store.getCounts(), (1, 2, 0))
+
+            # b is the least recently used recipe and has to make room for c
+            store.getFiles("recipe-c.spdx.json", tmpdir, False, common_args)
+            self.assertEqual(store.getCounts(), (1, 3, 1))
+            store.getFiles("recipe-a.spdx.json", tmpdir, False, common_args)
+            self.assertEqual(store.getCounts(), (2, 3, 1))
+            store.getFiles("recipe-b.spdx.json", tmpdir, False, common_args)
+            self.assertEqual(store.getCounts(), (2, 4, 2))
+
+    def test_drop_changed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "recipes"))
+            recipe_file = os.path.join(tmpdir, "recipes", "recipe-a.spdx.json")
+            with open(recipe_file, "w") as fp:
+                json.dump({ "files": [{ "SPDXID": "SPDXRef-SourceFile-a-1" }] }, fp)
+
+            common_args = lxsbomtool.CommonArgs(MockLogger(), None, None, None, None)
+            store = lxsbomtool.RecipeStore(4)
+            store.getFiles("recipe-a.spdx.json", tmpdir, False, common_args)
+            store.dropChanged(tmpdir, common_args)
+            store.getFiles("recipe-a.spdx.json", tmpdir, False, common_args)
+            self.assertEqual(store.getCounts(), (1, 1, 0))
+
+            with open(recipe_file, "w") as fp:
+                json.dump({ "files": [{ "SPDXID": "SPDXRef-SourceFile-a-2" }] }, fp)
+            os.utime(recipe_file, ns=(0, 0))
+            store.dropChanged(tmpdir, common_args)
+            self.assertIn("SPDXRef-SourceFile-a-2", store.getFiles("recipe-a.spdx.json", tmpdir, False, common_args))
+            self.assertEqual(store.getCounts(), (1, 2, 0))
+
+class TestShards(unittest.TestCase):
+    def test_size_balanced_split(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "packages"))
+            relationships = []
+            docref_dict = {}
+            for name, size in (("a", 900), ("b", 500), ("c", 400), ("d", 300), ("e", 100)):
+                with open(os.path.join(tmpdir, "packages", f"{name}.spdx.json"), "w") as fp:
+                    fp.write(" " * size)
+                relationships.append({ "relatedSpdxElement": f"DocumentRef-{name}:SPDXRef-Package-{name}" })
+                docref_dict[f"DocumentRef-{name}"] = f"{name}.spdx.json"
+
+            shards = [lxsbomtool.shard_relationships(relationships, k, 2, docref_dict, tmpdir) for k in (1, 2)]
+            names = [[rel["relatedSpdxElement"][12] for rel in shard] for shard in shards]
+            self.assertEqual(names, [["a", "d"], ["b", "c", "e"]])
+            self.assertEqual(lxsbomtool.shard_arg("2/3"), (2, 3))
+            for value in ("0/3", "4/3", "3"):
+                with self.assertRaises(lxsbomtool.argparse.ArgumentTypeError):
+                    lxsbomtool.shard_arg(value)
+
+    def test_merge_shard_logs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shard_info = { "shards": 2, "image": "test-image", "packages": ["foo", "bar", "baz"] }
+            for shard, logs in ((1, { "bar": { "parse_status": "succeeded" } }), (2, { "foo": { "parse_status": "failed" }, "baz": { "parse_status": "skipped" } })):
+                with open(os.path.join(tmpdir, f"parse_logs.shard-{shard}-of-2.json"), "w") as fp:
+                    json.dump(dict(logs, _shard=dict(shard_info, shard=shard)), fp)
+
+            self.assertTrue(lxsbomtool.merge_shard_logs(tmpdir))
+            with open(os.path.join(tmpdir, "parse_logs.json")) as fp:
+                self.assertEqual(list(json.load(fp)), ["foo", "bar", "baz"])
+
+            os.remove(os.path.join(tmpdir, "parse_logs.shard-1-of-2.json"))
+            self.assertFalse(lxsbomtool.merge_shard_logs(tmpdir))
+
+class TestServerRequest(unittest.TestCase):
+    def test_request_args(self):
+        server_args = lxsbomtool.argparse.Namespace(image="wrlinux-image-small", packages=None, output_dir=None, format="tag-value", aggregate=False,
+            limit=0, jobs=4, time=False, profile=0, incremental=False, resume=True, debug=False)
+        args = lxsbomtool.request_args(server_args, { "image": "test-image", "packages": ["foo", "bar"], "format": "json" })
+        self.assertEqual((args.image, args.packages, args.format, args.jobs), (["test-image"], ["foo", "bar"], "json", 4))
+        # only the changed packages are generated again
+        self.assertTrue(args.incremental)
+        self.assertFalse(args.resume)
+        self.assertFalse(lxsbomtool.request_args(server_args, { "aggregate": True }).incremental)
+        self.assertEqual(server_args.image, "wrlinux-image-small")
+        with self.assertRaises(ValueError):
+            lxsbomtool.request_args(server_args, { "format": "xml" })
+
+class TestSharedPackages(unittest.TestCase):
+    def test_counts_and_links(self):
+        shared = lxsbomtool.SharedPackages()
+        shared.addImage("small", ["a.spdx.json", "b.spdx.json"])
+        shared.addImage("full", ["a.spdx.json", "b.spdx.json", "c.spdx.json"])
+        self.assertEqual(shared.getImageCounts("small"), (2, 2))
+        self.assertEqual(shared.getImageCounts("full"), (3, 2))
+        self.assertEqual(shared.getCounts(), (3, 2))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "small"))
+            os.makedirs(os.path.join(tmpdir, "full"))
+            with open(os.path.join(tmpdir, "small", "a.spdx"), "w") as fp:
+                fp.write("a")
+            shared.addFile("a.spdx.json", os.path.join(tmpdir, "small", "a.spdx"))
+            self.assertIsNone(shared.getFile("b.spdx.json"))
+
+            # An earlier file is replaced by the link
+            link_name = os.path.join(tmpdir, "full", "a.spdx")
+            with open(link_name, "w") as fp:
+                fp.write("old")
+            lxsbomtool.link_file(shared.getFile("a.spdx.json"), link_name)
+            self.assertEqual(os.readlink(link_name), os.path.join("..", "small", "a.spdx"))
+            with open(link_name) as fp:
+                self.assertEqual(fp.read(), "a")
+
+class TestLicenseExpressions(unittest.TestCase):
+    def test_license_refs_in_order(self):
+        licenses = "LicenseRef-b AND MIT;GPL-2.0-only WITH LicenseRef-a OR LicenseRef-b"
+        self.assertEqual(lxsbomtool.license_tokens(licenses), ("LicenseRef-b", "MIT", "GPL-2.0-only", "LicenseRef-a", "LicenseRef-b"))
+        self.assertEqual(lxsbomtool.license_refs_in(licenses), ("LicenseRef-b", "LicenseRef-a"))
+
+    def test_extract_license_copyright(self):
+        rows = [ ("SHA256:" + "1" * 64, "SOURCE", "LicenseRef-c;MIT", "LicenseRef-a OR LicenseRef-c", "Copyright (c) Foo\r\n") ]
+        self.assertEqual(lxsbomtool.extract_license_copyright(rows), (["LicenseRef-c", "LicenseRef-a"], { "licenseInfoInFiles": "LicenseRef-c", "copyrightText": "Copyright (c) Foo" }))
+        self.assertEqual(lxsbomtool.extract_license_copyright([]), ([], None))
+
+    def test_ordered_set(self):
+        refs = lxsbomtool.OrderedSet(["LicenseRef-b"])
+        for licid in ["LicenseRef-a", "LicenseRef-b", "LicenseRef-c"]:
+            refs.append(licid)
+        self.assertEqual(list(refs), ["LicenseRef-b", "LicenseRef-a", "LicenseRef-c"])
+        self.assertIn("LicenseRef-a", refs)
+        refs.clear()
+        self.assertEqual(len(refs), 0)
+
+class TestLicenseReferenceLookup(unittest.TestCase):
+    def test_bulk_lookup_and_render(self):
+        db_conn = sqlite3.connect(":memory:")
+        db_conn.execute("CREATE TABLE LicenseReference (LicenseID TEXT NOT NULL PRIMARY KEY, ExtractedText TEXT NOT NULL, LicenseName TEXT NOT NULL DEFAULT 'NOASSERTION', LicenseCrossReference TEXT, LicenseComment TEXT)")
+        db_conn.execute("INSERT INTO LicenseReference VALUES ('LicenseRef-foo', 'Foo license text', 'Foo License', NULL, 'none')")
+        db_conn.execute("INSERT INTO LicenseReference VALUES ('LicenseRef-o''brien', 'Text', 'Name', NULL, 'none')")
+
+        lookup = lxsbomtool.LicenseReferenceLookup()
+        entries = lookup.getEntries(db_conn, ["LicenseRef-o'brien", "LicenseRef-missing", "LicenseRef-foo"])
+        self.assertEqual([(licid, row is not None) for licid, row in entries], [("LicenseRef-o'brien", True), ("LicenseRef-missing", False), ("LicenseRef-foo", True)])
+        self.assertEqual(lookup.getCounts(), (1,))
+
+        writer = lxsbomtool.TagValueWriter(io.StringIO())
+        rendered = lookup.getRendered(writer, db_conn, ["LicenseRef-foo", "LicenseRef-missing"])
+        self.assertIs(lookup.getRendered(writer, db_conn, ["LicenseRef-foo"])[0], rendered[0])
+        self.assertEqual(lookup.getCounts(), (1,))
+
+        expected = io.StringIO()
+        lxsbomtool.write_licenseref_entries(expected, lxsbomtool.lookup_licenserefs(db_conn, ["LicenseRef-foo", "LicenseRef-missing"]))
+        sbom_fp = io.StringIO()
+        lxsbomtool.TagValueWriter(sbom_fp).writeRenderedLicenseRefs(rendered)
+        self.assertEqual(sbom_fp.getvalue().split("AnnotationDate:")[0], expected.getvalue().split("AnnotationDate:")[0])
+
+class TestSourceFileCache(unittest.TestCase):
+    def make_file(self, n):
+        return {
+            "fileName": f"src/file{n}.c",
+            "SPDXID": f"SPDXRef-SourceFile-{n}",
+            "checksums": [ { "algorithm": "SHA1", "checksumValue": "a" * 40 }, { "algorithm": "SHA256", "checksumValue": f"{n}" * 64 } ],
+        }
+
+    def test_render_once_and_evict(self):
+        rows = [ (f"SHA256:{'1' * 64}", "SOURCE", "MIT", "LicenseRef-foo", "Copyright (c) Foo") ]
+        cache = lxsbomtool.SourceFileCache(3 * lxsbomtool.CachedSourceFile.ENTRY_SIZE)
+        writer = lxsbomtool.TagValueWriter(io.StringIO())
+        file_1 = self.make_file(1)
+
+        key = lxsbomtool.SourceFileCache.makeKey(file_1)
+        self.assertIsNone(cache.get(key))
+        entry = lxsbomtool.CachedSourceFile(rows, *lxsbomtool.extract_license_copyright(rows))
+        cache.put(key, entry)
+        self.assertEqual(entry.license_refs, ["LicenseRef-foo"])
+
+        text = cache.getRendered(entry, writer, file_1)
+        self.assertIn("SPDXID: SPDXRef-SourceFile-1\n", text)
+        self.assertIn("LicenseInfoInFile: LicenseRef-foo\n", text)
+        self.assertIs(cache.getRendered(cache.get(key), writer, file_1), text)
+
+        for n in range(2, 5):
+            cache.put(lxsbomtool.SourceFileCache.makeKey(self.make_file(n)), lxsbomtool.CachedSourceFile([], [], None))
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.getCounts(), (1, 2, 1))
+        self.assertEqual(cache.getSize(), 3 * lxsbomtool.CachedSourceFile.ENTRY_SIZE)
+
+    def test_render_evicted_entry(self):
+        rows = [ (f"SHA256:{'1' * 64}", "SOURCE", "MIT", "MIT", "Copyright (c) Foo") ]
+        cache = lxsbomtool.SourceFileCache(2 * lxsbomtool.CachedSourceFile.ENTRY_SIZE)
+        writer = lxsbomtool.TagValueWriter(io.StringIO())
+        file_1 = self.make_file(1)
+        entry = lxsbomtool.CachedSourceFile(rows, *lxsbomtool.extract_license_copyright(rows))
+        cache.put(lxsbomtool.SourceFileCache.makeKey(file_1), entry)
+        for n in range(2, 4):
+            cache.put(lxsbomtool.SourceFileCache.makeKey(self.make_file(n)), lxsbomtool.CachedSourceFile([], [], None))
+        self.assertEqual(cache.getCounts(), (0, 0, 1))
+
+        # Rendering the evicted entry does not count against the cache
+        self.assertIn("SPDXID: SPDXRef-SourceFile-1\n", cache.getRendered(entry, writer, file_1))
+        self.assertEqual(cache.getSize(), 2 * lxsbomtool.CachedSourceFile.ENTRY_SIZE)
+        self.assertEqual(cache.getCounts(), (0, 0, 1))
+
+class TestPhaseTimer(unittest.TestCase):
+    def test_phase_summary(self):
+        timer = lxsbomtool.PhaseTimer()
+        timer.add("json_load", 0.5)
+        timer.add("json_load", 1.5)
+        timer.add("render", 2.0)
+        self.assertEqual(timer.getPhases()["json_load"], { "count": 2, "total": 2.0, "max": 1.5 })
+        parse_logs = {
+            "foo": { "parse_status": "succeeded", "phases": timer.getPhases() },
+            "bar": { "parse_status": "succeeded", "phases": { "render": { "count": 1, "total": 1.0, "max": 1.0 } } },
+            "baz": { "parse_status": "skipped", "phases": { "render": { "count": 1, "total": 9.0, "max": 9.0 } } },
+        }
+        # what is timed after the package was logged is not added to it
+        timer.add("render", 5.0)
+        self.assertEqual(parse_logs["foo"]["phases"]["render"], { "count": 1, "total": 2.0, "max": 2.0 })
+        timer.reset()
+        self.assertEqual(timer.getPhases(), {})
+
+        summary = lxsbomtool.phase_summary(parse_logs)
+        self.assertEqual(list(summary), ["json_load", "render"])
+        self.assertEqual(summary["render"], { "packages": 2, "count": 2, "total": 3.0, "max": 2.0, "p50": 1.0, "p90": 2.0, "p99": 2.0 })
+
+class TestParsePackageOutput(unittest.TestCase):
+    """Compare the SPDX written for testdata/packages/foo.spdx.json with the
+    output recorded in testdata/foo.spdx."""
+    def make_db(self):
+        db_conn = sqlite3.connect(":memory:")
+        db_conn.execute("CREATE TABLE File (FileChecksum TEXT, FileType TEXT, LicenseConcluded TEXT, LicenseInfoInFile TEXT, FileCopyrightText TEXT)")
+        db_conn.execute("CREATE TABLE LicenseReference (LicenseID TEXT NOT NULL PRIMARY KEY, ExtractedText TEXT NOT NULL, LicenseName TEXT NOT NULL DEFAULT 'NOASSERTION', LicenseCrossReference TEXT, LicenseComment TEXT)")
+        db_conn.execute("INSERT INTO File VALUES (?, 'SOURCE', 'GPL-2.0-only;LicenseRef-foo AND MIT', 'GPL-2.0-only OR LicenseRef-bar', ?)", ("SHA256:" + "1" * 64, "Copyright (c) 2020 Foo\r\n"))
+        db_conn.execute("INSERT INTO File VALUES (?, 'SOURCE', 'MIT', 'MIT', 'Copyright (c) 2021 Bar')", ("SHA256:" + "2" * 64,))
+        db_conn.execute("INSERT INTO LicenseReference VALUES ('LicenseRef-foo', 'Foo license text', 'Foo License', NULL, 'none')")
+        return db_conn
+
+    def normalize(self, text):
+        # Annotation dates change from run to run and collated licenses,
+        # copyrights and relationships are written in set order
+        def sort_key(line, state={ 'copyright': False }):
+            if line == "</text>":
+                state['copyright'] = False
+            elif state['copyright']:
+                return "copyright"
+            elif line == "FileCopyrightText: <text>":
+                state['copyright'] = True
+            elif line.startswith("LicenseInfoInFile: ") or line.startswith("Relationship: "):
+                return line.split(":")[0]
+            return None
+
+        lines = []
+        text = "\n".join("AnnotationDate: <date>" if l.startswith("AnnotationDate: ") else l for l in text.splitlines())
+        for key, group in itertools.groupby(text.splitlines(), key=sort_key):
+            lines += sorted(group) if key else list(group)
+        return "\n".join(lines)
+
+    def test_foo_package(self):
+        with open(os.path.join(TESTDATA, "index.json")) as fp:
+            index_json = json.load(fp)
+        with open(os.path.join(TESTDATA, "packages", "foo.spdx.json")) as fp:
+            pkg_json = json.load(fp)
+        rel = { "spdxElementId": "SPDXRef-Image", "relationshipType": "CONTAINS", "relatedSpdxElement": "DocumentRef-package-foo:SPDXRef-Package-foo" }
+
+        db_conn = self.make_db()
+        common_args = lxsbomtool.CommonArgs(MockLogger(), dict(), [], lxsbomtool.RecipeStore(100), {}, lxsbomtool.FileChecksumLookup(), lxsbomtool.make_namespace_dict(index_json))
+        sbom_fp = io.StringIO()
+        resolved = lxsbomtool.resolve_package(pkg_json, pkg_json['packages'][0]['SPDXID'], rel, db_conn, False, TESTDATA, common_args)
+        lxsbomtool.write_resolved_package(resolved, lxsbomtool.TagValueWriter(sbom_fp), False, common_args)
+        lxsbomtool.write_licenserefs(sbom_fp, db_conn, False, common_args)
+
+        with open(os.path.join(TESTDATA, "foo.spdx")) as fp:
+            expected = fp.read()
+        self.assertEqual(self.normalize(sbom_fp.getvalue()), self.normalize(expected))
+
+    def test_jobs_match_serial(self):
+        with open(os.path.join(TESTDATA, "index.json")) as fp:
+            index_json = json.load(fp)
+        rel = { "spdxElementId": "SPDXRef-Image", "relationshipType": "CONTAINS", "relatedSpdxElement": "DocumentRef-package-foo:SPDXRef-Package-foo" }
+        docref_dict = { "DocumentRef-package-foo": "foo.spdx.json" }
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, "ip.sqlite3")
+            db_conn = self.make_db()
+            with sqlite3.connect(db_file) as file_conn:
+                db_conn.backup(file_conn)
+            file_conn.close()
+            serial_dir = os.path.join(tmpdir, "serial")
+            jobs_dir = os.path.join(tmpdir, "jobs")
+            os.makedirs(serial_dir)
+            os.makedirs(jobs_dir)
+
+            common_args = lxsbomtool.CommonArgs(MockLogger(), dict(), lxsbomtool.OrderedSet(), lxsbomtool.RecipeStore(100), {}, lxsbomtool.FileChecksumLookup(), lxsbomtool.make_namespace_dict(index_json))
+            self.assertTrue(lxsbomtool.parse_relationship(rel, 1, {}, db_conn, None, "image", False, index_json, [], TESTDATA, serial_dir, docref_dict, common_args))
+
+            initargs = (db_file, None, None, 100, 1, "image", False, index_json, [], TESTDATA, jobs_dir, docref_dict)
+            with multiprocessing.Pool(2, initializer=lxsbomtool.init_worker, initargs=initargs) as pool:
+                parse_logs, success, counts, packages = pool.apply(lxsbomtool.parse_relationship_worker, (rel,))
+            self.assertTrue(success)
+            self.assertEqual([name for name, log in parse_logs], ["foo"])
+
+            with open(os.path.join(serial_dir, "foo.spdx")) as fp:
+                serial = fp.read()
+            with open(os.path.join(jobs_dir, "foo.spdx")) as fp:
+                self.assertEqual(self.normalize(fp.read()), self.normalize(serial))
+
+    def test_json_format(self):
+        with open(os.path.join(TESTDATA, "index.json")) as fp:
+            index_json = json.load(fp)
+        with open(os.path.join(TESTDATA, "packages", "foo.spdx.json")) as fp:
+            pkg_json = json.load(fp)
+        rel = { "spdxElementId": "SPDXRef-Image", "relationshipType": "CONTAINS", "relatedSpdxElement": "DocumentRef-package-foo:SPDXRef-Package-foo" }
+
+        db_conn = self.make_db()
+        common_args = lxsbomtool.CommonArgs(MockLogger(), dict(), [], lxsbomtool.RecipeStore(100), {}, lxsbomtool.FileChecksumLookup(), lxsbomtool.make_namespace_dict(index_json))
+        resolved = lxsbomtool.resolve_package(pkg_json, pkg_json['packages'][0]['SPDXID'], rel, db_conn, False, TESTDATA, common_args)
+        sbom_fp = io.StringIO()
+        writer = lxsbomtool.JsonWriter(sbom_fp)
+        writer.writeDocumentHeader("image")
+        writer.writeCreationInfo(pkg_json)
+        lxsbomtool.write_resolved_package(resolved, writer, False, common_args)
+        writer.writeLicenseRefs(lxsbomtool.lookup_licenserefs(db_conn, common_args.getLicenseRefs()))
+        writer.close()
+
+        with open(os.path.join(TESTDATA, "foo.spdx")) as fp:
+            expected = fp.read()
+        document = json.loads(sbom_fp.getvalue())
+        self.assertEqual(document['name'], "image")
+        self.assertEqual([p['SPDXID'] for p in document['packages']], ["SPDXRef-Package-foo"])
+        self.assertEqual(sorted(f['SPDXID'] for f in document['files']), sorted(l[len("SPDXID: "):] for l in expected.splitlines() if l.startswith("SPDXID: SPDXRef-") and "Package-" not in l))
+        self.assertEqual(len(document['relationships']), expected.count("\nRelationship: "))
+        self.assertEqual([l['licenseId'] for l in document['hasExtractedLicensingInfos']], ["LicenseRef-foo", "LicenseRef-bar"])
+
+    def test_aggregate_writes_shared_data_once(self):
+        with open(os.path.join(TESTDATA, "index.json")) as fp:
+            index_json = json.load(fp)
+        with open(os.path.join(TESTDATA, "packages", "foo.spdx.json")) as fp:
+            pkg_json = json.load(fp)
+        rel = { "spdxElementId": "SPDXRef-Image", "relationshipType": "CONTAINS", "relatedSpdxElement": "DocumentRef-package-foo:SPDXRef-Package-foo" }
+
+        db_conn = self.make_db()
+        common_args = lxsbomtool.CommonArgs(MockLogger(), dict(), [], lxsbomtool.RecipeStore(100), {}, lxsbomtool.FileChecksumLookup(), lxsbomtool.make_namespace_dict(index_json))
+        sbom_fp = io.StringIO()
+        aggregate = lxsbomtool.AggregateWriter(lxsbomtool.TagValueWriter(sbom_fp), "image", pkg_json, False, common_args)
+        for i in range(2):
+            common_args.resetPackageState()
+            resolved = lxsbomtool.resolve_package(pkg_json, pkg_json['packages'][0]['SPDXID'], rel, db_conn, False, TESTDATA, common_args)
+            aggregate.addPackage(resolved, list(common_args.getLicenseRefs()))
+        aggregate.close(db_conn)
+
+        output = sbom_fp.getvalue()
+        self.assertEqual(output.count("SPDXVersion: "), 1)
+        self.assertEqual(output.count("PackageName: "), 2)
+        self.assertEqual(output.count("SPDXID: SPDXRef-SourceFile-foo-1\n"), 1)
+        self.assertEqual(output.count("LicenseID: LicenseRef-foo\n"), 1)
+        self.assertGreater(aggregate.getSharedSourceCount(), 0)
+
+class TestIterPackages(unittest.TestCase):
+    def test_package_model(self):
+        with tempfile.TemporaryDirectory() as deploy_dir_image:
+            db_file = os.path.join(deploy_dir_image, "ip.sqlite3")
+            db_conn = TestParsePackageOutput().make_db()
+            db_conn.commit()
+            db_conn.execute("VACUUM INTO ?", (db_file,))
+            db_conn.close()
+            image_json = {
+                "externalDocumentRefs": [{ "externalDocumentId": "DocumentRef-package-foo", "spdxDocument": "http://spdx.org/spdxdoc/foo-1" }],
+                "relationships": [
+                    { "spdxElementId": "SPDXRef-DOCUMENT", "relationshipType": "DESCRIBES", "relatedSpdxElement": "SPDXRef-Image" },
+                    { "spdxElementId": "SPDXRef-Image", "relationshipType": "CONTAINS", "relatedSpdxElement": "DocumentRef-package-foo:SPDXRef-Package-foo" },
+                ],
+            }
+            with open(os.path.join(deploy_dir_image, "image-qemux86-64.spdx.json"), "w") as fp:
+                json.dump(image_json, fp)
+            shutil.copy(os.path.join(TESTDATA, "index.json"), os.path.join(deploy_dir_image, "image-qemux86-64.spdx.index.json"))
+
+            models = list(lxsbomtool.iter_packages(deploy_dir_image, TESTDATA, "qemux86_64", "image", db_file))
+
+        with open(os.path.join(TESTDATA, "foo.spdx")) as fp:
+            expected = fp.read()
+        self.assertEqual([m.name for m in models], ["foo"])
+        model = models[0]
+        self.assertEqual(model.package['SPDXID'], "SPDXRef-Package-foo")
+        self.assertEqual({f.spdx_id for f in model.packaged_files} | set(model.source_files),
+            {l[len("SPDXID: "):] for l in expected.splitlines() if l.startswith("SPDXID: SPDXRef-") and "Package-" not in l})
+        for packaged_file in model.packaged_files:
+            self.assertTrue(set(packaged_file.sources) <= set(model.source_files))
+        source = [s for s in model.source_files.values() if s.ip_data is not None][0]
+        self.assertEqual(source.ip_data.copyright_text, "Copyright (c) 2020 Foo")
+        self.assertEqual([(r.license_id, r.found) for r in model.license_refs], [("LicenseRef-foo", True), ("LicenseRef-bar", False)])
+        with self.assertRaises(AttributeError):
+            model.extra = None
+
 if __name__ == "__main__":
     unittest.main()
 